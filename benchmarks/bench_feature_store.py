@@ -0,0 +1,51 @@
+"""Чтение признаков всех открытых профилей для анализа: из таблицы SQLite и из колоночного хранилища"""
+import numpy as np
+import pytest
+
+from src.bot_detector.database import DatabaseManager
+from src.bot_detector.data_analysis import database_batches, feature_store_batches, update_feature_store
+from src.bot_detector.feature_store import FeatureStore
+from src.bot_detector.features import users_features
+from benchmarks.conftest import PROFILES_NUMBER
+
+BATCHES_NUMBER = 20     # Профилей в таблице = BATCHES_NUMBER * PROFILES_NUMBER, читаются пачками по PROFILES_NUMBER
+
+
+@pytest.fixture
+def database(tmp_path, event_loop_runner, grabber, open_profiles):
+    """БД с BATCHES_NUMBER * PROFILES_NUMBER открытыми профилями и сжатым хранилищем признаков рядом с ней"""
+    db = DatabaseManager(str(tmp_path / 'data.db'), feature_folder=str(tmp_path))
+    event_loop_runner(db.connect())
+    event_loop_runner(db.create_tables())
+    rows = users_features(open_profiles, grabber.open_fillers_list, grabber.open_counters_list)
+    for batch in range(BATCHES_NUMBER):
+        offset = batch * PROFILES_NUMBER
+        event_loop_runner(db.save_collected_batch(
+            users=[(row[0] + offset, 0, 0) for row in rows],
+            open_profiles=[(row[0] + offset, *row[1:]) for row in rows]))
+    event_loop_runner(update_feature_store(db, db.feature_stores[False]))
+    yield db
+    event_loop_runner(db.close())
+
+
+async def read_all(batches) -> int:
+    """Проходит все пачки так же, как конвейер анализа, и считает строки"""
+    rows = 0
+    async for ids, features in batches:
+        rows += len(ids)
+        np.ascontiguousarray(features)  # Нейросеть получает признаки одним массивом
+    return rows
+
+
+def bench_read_features_database(benchmark, database, event_loop_runner):
+    benchmark.extra_info['rows'] = BATCHES_NUMBER * PROFILES_NUMBER
+    rows = benchmark(lambda: event_loop_runner(read_all(database_batches(database, False, PROFILES_NUMBER, None))))
+    assert rows == BATCHES_NUMBER * PROFILES_NUMBER
+
+
+def bench_read_features_store(benchmark, database, event_loop_runner):
+    store: FeatureStore = database.feature_stores[False]
+    benchmark.extra_info['rows'] = BATCHES_NUMBER * PROFILES_NUMBER
+    rows = benchmark(lambda: event_loop_runner(read_all(feature_store_batches(database, store, PROFILES_NUMBER,
+                                                                              None))))
+    assert rows == BATCHES_NUMBER * PROFILES_NUMBER
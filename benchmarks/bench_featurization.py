@@ -0,0 +1,23 @@
+"""Разбор ответов API в строки БД: стоимость на один профиль = время пачки / PROFILES_NUMBER"""
+from src.bot_detector.features import users_features, groups_features, walls_features
+from benchmarks.conftest import PROFILES_NUMBER
+
+
+def bench_users_features_open(benchmark, grabber, open_profiles):
+    benchmark.extra_info['profiles'] = PROFILES_NUMBER
+    benchmark(users_features, open_profiles, grabber.open_fillers_list, grabber.open_counters_list)
+
+
+def bench_users_features_closed(benchmark, grabber, closed_profiles):
+    benchmark.extra_info['profiles'] = PROFILES_NUMBER
+    benchmark(users_features, closed_profiles, grabber.close_fillers_list, grabber.close_counters_list)
+
+
+def bench_groups_features(benchmark, groups):
+    benchmark.extra_info['profiles'] = PROFILES_NUMBER
+    benchmark(groups_features, groups)
+
+
+def bench_walls_features(benchmark, walls):
+    benchmark.extra_info['profiles'] = PROFILES_NUMBER
+    benchmark(walls_features, walls)
@@ -0,0 +1,41 @@
+"""Нормализация и предсказание нейросети на пачке из 1 и из PROFILES_NUMBER профилей"""
+import pytest
+
+from src.bot_detector.numpy_models import NumpyPredictionModel
+from benchmarks.conftest import PROFILES_NUMBER
+
+BATCH_SIZES = [1, PROFILES_NUMBER]
+
+
+@pytest.fixture(scope='module')
+def torch_models():
+    pytest.importorskip('torch')
+    from src.bot_detector.neural_models import PredictionModel
+    return {False: PredictionModel(False), True: PredictionModel(True)}
+
+
+@pytest.fixture(scope='module')
+def numpy_models():
+    return {False: NumpyPredictionModel(False), True: NumpyPredictionModel(True)}
+
+
+@pytest.mark.parametrize('batch_size', BATCH_SIZES)
+def bench_normalizer_forward(benchmark, torch_models, open_features, batch_size):
+    benchmark.extra_info['profiles'] = batch_size
+    benchmark(torch_models[False].transform.forward, open_features[:batch_size])
+
+
+@pytest.mark.parametrize('is_close', [False, True])
+@pytest.mark.parametrize('batch_size', BATCH_SIZES)
+def bench_torch_model_predict(benchmark, torch_models, open_features, closed_features, is_close, batch_size):
+    features = closed_features if is_close else open_features
+    benchmark.extra_info['profiles'] = batch_size
+    benchmark(torch_models[is_close].model_predict, features[:batch_size])
+
+
+@pytest.mark.parametrize('is_close', [False, True])
+@pytest.mark.parametrize('batch_size', BATCH_SIZES)
+def bench_numpy_model_predict(benchmark, numpy_models, open_features, closed_features, is_close, batch_size):
+    features = closed_features if is_close else open_features
+    benchmark.extra_info['profiles'] = batch_size
+    benchmark(numpy_models[is_close].model_predict, features[:batch_size])
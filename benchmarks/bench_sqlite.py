@@ -0,0 +1,44 @@
+"""Запись собранных профилей в SQLite: стоимость на одну строку = время пачки / PROFILES_NUMBER"""
+import itertools
+
+import pytest
+
+from src.bot_detector.database import DatabaseManager
+from src.bot_detector.features import users_features, groups_features
+from benchmarks.conftest import PROFILES_NUMBER
+
+
+@pytest.fixture
+def database(tmp_path, event_loop_runner):
+    db = DatabaseManager(str(tmp_path / 'data.db'))
+    event_loop_runner(db.connect())
+    event_loop_runner(db.create_tables())
+    yield db
+    event_loop_runner(db.close())
+
+
+def bench_save_open_profiles(benchmark, database, event_loop_runner, grabber, open_profiles):
+    rows = users_features(open_profiles, grabber.open_fillers_list, grabber.open_counters_list)
+    rounds = itertools.count()
+
+    def save_batch():
+        # Каждый раунд пишет новые id, иначе вставка упрется в первичный ключ
+        offset = next(rounds) * PROFILES_NUMBER
+        event_loop_runner(database.save_collected_batch(
+            users=[(row[0] + offset, 0, 0) for row in rows],
+            open_profiles=[(row[0] + offset, *row[1:]) for row in rows]))
+
+    benchmark.extra_info['rows'] = PROFILES_NUMBER
+    benchmark(save_batch)
+
+
+def bench_save_groups(benchmark, database, event_loop_runner, groups):
+    rows = groups_features(groups)
+    rounds = itertools.count()
+
+    def save_batch():
+        offset = next(rounds) * PROFILES_NUMBER
+        event_loop_runner(database.save_collected_batch(groups=[[row[0] + offset, *row[1:]] for row in rows]))
+
+    benchmark.extra_info['rows'] = PROFILES_NUMBER
+    benchmark(save_batch)
@@ -0,0 +1,214 @@
+"""
+Сквозной бенчмарк сбора: поднимает локальный симулятор VK API и собирает через него 10k, 100k и 1M id.
+
+Запуск из корня репозитория:
+    python -m benchmarks.collection_benchmark --ids 10000 100000 1000000 --mode loop --tokens 3
+
+Каждый размер собирается в отдельном процессе с чистой БД во временной папке, так что пиковая память
+одного прогона не смешивается с другими. Результаты печатаются таблицей и могут дописываться в JSON (--json),
+чтобы сравнивать их между версиями.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import asyncio
+import argparse
+import datetime
+import tempfile
+from multiprocessing import Process, Queue
+
+import aiohttp
+import numpy as np
+
+from src.bot_detector import data_collector, token_limits
+from src.bot_detector.async_api import AIOInfoGrabber
+from src.bot_detector.database import DatabaseManager
+from src.bot_detector.data_collector import InfoLoop, take_data_in_processes
+from benchmarks.vk_simulator import start_simulator_process
+
+MODES = ['loop', 'processes', 'grabber']
+
+
+def peak_rss_mb(with_children: bool = False) -> float | None:
+    """Пиковая память процесса (и его завершившихся дочерних процессов), МБ"""
+    try:
+        import resource
+    except ImportError:     # Windows
+        try:
+            import psutil
+        except ImportError:
+            return None
+        return psutil.Process().memory_info().peak_wset / 2 ** 20
+
+    # В Linux ru_maxrss в КБ, в macOS - в байтах
+    scale = 2 ** 20 if sys.platform == 'darwin' else 2 ** 10
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if with_children:
+        peak = max(peak, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    return peak * scale / 2 ** 20
+
+
+def percentile(values: list[float], percent: float) -> float | None:
+    if len(values) == 0:
+        return None
+    return float(np.percentile(values, percent))
+
+
+def busy_time(intervals: list[tuple[float, float]]) -> float:
+    """
+    Сколько времени был занят хотя бы один из интервалов. Записи в БД идут по очереди под блокировкой,
+    так что простая сумма посчитала бы еще и ожидание блокировки
+    """
+    total, busy_until = 0.0, 0.0
+    for start, end in sorted(intervals):
+        if end > busy_until:
+            total += end - max(start, busy_until)
+            busy_until = end
+    return total
+
+
+def instrument(latencies: list[float], db_writes: list[tuple[float, float]]) -> None:
+    """
+    Оборачивает запросы к API и запись в БД замером времени. Работает только в текущем процессе,
+    так что в режиме processes задержки запросов и время записи не считаются
+    """
+    def timed(func, on_done):
+        async def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                on_done(start, time.perf_counter())
+        return wrapper
+
+    for name in ['users_info_request', 'groups_request', 'walls_request']:
+        setattr(AIOInfoGrabber, name, timed(getattr(AIOInfoGrabber, name),
+                                            lambda start, end: latencies.append(end - start)))
+    DatabaseManager.save_collected_batches = timed(DatabaseManager.save_collected_batches,
+                                                   lambda start, end: db_writes.append((start, end)))
+
+
+async def simulator_stats(api_url: str) -> dict:
+    async with aiohttp.ClientSession() as session:
+        async with session.get(api_url.replace('/method', '/stats')) as response:
+            return await response.json()
+
+
+def run_collection(ids_number: int, args: argparse.Namespace, api_url: str, results: Queue) -> None:
+    """Один прогон сбора, выполняется в отдельном процессе"""
+    data_folder = tempfile.mkdtemp(prefix='bot_detector_bench_')
+    token_keys = [f'bench-token-{number}' for number in range(args.tokens)]
+    proxys = [[None, None]] * args.tokens
+
+    # Паузы токенов пишем не в общий файл лимитов, а во временную папку, и ждем их столько же, сколько симулятор.
+    # Модули подменяются до запуска процессов сбора, так что в режиме processes это работает только там,
+    # где процессы создаются через fork (Linux)
+    data_collector.TOKEN_LIMITS_FILE = os.path.join(data_folder, 'token_limits.json')
+    token_limits.TOKEN_COOLDOWN = args.limit_cooldown
+
+    latencies, db_writes = [], []
+    instrument(latencies, db_writes)
+
+    # id идут с пропусками, как в реальных списках
+    user_ids = np.arange(1, ids_number + 1, dtype=np.int64) * 7
+    stages = args.stages.split(',')
+    stats_before = asyncio.run(simulator_stats(api_url))
+
+    start = time.perf_counter()
+    if args.mode == 'loop':
+        asyncio.run(InfoLoop(user_ids, token_keys, proxys, data_folder, cache_ttl_days=0, stages=stages,
+                             api_url=api_url, requests_per_second=args.rps).start())
+    elif args.mode == 'processes':
+        take_data_in_processes(user_ids, data_folder, token_keys, proxys, None, stages, api_url, args.rps)
+    else:
+        asyncio.run(AIOInfoGrabber(user_ids, data_folder, token_keys[0], requests_per_second=args.rps,
+                                   api_url=api_url).start('users'))
+    elapsed = time.perf_counter() - start
+
+    stats_after = asyncio.run(simulator_stats(api_url))
+    requests_number = stats_after['requests'] - stats_before['requests']
+    tokens_used = max(1, len([key for key in token_keys if key in stats_after['tokens']]))
+
+    results.put({
+        'date': datetime.datetime.now().isoformat(timespec='seconds'),
+        'mode': args.mode,
+        'stages': args.stages,
+        'ids': ids_number,
+        'tokens': tokens_used,
+        'seconds': round(elapsed, 2),
+        'ids_per_second': round(ids_number / elapsed, 1),
+        'requests_per_second_per_token': round(requests_number / elapsed / tokens_used, 2),
+        'requests': requests_number,
+        'error_29': stats_after['error_29'] - stats_before['error_29'],
+        'error_6': stats_after['error_6'] - stats_before['error_6'],
+        'latency_p50': percentile(latencies, 50),
+        'latency_p99': percentile(latencies, 99),
+        'db_write_seconds': round(busy_time(db_writes), 2) if db_writes else None,
+        'peak_rss_mb': peak_rss_mb(with_children=args.mode == 'processes'),
+    })
+
+    shutil.rmtree(data_folder, ignore_errors=True)
+
+
+def print_table(rows: list[dict]) -> None:
+    columns = ['ids', 'seconds', 'ids_per_second', 'requests_per_second_per_token', 'latency_p50', 'latency_p99',
+               'db_write_seconds', 'peak_rss_mb', 'error_29', 'error_6']
+    print('\t'.join(columns))
+    for row in rows:
+        print('\t'.join('-' if row[column] is None else
+                        f'{row[column]:.3f}' if isinstance(row[column], float) else str(row[column])
+                        for column in columns))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Сквозной бенчмарк сбора через локальный симулятор VK API')
+    parser.add_argument('--ids', type=int, nargs='+', default=[10_000, 100_000, 1_000_000],
+                        help='Сколько id собирать, можно несколько размеров')
+    parser.add_argument('--mode', choices=MODES, default='loop',
+                        help='loop - все токены в одном процессе (InfoLoop), processes - процесс на токен, '
+                             'grabber - один AIOInfoGrabber с одним токеном')
+    parser.add_argument('--stages', type=str, default='users', help='Стадии сбора через запятую')
+    parser.add_argument('--tokens', type=int, default=3, help='Сколько токенов (полос)')
+    parser.add_argument('--rps', type=float, default=50, help='Запросов в секунду с одного токена')
+    parser.add_argument('--latency', type=float, default=0.05, help='Средняя задержка ответа симулятора, сек')
+    parser.add_argument('--limit-after', type=int, help='Ошибка 29 после стольких запросов токена к методу')
+    parser.add_argument('--limit-cooldown', type=float, default=5.0, help='Сколько секунд держится ошибка 29')
+    parser.add_argument('--rps-limit', type=float, help='Ошибка 6 сверх стольких запросов в секунду с токена')
+    parser.add_argument('--fail-rate', type=float, default=0.0, help='Доля ответов 500')
+    parser.add_argument('--closed', type=float, default=0.3, help='Доля закрытых профилей')
+    parser.add_argument('--deactivated', type=float, default=0.1, help='Доля удаленных профилей')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--json', type=str, help='Дописать результаты в этот файл (JSON lines)')
+    args = parser.parse_args()
+
+    simulator = start_simulator_process(args.port, latency=args.latency, limit_after=args.limit_after,
+                                        limit_cooldown=args.limit_cooldown, rps_limit=args.rps_limit,
+                                        fail_rate=args.fail_rate, closed_ratio=args.closed,
+                                        deactivated_ratio=args.deactivated)
+    api_url = f'http://127.0.0.1:{args.port}/method'
+
+    rows = []
+    try:
+        for ids_number in args.ids:
+            results = Queue()
+            run = Process(target=run_collection, args=(ids_number, args, api_url, results))
+            run.start()
+            run.join()
+            if run.exitcode != 0:
+                raise RuntimeError(f'Прогон на {ids_number} id завершился с ошибкой')
+            row = results.get()
+            rows.append(row)
+            if args.json:
+                with open(args.json, 'a', encoding='utf-8') as file:
+                    file.write(json.dumps(row, ensure_ascii=False) + '\n')
+    finally:
+        simulator.terminate()
+
+    print()
+    print_table(rows)
+
+
+if __name__ == '__main__':
+    main()
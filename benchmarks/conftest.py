@@ -0,0 +1,58 @@
+import asyncio
+
+import numpy as np
+import pytest
+
+from src.bot_detector.async_api import AIOInfoGrabber
+from src.bot_detector.features import users_features
+from benchmarks.vk_fixtures import user_profile, user_groups, user_wall
+
+PROFILES_NUMBER = 1000  # Сколько профилей в одной пачке бенчмарка, время на профиль = время пачки / PROFILES_NUMBER
+
+
+@pytest.fixture(scope='session')
+def grabber() -> AIOInfoGrabber:
+    """Сборщик нужен только ради списков полей, к сети и БД он не подключается"""
+    return AIOInfoGrabber([], '', '')
+
+
+@pytest.fixture(scope='session')
+def open_profiles() -> list[dict]:
+    return [user_profile(user_id, closed_ratio=0, deactivated_ratio=0) for user_id in range(1, PROFILES_NUMBER + 1)]
+
+
+@pytest.fixture(scope='session')
+def closed_profiles() -> list[dict]:
+    return [user_profile(user_id, closed_ratio=1, deactivated_ratio=0) for user_id in range(1, PROFILES_NUMBER + 1)]
+
+
+@pytest.fixture(scope='session')
+def groups() -> list[list]:
+    return [user_groups(user_id) for user_id in range(1, PROFILES_NUMBER + 1)]
+
+
+@pytest.fixture(scope='session')
+def walls() -> list[list]:
+    return [user_wall(user_id) for user_id in range(1, PROFILES_NUMBER + 1)]
+
+
+@pytest.fixture(scope='session')
+def open_features(grabber, open_profiles) -> np.ndarray:
+    """Признаки открытых профилей без id, размер (PROFILES_NUMBER, 45)"""
+    rows = users_features(open_profiles, grabber.open_fillers_list, grabber.open_counters_list)
+    return np.array([row[1:] for row in rows], dtype=np.float32)
+
+
+@pytest.fixture(scope='session')
+def closed_features(grabber, closed_profiles) -> np.ndarray:
+    """Признаки закрытых профилей без id, размер (PROFILES_NUMBER, 16)"""
+    rows = users_features(closed_profiles, grabber.close_fillers_list, grabber.close_counters_list)
+    return np.array([row[1:] for row in rows], dtype=np.float32)
+
+
+@pytest.fixture
+def event_loop_runner():
+    """Один цикл событий на весь бенчмарк, чтобы не создавать его на каждый раунд"""
+    loop = asyncio.new_event_loop()
+    yield loop.run_until_complete
+    loop.close()
@@ -0,0 +1,94 @@
+"""Сбор всех стадий через локальный симулятор VK API доходит до конца и собирает каждый профиль один раз"""
+import os
+import asyncio
+import sqlite3
+
+import numpy as np
+import pytest
+
+from src.bot_detector import data_collector
+from src.bot_detector.database import DatabaseManager
+from src.bot_detector.data_collector import InfoLoop, take_data_in_processes
+from benchmarks.collection_benchmark import simulator_stats
+from benchmarks.vk_simulator import free_port, start_simulator_process
+
+IDS_NUMBER = 500
+HIDDEN_RATIO = 0.05         # Каждый двадцатый профиль со скрытыми группами и стеной
+COLLECTION_TIMEOUT = 60     # Сбор 500 профилей идет пару секунд, дольше - значит, зациклился
+PROCESSES = 3
+
+
+@pytest.fixture(scope='module')
+def api_url():
+    port = free_port()
+    simulator = start_simulator_process(port, latency=0.01, hidden_ratio=HIDDEN_RATIO)
+    yield f'http://127.0.0.1:{port}/method'
+    simulator.terminate()
+
+
+@pytest.fixture
+def data_folder(tmp_path, monkeypatch):
+    monkeypatch.setattr(data_collector, 'TOKEN_LIMITS_FILE', str(tmp_path / 'token_limits.json'))
+    return str(tmp_path)
+
+
+def open_profiles(data_folder: str) -> list[tuple]:
+    """id, group_checked и wall_checked всех открытых профилей"""
+    with sqlite3.connect(os.path.join(data_folder, 'data.db')) as connection:
+        return connection.execute('SELECT user_id, group_checked, wall_checked FROM users '
+                                  'WHERE deactivated = 0 AND is_close = 0').fetchall()
+
+
+def test_hidden_groups_and_walls_finish(data_folder, api_url):
+    """Профили, по которым VK всегда отвечает False, отмечаются проверенными, а не собираются заново бесконечно"""
+    collection = InfoLoop(np.arange(1, IDS_NUMBER + 1, dtype=np.int64), ['token-1', 'token-2'], [[None, None]],
+                          data_folder, cache_ttl_days=0, stages=['users', 'groups', 'walls'], api_url=api_url,
+                          requests_per_second=50)
+
+    async def run():
+        try:
+            await asyncio.wait_for(collection.start(), COLLECTION_TIMEOUT)
+        except asyncio.TimeoutError:
+            await collection.db.close()     # Иначе поток соединения с БД не даст pytest завершиться
+            raise
+
+    asyncio.run(run())
+
+    profiles = open_profiles(data_folder)
+    assert len(profiles) > 0
+    assert all(group_checked and wall_checked for _, group_checked, wall_checked in profiles)
+
+
+def test_processes_split_groups_and_walls(data_folder, api_url, monkeypatch):
+    """В режиме процессов группы и стены каждого профиля собирает только один процесс - тот, чей это срез id"""
+    monkeypatch.setattr(os, 'cpu_count', lambda: PROCESSES)    # Процессов не больше, чем ядер
+    user_ids = np.arange(1, IDS_NUMBER + 1, dtype=np.int64)
+    token_keys = [f'process-{number}' for number in range(PROCESSES)]
+    proxys = [[None, None]] * PROCESSES
+    take_data_in_processes(user_ids, data_folder, token_keys, proxys, None, ['users'], api_url, 50)
+
+    stats_before = asyncio.run(simulator_stats(api_url))
+    take_data_in_processes(user_ids, data_folder, token_keys, proxys, None, ['groups', 'walls'], api_url, 50)
+    stats_after = asyncio.run(simulator_stats(api_url))
+
+    profiles = open_profiles(data_folder)
+    assert all(group_checked and wall_checked for _, group_checked, wall_checked in profiles)
+    requests = {method: sum(stats_after['tokens'][key][method] - stats_before['tokens'][key][method]
+                            for key in token_keys) for method in ['groups', 'walls']}
+    # Пакеты по 25 и 10 id, неполным может быть только последний пакет каждого процесса
+    assert requests['groups'] <= len(profiles) // 25 + PROCESSES
+    assert requests['walls'] <= len(profiles) // 10 + PROCESSES
+
+
+def test_processes_fail_when_writer_fails(data_folder, api_url, monkeypatch):
+    """Если писатель упал, то сбор в процессах завершается ошибкой, а не зависает и не оставляет неполные данные"""
+    monkeypatch.setattr(os, 'cpu_count', lambda: PROCESSES)
+
+    async def failing_write(self, batches):
+        raise sqlite3.OperationalError('disk I/O error')
+
+    monkeypatch.setattr(DatabaseManager, 'save_collected_batches', failing_write)   # Процессы создаются через fork
+    token_keys = [f'failing-{number}' for number in range(PROCESSES)]
+    with pytest.raises(RuntimeError, match='disk I/O error'):
+        take_data_in_processes(np.arange(1, IDS_NUMBER + 1, dtype=np.int64), data_folder, token_keys,
+                               [[None, None]] * PROCESSES, None, ['users'], api_url, 50)
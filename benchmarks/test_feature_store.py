@@ -0,0 +1,52 @@
+"""Отметки об удалении профилей из таблиц признаков ведутся, только пока есть колоночное хранилище признаков"""
+import asyncio
+
+import pytest
+
+from src.bot_detector.database import DatabaseManager
+from src.bot_detector.features import users_features
+from benchmarks.conftest import PROFILES_NUMBER
+
+
+@pytest.fixture
+def rows(grabber, open_profiles) -> list[tuple]:
+    """Строки таблицы признаков открытых профилей (id, признаки...)"""
+    return users_features(open_profiles, grabber.open_fillers_list, grabber.open_counters_list)
+
+
+def removed_after_recheck(tmp_path, rows: list[tuple], feature_folder: str | None,
+                          tracking: bool | None = None) -> int:
+    """
+    Записывает открытые профили и удаляет их на перепроверку
+    :param feature_folder: Папка хранилища признаков для DatabaseManager
+    :param tracking: Включить или выключить отметки перед удалением (track_removed_features), как это делает анализ
+    :return: Сколько отметок об удалении осталось в features_removed
+    """
+    async def run() -> int:
+        db = DatabaseManager(str(tmp_path / 'data.db'), feature_folder=feature_folder)
+        await db.connect()
+        try:
+            await db.create_tables()
+            await db.save_collected_batch(users=[(row[0], 0, 0) for row in rows], open_profiles=rows)
+            if tracking is not None:
+                await db.track_removed_features(tracking)
+            await db.save_collected_batch(to_remove=[row[0] for row in rows])
+            return len(await db.get_data_in_list('SELECT user_id FROM features_removed'))
+        finally:
+            await db.close()
+
+    return asyncio.run(run())
+
+
+def test_removed_features_tracked_with_store(tmp_path, rows):
+    assert removed_after_recheck(tmp_path, rows, str(tmp_path)) == PROFILES_NUMBER
+
+
+def test_removed_features_not_tracked_without_store(tmp_path, rows):
+    assert removed_after_recheck(tmp_path, rows, None) == 0
+
+
+def test_disabling_tracking_clears_marks(tmp_path, rows):
+    """Анализ без хранилища выключает отметки, оставшиеся в БД после сбора с хранилищем, и стирает накопленные"""
+    assert removed_after_recheck(tmp_path, rows, str(tmp_path)) == PROFILES_NUMBER
+    assert removed_after_recheck(tmp_path, rows, None, tracking=False) == 0
@@ -0,0 +1,21 @@
+"""NumPy движок нейросети совпадает с PyTorch: те же веса и те же предсказания"""
+import pytest
+
+from src.bot_detector.numpy_models import NumpyPredictionModel, PARITY_TOLERANCE
+
+
+@pytest.fixture(scope='module')
+def neural_models():
+    pytest.importorskip('torch')
+    from src.bot_detector import neural_models
+    return neural_models
+
+
+def test_numpy_predictions_match_torch(neural_models):
+    assert neural_models.check_numpy_parity() <= PARITY_TOLERANCE
+
+
+@pytest.mark.parametrize('is_close', [False, True])
+def test_numpy_checksum_matches_torch(neural_models, is_close):
+    """По контрольной сумме анализ понимает, какие результаты уже посчитаны текущей моделью"""
+    assert NumpyPredictionModel(is_close).checksum == neural_models.PredictionModel(is_close).checksum
@@ -0,0 +1,82 @@
+"""Сбор через локальный симулятор VK API, который, как и настоящий API, отвечает ошибкой 6 сверх 3 запросов в секунду"""
+import asyncio
+
+import numpy as np
+import pytest
+
+from src.bot_detector.async_api import AIOInfoGrabber
+from src.bot_detector.database import DatabaseManager
+from src.bot_detector.work_queue import WorkQueue
+from benchmarks.collection_benchmark import simulator_stats
+from benchmarks.vk_simulator import free_port, start_simulator_process
+
+VK_RPS_LIMIT = 3                # Сколько запросов в секунду с одного токена разрешает VK API
+REQUESTS_NUMBER = 15            # Сколько запросов сделать, ~5 секунд на пределе лимита
+SLOW_LANE_RPS = 0.2             # Полоса с токеном, который разрешает один запрос в 5 секунд
+
+
+@pytest.fixture(scope='module')
+def api_url():
+    port = free_port()
+    simulator = start_simulator_process(port, latency=0.05, rps_limit=VK_RPS_LIMIT)
+    yield f'http://127.0.0.1:{port}/method'
+    simulator.terminate()
+
+
+def collect(tmp_path, api_url: str, token: str, **grabber_params) -> tuple[dict, int]:
+    """
+    Собирает REQUESTS_NUMBER полных пакетов id через симулятор
+    :return: Разница статистики симулятора за сбор и сколько профилей осталось несобранными
+    """
+    user_ids = np.arange(1, 25 * REQUESTS_NUMBER + 1, dtype=np.int64)
+
+    async def run() -> tuple[dict, int]:
+        db = DatabaseManager(str(tmp_path / 'data.db'))
+        await db.connect()
+        await db.create_tables()
+        stats_before = await simulator_stats(api_url)
+        await AIOInfoGrabber(user_ids, str(tmp_path), token, db=db, api_url=api_url, **grabber_params).start('users')
+        stats_after = await simulator_stats(api_url)
+        unchecked = await db.get_unchecked_profiles()
+        await db.close()
+        return {key: stats_after[key] - stats_before[key] for key in ['requests', 'error_6']}, len(unchecked)
+
+    return asyncio.run(run())
+
+
+def test_default_rate_has_no_error_6(tmp_path, api_url):
+    """С частотой по умолчанию (MIN_REQUEST_INTERVAL) сборщик идет вплотную к лимиту, но не получает ошибку 6"""
+    stats, unchecked = collect(tmp_path, api_url, 'default-rate')
+    assert stats['error_6'] == 0
+    assert unchecked == 0
+
+
+def test_error_6_keeps_batch_size(tmp_path, api_url):
+    """Ошибка 6 придерживает запросы токена, но не уменьшает пакет id: иначе запросов стало бы только больше"""
+    stats, unchecked = collect(tmp_path, api_url, 'too-fast', requests_per_second=2 * VK_RPS_LIMIT)
+    assert stats['error_6'] > 0
+    assert stats['requests'] - stats['error_6'] == REQUESTS_NUMBER     # Все принятые запросы - полные пакеты
+    assert unchecked == 0
+
+
+def test_slow_lane_does_not_hoard_batches(tmp_path, api_url):
+    """Полоса берет пакет из общей очереди, только когда ограничитель разрешил запрос, и не держит пакеты в ожидании"""
+    async def run() -> dict:
+        db = DatabaseManager(str(tmp_path / 'data.db'))
+        await db.connect()
+        await db.create_tables()
+        work_queue = WorkQueue(np.arange(1, 25 * REQUESTS_NUMBER + 1, dtype=np.int64))
+        stats_before = await simulator_stats(api_url)
+        # Медленная полоса стартует первой, так что раньше она успевала забрать себе всю очередь
+        lanes = [AIOInfoGrabber([], str(tmp_path), token, db=db, api_url=api_url, requests_per_second=rate)
+                 for token, rate in [('slow-lane', SLOW_LANE_RPS), ('fast-lane', VK_RPS_LIMIT)]]
+        await asyncio.gather(*[lane.start('users', work_queue) for lane in lanes])
+        stats_after = await simulator_stats(api_url)
+        await db.close()
+        return {token: stats_after['tokens'].get(token, {}).get('users', 0)
+                - stats_before['tokens'].get(token, {}).get('users', 0) for token in ['fast-lane', 'slow-lane']}
+
+    requests = asyncio.run(run())
+    # Пока быстрая полоса собирает очередь (~5 секунд), медленной разрешено не больше двух запросов
+    assert requests['slow-lane'] <= 2
+    assert requests['fast-lane'] + requests['slow-lane'] == REQUESTS_NUMBER
@@ -0,0 +1,74 @@
+import random
+
+# Поля, которые запрашивает execute.users_info (см. AIOInfoGrabber.fields_str), кроме id, screen_name и counters
+TEXT_FIELDS = ['about', 'activities', 'books', 'games', 'home_town', 'interests', 'movies', 'music', 'quotes',
+               'status']
+LIST_FIELDS = ['career', 'military', 'schools', 'universities']
+OPEN_COUNTERS = ['albums', 'audios', 'followers', 'friends', 'pages', 'photos', 'subscriptions', 'videos',
+                 'video_playlists', 'clips_followers', 'gifts', 'posts']
+
+
+def user_profile(user_id: int, closed_ratio: float = 0.3, deactivated_ratio: float = 0.1) -> dict:
+    """
+    Профиль в том виде, в каком его возвращает execute.users_info. Один и тот же id всегда дает один и тот же
+    профиль, так что повторные запуски собирают одинаковые данные
+    :param closed_ratio: Доля закрытых профилей
+    :param deactivated_ratio: Доля удаленных и забаненных профилей
+    """
+    rnd = random.Random(user_id)
+    profile = {'id': user_id, 'first_name': 'Имя', 'last_name': 'Фамилия', 'can_access_closed': True,
+               'is_closed': rnd.random() < closed_ratio}
+
+    if rnd.random() < deactivated_ratio:
+        profile['deactivated'] = rnd.choice(['deleted', 'banned'])
+        return profile
+
+    profile['screen_name'] = f'id{user_id}' if rnd.random() < 0.7 else f'user_{user_id}'
+    profile['has_photo'] = int(rnd.random() < 0.8)
+    profile['has_mobile'] = int(rnd.random() < 0.6)
+    profile['verified'] = 0
+    for field in TEXT_FIELDS:
+        profile[field] = 'Текст поля профиля' if rnd.random() < 0.3 else ''
+    for field in LIST_FIELDS:
+        profile[field] = [{'id': rnd.randint(1, 10 ** 6), 'name': 'Название'}] if rnd.random() < 0.2 else []
+    if rnd.random() < 0.6:
+        profile['city'] = {'id': rnd.randint(1, 1000), 'title': 'Город'}
+    if rnd.random() < 0.4:
+        profile['occupation'] = {'type': 'work', 'name': 'Работа'}
+    if rnd.random() < 0.3:
+        profile['personal'] = {'political': rnd.randint(1, 9), 'religion': 'Религия'}
+    profile['relation'] = rnd.choice([0, 0, 1, 2, 4])
+
+    # У части профилей VK вообще не возвращает счетчики
+    if rnd.random() < 0.95:
+        profile['counters'] = {counter: int(rnd.expovariate(1 / 50)) for counter in OPEN_COUNTERS
+                               if rnd.random() < 0.8}
+    return profile
+
+
+def user_groups(user_id: int) -> list:
+    """Ответ execute.groups_info на один профиль: [id, {count, items}]"""
+    rnd = random.Random(user_id)
+    count = int(rnd.expovariate(1 / 80))
+    items = [{'id': rnd.randint(1, 10 ** 8), 'is_closed': rnd.choice([0, 0, 0, 1, 2]),
+              'type': rnd.choice(['page', 'page', 'group', 'event']), 'has_photo': int(rnd.random() < 0.9)}
+             for _ in range(min(count, 200))]
+    return [str(user_id), {'count': count, 'items': items}]
+
+
+def user_wall(user_id: int) -> list:
+    """Ответ execute.walls_info на один профиль: [id, {count, items}], не больше 100 постов"""
+    rnd = random.Random(user_id)
+    count = int(rnd.expovariate(1 / 60))
+    items = []
+    for post_number in range(min(count, 100)):
+        post = {'id': count - post_number + rnd.randint(0, 3), 'text': 'Текст поста' if rnd.random() < 0.6 else '',
+                'likes': {'count': int(rnd.expovariate(1 / 20))},
+                'comments': {'count': int(rnd.expovariate(1 / 3))},
+                'reposts': {'count': int(rnd.expovariate(1))}}
+        if rnd.random() < 0.8:
+            post['views'] = {'count': int(rnd.expovariate(1 / 300))}
+        if rnd.random() < 0.3:
+            post['copy_history'] = [{'id': rnd.randint(1, 10 ** 6), 'text': ''}]
+        items.append(post)
+    return [str(user_id), {'count': count, 'items': items}]
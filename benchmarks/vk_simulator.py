@@ -0,0 +1,171 @@
+import time
+import random
+import socket
+import asyncio
+import argparse
+from collections import deque
+from multiprocessing import Process
+
+from aiohttp import web
+
+from benchmarks.vk_fixtures import user_profile, user_groups, user_wall
+
+METHODS = {'users': 'execute.users_info', 'groups': 'execute.groups_info', 'walls': 'execute.walls_info'}
+
+
+class VKSimulator:
+    def __init__(self, latency: float = 0.05,
+                 latency_jitter: float = 0.5,
+                 closed_ratio: float = 0.3,
+                 deactivated_ratio: float = 0.1,
+                 limit_after: int | None = None,
+                 limit_cooldown: float = 5.0,
+                 rps_limit: float | None = None,
+                 fail_rate: float = 0.0,
+                 hidden_ratio: float = 0.0):
+        """
+        Локальная замена VK API для процедур execute.users_info, execute.groups_info и execute.walls_info.
+        Отвечает данными того же вида, что и VK, и умеет в ошибки, с которыми сталкивается сбор
+        :param latency: Средняя задержка ответа, сек
+        :param latency_jitter: Разброс задержки: она равномерно распределена в latency * (1 +- latency_jitter)
+        :param closed_ratio: Доля закрытых профилей
+        :param deactivated_ratio: Доля удаленных и забаненных профилей
+        :param limit_after: Через сколько запросов токена к методу отвечать ошибкой 29 (лимит метода),
+            None - без лимита
+        :param limit_cooldown: Сколько секунд токен ограничен в методе после ошибки 29, потом счет начинается заново
+        :param rps_limit: Сколько запросов в секунду можно с одного токена, сверх этого - ошибка 6,
+            None - без ограничения
+        :param fail_rate: Доля запросов, на которые сервер отвечает 500
+        :param hidden_ratio: Доля профилей, у которых группы и стена скрыты: execute отвечает по ним False.
+            Профиль выбирается по id, так что повторный запрос ответит так же
+        """
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.closed_ratio = closed_ratio
+        self.deactivated_ratio = deactivated_ratio
+        self.limit_after = limit_after
+        self.limit_cooldown = limit_cooldown
+        self.rps_limit = rps_limit
+        self.fail_rate = fail_rate
+        self.hidden_ratio = hidden_ratio
+
+        self.requests: dict[str, deque] = {}                    # Время последних запросов каждого токена
+        self.method_requests: dict[tuple[str, str], int] = {}   # Запросы токена к методу с последнего лимита
+        self.limited_until: dict[tuple[str, str], float] = {}
+        self.stats = {'requests': 0, 'ids': 0, 'error_29': 0, 'error_6': 0, 'failed': 0, 'tokens': {}}
+
+    def make_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post(f'/method/{METHODS["users"]}', self.users_info)
+        app.router.add_post(f'/method/{METHODS["groups"]}', self.groups_info)
+        app.router.add_post(f'/method/{METHODS["walls"]}', self.walls_info)
+        app.router.add_get('/stats', self.get_stats)
+        return app
+
+    async def users_info(self, request: web.Request) -> web.Response:
+        return await self.handle(request, 'users', lambda user_id: user_profile(
+            user_id, self.closed_ratio, self.deactivated_ratio))
+
+    async def groups_info(self, request: web.Request) -> web.Response:
+        return await self.handle(request, 'groups', lambda user_id: self.hidden_or(user_id, user_groups))
+
+    async def walls_info(self, request: web.Request) -> web.Response:
+        return await self.handle(request, 'walls', lambda user_id: self.hidden_or(user_id, user_wall))
+
+    def hidden_or(self, user_id: int, build_item) -> list:
+        """Ответ по профилю со скрытыми группами и стеной - [id, False], по остальным - данные build_item"""
+        if random.Random(f'hidden-{user_id}').random() < self.hidden_ratio:
+            return [str(user_id), False]
+        return build_item(user_id)
+
+    async def get_stats(self, request: web.Request) -> web.Response:
+        """Накопленная статистика запросов, драйвер бенчмарка считает разницу до и после прогона"""
+        return web.json_response(self.stats)
+
+    async def handle(self, request: web.Request, method: str, build_item) -> web.Response:
+        data = await request.post()     # Сборщик шлет параметры формой в теле запроса
+        if 'users_id' not in data:
+            data = request.query        # На всякий случай принимаем и параметры в адресе
+        token = data.get('access_token', '')
+        user_ids = [int(user_id) for user_id in data['users_id'].split(',')]
+        now = time.monotonic()
+
+        token_stats = self.stats['tokens'].setdefault(token, {name: 0 for name in METHODS})
+        token_stats[method] += 1
+        self.stats['requests'] += 1
+
+        await asyncio.sleep(self.latency * random.uniform(1 - self.latency_jitter, 1 + self.latency_jitter))
+
+        if self.rps_limit is not None:
+            # Скользящее окно в одну секунду на каждый токен, в нем считаются только принятые запросы,
+            # иначе сборщик, который шлет чаще лимита, не получил бы ни одного ответа
+            token_requests = self.requests.setdefault(token, deque())
+            while token_requests and now - token_requests[0] > 1:
+                token_requests.popleft()
+            if len(token_requests) >= self.rps_limit:
+                self.stats['error_6'] += 1
+                return web.json_response({'error': {'error_code': 6,
+                                                    'error_msg': 'Too many requests per second'}})
+            token_requests.append(now)
+
+        if self.limit_after is not None:
+            key = (token, method)
+            if self.limited_until.get(key, 0) > now:
+                self.stats['error_29'] += 1
+                return web.json_response({'response': False, 'execute_errors': [
+                    {'method': 'users.get', 'error_code': 29, 'error_msg': 'Rate limit reached'}]})
+            self.method_requests[key] = self.method_requests.get(key, 0) + 1
+            if self.method_requests[key] > self.limit_after:
+                self.method_requests[key] = 0
+                self.limited_until[key] = now + self.limit_cooldown
+
+        if random.random() < self.fail_rate:
+            self.stats['failed'] += 1
+            return web.Response(status=500, text='Internal server error')
+
+        self.stats['ids'] += len(user_ids)
+        return web.json_response({'response': [build_item(user_id) for user_id in user_ids]})
+
+
+def free_port() -> int:
+    """Свободный локальный порт для симулятора"""
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def run_simulator(port: int, **config) -> None:
+    """Запускает симулятор и работает, пока процесс не остановят"""
+    web.run_app(VKSimulator(**config).make_app(), host='127.0.0.1', port=port, print=None)
+
+
+def start_simulator_process(port: int, **config) -> Process:
+    """Запускает симулятор в отдельном процессе (чтобы он не отнимал время у сборщика) и ждет, пока он поднимется"""
+    process = Process(target=run_simulator, args=(port, ), kwargs=config, daemon=True)
+    process.start()
+    for _ in range(100):
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=0.1):
+                return process
+        except OSError:
+            time.sleep(0.1)
+    process.terminate()
+    raise RuntimeError(f'Симулятор VK API не запустился на порту {port}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Локальный симулятор VK API для бенчмарков')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', type=float, default=0.05, help='Средняя задержка ответа, сек')
+    parser.add_argument('--limit-after', type=int, help='Ошибка 29 после стольких запросов токена к методу')
+    parser.add_argument('--limit-cooldown', type=float, default=5.0, help='Сколько секунд держится ошибка 29')
+    parser.add_argument('--rps-limit', type=float, help='Ошибка 6 сверх стольких запросов в секунду с токена')
+    parser.add_argument('--fail-rate', type=float, default=0.0, help='Доля ответов 500')
+    parser.add_argument('--hidden', type=float, default=0.0, help='Доля профилей со скрытыми группами и стеной')
+    parser.add_argument('--closed', type=float, default=0.3, help='Доля закрытых профилей')
+    parser.add_argument('--deactivated', type=float, default=0.1, help='Доля удаленных профилей')
+    args = parser.parse_args()
+    print(f'Симулятор VK API: http://127.0.0.1:{args.port}/method')
+    run_simulator(args.port, latency=args.latency, limit_after=args.limit_after, limit_cooldown=args.limit_cooldown,
+                  rps_limit=args.rps_limit, fail_rate=args.fail_rate, closed_ratio=args.closed,
+                  deactivated_ratio=args.deactivated, hidden_ratio=args.hidden)
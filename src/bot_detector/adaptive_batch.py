@@ -0,0 +1,45 @@
+class AdaptiveBatchSize:
+    def __init__(self, max_size: int, min_size: int = 1, grow_after: int = 10):
+        """
+        Размер пакета id в одном запросе execute, который подстраивается под ответы API.
+        Пока запросы проходят, размер растет на 1 после каждых grow_after удачных запросов (но не больше max_size),
+        а при ошибке или обрезанном ответе уменьшается вдвое
+        :param max_size: Максимальный размер пакета. Больше нельзя из-за ограничения VK на 25 вызовов API
+            внутри одного execute, поэтому с него и начинаем
+        :param min_size: Минимальный размер пакета
+        :param grow_after: Через сколько удачных запросов подряд увеличивать пакет
+        """
+        if not 1 <= min_size <= max_size:
+            raise ValueError('Размеры пакета должны быть 1 <= min_size <= max_size')
+
+        self.max_size = max_size
+        self.min_size = min_size
+        self.grow_after = grow_after
+        self.size = max_size
+        self._successes = 0
+
+    def success(self, batch_len: int, response_len: int) -> None:
+        """
+        Учитывает выполненный запрос
+        :param batch_len: Сколько id было в запросе
+        :param response_len: Сколько ответов вернул execute. Если меньше, чем id,
+            значит процедура не уложилась в ограничения VK и пакет нужно уменьшить
+        """
+        if response_len < batch_len:
+            self.failure(batch_len)
+            return
+
+        self._successes += 1
+        if self._successes >= self.grow_after and self.size < self.max_size:
+            self.size += 1
+            self._successes = 0
+
+    def failure(self, batch_len: int) -> None:
+        """
+        Учитывает неудачный запрос (ошибка сети, таймаут или ошибка внутри execute).
+        Пакеты, взятые до прошлого уменьшения, уже ничего не говорят о текущем размере и не учитываются,
+        иначе одна пачка одновременных ошибок сожмет пакет до минимума
+        """
+        self._successes = 0
+        if batch_len >= self.size:
+            self.size = max(self.min_size, self.size // 2)
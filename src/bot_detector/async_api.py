@@ -1,12 +1,31 @@
+import os
 import asyncio
 import aiohttp
 import datetime
 import math
-from aiohttp import ClientSession, ClientTimeout
-from statistics import fmean, median
+import time
+from aiohttp import ClientSession
+from contextlib import nullcontext
 from typing import Literal
 
+import numpy as np
+
+from src.bot_detector.adaptive_batch import AdaptiveBatchSize
 from src.bot_detector.database import DatabaseManager
+from src.bot_detector.database_writer import QueueWriter
+from src.bot_detector.features import users_features, groups_features, walls_features
+from src.bot_detector.http_session import create_session, json_loads
+from src.bot_detector.metrics import METRICS, BATCH_BUCKETS
+from src.bot_detector.rate_limiter import TokenBucket
+from src.bot_detector.token_limits import token_key
+from src.bot_detector.work_queue import WorkQueue
+
+MIN_REQUEST_INTERVAL = 0.35     # Промежуток между запросами с одного токена: лимит API 3 в секунду, плюс запас на задержки
+MAX_IN_FLIGHT = 50              # Сколько запросов одного сборщика могут одновременно ожидать ответа
+VK_API_URL = 'https://api.vk.com/method'
+FEATURES_IN_THREAD = 500       # Со скольких профилей в пачке признаки считаются в пуле потоков, а не в цикле событий
+TOO_MANY_REQUESTS = 6           # Код ошибки API "слишком много запросов в секунду"
+TOO_MANY_REQUESTS_BACKOFF = 1   # На сколько секунд придержать запросы токена после ошибки 6
 
 
 def get_current_time() -> str:
@@ -16,54 +35,91 @@ def get_current_time() -> str:
 
 
 class AIOInfoGrabber:
-    def __init__(self, users: list,
+    def __init__(self, users: list | np.ndarray,
                  data_folder: str,
                  access_token: str,
                  proxy: str = None,
                  proxy_auth: list[str, str] = None,
                  need_prints: bool = False,
-                 round_seconds: int = 120):
+                 requests_per_second: float = 1 / MIN_REQUEST_INTERVAL,
+                 max_in_flight: int = MAX_IN_FLIGHT,
+                 write_queue_size: int = 500,
+                 write_batch_size: int = 40,
+                 rate_limiter: TokenBucket | None = None,
+                 db_writer: QueueWriter | None = None,
+                 db: DatabaseManager | None = None,
+                 next_stages: list[WorkQueue] | None = None,
+                 session: ClientSession | None = None,
+                 compress: bool = True,
+                 api_url: str = VK_API_URL):
         """
         Класс, предназначенный для сбора информации о множестве пользователей за малое время
-        :param users: Список пользователей, которых нужно проверить
+        :param users: id пользователей, которых нужно проверить (список или массив int64, он не копируется)
         :param data_folder: Путь до папки, где будут храниться данные по текущему разбору (data/<название xls дока>)
         :param access_token: Токен от VK API
         :param proxy: Прокси, если есть
         :param proxy_auth: Логин и пароль для прокси, если есть
         :param need_prints: Нужны ли информационные принты
-        :param round_seconds: Раз в сколько секунд информация сохраняется на диск, стандартное значение - 120 секунд
+        :param requests_per_second: Сколько запросов в секунду можно отправлять с этим токеном
+        :param max_in_flight: Сколько запросов могут одновременно ожидать ответа от API
+        :param write_queue_size: Сколько ответов API может ждать записи в БД, после чего сборщики ждут писателя
+        :param write_batch_size: Сколько ответов из очереди записывать в БД за один раз
+        :param rate_limiter: Общий ограничитель частоты для токена, если токен используется в нескольких местах.
+            Если не указан, то создается свой по requests_per_second
+        :param db_writer: Через что записывать собранные данные, если БД пишет другой процесс.
+            Если не указан, то запись идет напрямую в БД
+        :param db: Общее соединение с БД, если несколько сборщиков работают в одном процессе.
+            Если не указано, то сборщик сам подключается к БД в data_folder
+        :param next_stages: Очереди следующих стадий сбора (группы, посты), в которые сразу после записи
+            отправляются открытые профили, собранные методом users
+        :param session: Общая сессия (пул соединений) прокси, если через него работает несколько сборщиков.
+            Если не указана, то сборщик сам создает сессию через свой прокси
+        :param compress: Просить ли API сжимать ответы (gzip, а если установлен brotli, то и br)
+        :param api_url: Адрес API, можно заменить на локальный для тестов
         """
-        self.all_users_id = sorted(list(set([int(item) for item in users])))
+        self.all_users_id = users     # Повторы уберет БД при загрузке во временную таблицу
         self.data_folder = data_folder
         self.proxy = proxy
         self.proxy_auth = proxy_auth
-        self.requests_session: ClientSession | None = None
-        self.db: DatabaseManager | None = None
+        self.requests_session: ClientSession | None = session
+        self.own_session = session is None      # Создавал ли сборщик сессию сам (тогда сам её и закрывает)
+        self.compress = compress
+        self.db: DatabaseManager | None = db
+        self.own_db = db is None    # Открывал ли сборщик соединение с БД сам (тогда сам его и закрывает)
+        self.db_writer: DatabaseManager | QueueWriter | None = db_writer
+        self.next_stages = next_stages if next_stages is not None else []
         self.need_print = need_prints
 
-        # Сколько запросов к API сделать за backup_seconds секунд
-        # Задержка ответа на запрос о пользователях - 5 секунд, группах - 4 секунды, постах - 15 секунд
-        # Оставляется 10% на погрешность
-        # Потом делим на 0.4 секунды, которые нужны чтобы API не заблокировался,
-        # Все значения для стандартного значения в 120 секунд
-        self.user_info_rounds = int((round_seconds - 5) / 1.1 / 0.4)    # 261 пакет id, по 25, всего 6 525 id
-        self.group_rounds = int((round_seconds - 4) / 1.1 / 0.4)        # 263 пакета id, по 25, всего 6 575 id
-        self.wall_rounds = int((round_seconds - 15) / 1.1 / 0.4)        # 238 покетов id, по 10, всего 2 380 id
+        # Запросы идут непрерывным потоком с частотой, которую разрешает ограничитель,
+        # и не ждут ответов на предыдущие запросы. Ответ на запрос приходит через 4-15 секунд,
+        # поэтому одновременно ожидают ответа несколько десятков запросов
+        self.rate_limiter = rate_limiter if rate_limiter is not None else TokenBucket(requests_per_second)
+        self.max_in_flight = max_in_flight
+
+        # Ответы складываются в ограниченную очередь, из которой их пачками забирает один писатель в БД
+        self.write_queue_size = write_queue_size
+        self.write_batch_size = write_batch_size
 
         # Ссылки на методы для сбора информации
-        self.users_info_url = 'https://api.vk.com/method/execute.users_info'
-        self.users_groups_url = 'https://api.vk.com/method/execute.groups_info'
-        self.users_wall_url = 'https://api.vk.com/method/execute.walls_info'
+        self.users_info_url = f'{api_url}/execute.users_info'
+        self.users_groups_url = f'{api_url}/execute.groups_info'
+        self.users_wall_url = f'{api_url}/execute.walls_info'
 
         # Данные для API
         self.access_token = access_token
         self.version = 5.199
+        self.token_label = token_key(access_token)     # Токен в метриках, сам токен туда не попадает
 
         # Достигнуты ли лимиты метода
         self.limit_reached = {'users': False,
                               'groups': False,
                               'walls': False}
 
+        # Сколько запросов выполнено по каждому методу, нужно для учета лимитов токена
+        self.requests_done = {'users': 0,
+                              'groups': 0,
+                              'walls': 0}
+
         # Если не проверили все профили, то нужен повтор
         self.need_repeat = False
 
@@ -83,464 +139,393 @@ class AIOInfoGrabber:
                                    'videos', 'video_playlists', 'clips_followers', 'gifts']
         self.close_counters_list = ['friends', 'pages', 'subscriptions', 'posts']
 
-    async def start(self, method: Literal['users', 'groups', 'walls']) -> tuple[dict[str, bool], bool]:
+    async def start(self, method: Literal['users', 'groups', 'walls'],
+                    work_queue: WorkQueue | None = None) -> tuple[dict[str, bool], bool]:
         """
         ВЫПОЛНЯТЬ С ПОМОЩЬЮ asyncio.run(AIOInfoGrabber(*).start(method))!
 
         Выполняет сбор информации по выбранному методу.
         :param method: Работают все методы, но информация для нейронки берется только из users
+        :param work_queue: Общая очередь id, если сборщик - одна из полос общего сбора.
+            Тогда сборщик забирает id из неё, пока она не опустеет, а повторным сбором занимается тот, кто её создал.
+            Если не указана, то сборщик собирает свой список пользователей, пока не соберет всех
         :return: Словарь лимитов и нужен ли повтор
         """
         if method not in ['users', 'groups', 'walls']:
             raise Exception('Некорректно указанный метод для AIOInfoGrabber(*).start(method)')
 
-        # Разные подключения
-        # Если есть прокси, то
-        proxy_auth = aiohttp.BasicAuth(self.proxy_auth[0], self.proxy_auth[1]) if self.proxy_auth is not None else None
-        self.requests_session = ClientSession(timeout=ClientTimeout(total=30), proxy=self.proxy, proxy_auth=proxy_auth)
-
-        self.db = DatabaseManager(fr'{self.data_folder}\data.db')
-        await self.db.connect()
-        await self.db.create_tables()
-
-        # Используем одну сессию для всех запросов, так как это быстрее
-        async with self.requests_session:
-            # === ПОЛЬЗОВАТЕЛИ ===
-            if method == 'users':
-                # Смотрим какие пользователи уже проверены и непроверенных проверяем
-                checked_users = await self.db.get_checked_profiles()
-                unchecked_users = sorted(list(set(self.all_users_id) - set(checked_users)))
-                if self.need_print:
-                    print(f'\tВсего: {len(self.all_users_id)}, '
-                          f'Проверенно: {len(checked_users)}, '
-                          f'Осталось: {len(unchecked_users)}')
-                while len(unchecked_users) != 0 and not self.limit_reached['users']:
-                    await self.users_info_process(unchecked_users)    # Сбор данных из сети
-                    checked_users = await self.db.get_checked_profiles()
-                    unchecked_users = sorted(list(set(self.all_users_id) - set(checked_users)))
+        if self.own_session:
+            self.requests_session = create_session(self.proxy, self.proxy_auth, self.max_in_flight, self.compress)
+
+        if self.own_db:
+            self.db = DatabaseManager(os.path.join(self.data_folder, 'data.db'))
+            await self.db.connect()
+            await self.db.create_tables()
+        if self.db_writer is None:
+            self.db_writer = self.db
+
+        methods_process = {'users': self.users_info_process, 'groups': self.groups_process, 'walls': self.posts_process}
+
+        try:
+            # Используем одну сессию для всех запросов, так как это быстрее. Общую сессию закрывает тот, кто её создал
+            async with self.requests_session if self.own_session else nullcontext():
+                # === ПОЛОСА ОБЩЕГО СБОРА ===
+                if work_queue is not None:
+                    await methods_process[method](work_queue)
+
+                # === ПОЛЬЗОВАТЕЛИ ===
+                elif method == 'users':
+                    # Смотрим какие пользователи уже проверены и непроверенных проверяем
+                    users_number = await self.db.load_input_ids(self.all_users_id)
+                    unchecked_users = await self.db.get_unchecked_profiles()
                     if self.need_print:
-                        print(f'\tВсего: {len(self.all_users_id)}, '
-                              f'Проверенно: {len(checked_users)}, '
+                        print(f'\tВсего: {users_number}, '
+                              f'Проверенно: {users_number - len(unchecked_users)}, '
                               f'Осталось: {len(unchecked_users)}')
-                if len(unchecked_users) != 0:
-                    self.need_repeat = True
-
-            # === ГРУППЫ ===
-            elif method == 'groups':
-                ids_to_groups = await self.db.get_profiles_to_group_check()
-                if self.need_print:
-                    print(f'\tПредстоит проверить группы у {len(ids_to_groups)} пользователей')
-                while len(ids_to_groups) != 0 and not self.limit_reached['groups']:
-                    await self.groups_process(ids_to_groups)
+                    while len(unchecked_users) != 0 and not self.limit_reached['users']:
+                        unchecked_before = len(unchecked_users)
+                        await self.users_info_process(WorkQueue(unchecked_users))    # Сбор данных из сети
+                        unchecked_users = await self.db.get_unchecked_profiles()
+                        if self.need_print:
+                            print(f'\tВсего: {users_number}, '
+                                  f'Проверенно: {users_number - len(unchecked_users)}, '
+                                  f'Осталось: {len(unchecked_users)}')
+                        if len(unchecked_users) == unchecked_before:
+                            break   # Круг ничего не собрал (например, нет сети), повторим на следующем круге сбора
+                    if len(unchecked_users) != 0:
+                        self.need_repeat = True
+
+                # === ГРУППЫ ===
+                elif method == 'groups':
+                    # Только профили этого сборщика (в режиме процессов - среза процесса)
+                    await self.db.load_input_ids(self.all_users_id)
                     ids_to_groups = await self.db.get_profiles_to_group_check()
                     if self.need_print:
                         print(f'\tПредстоит проверить группы у {len(ids_to_groups)} пользователей')
-                if len(ids_to_groups) != 0:
-                    self.need_repeat = True
-
-            # === ПОСТЫ ===
-            elif method == 'walls':
-                ids_to_posts = await self.db.get_profiles_to_wall_check()
-                if self.need_print:
-                    print(f'\tПредстоит проверить посты у {len(ids_to_posts)} пользователей')
-                while len(ids_to_posts) != 0 and not self.limit_reached['walls']:
-                    await self.posts_process(ids_to_posts)
+                    while len(ids_to_groups) != 0 and not self.limit_reached['groups']:
+                        unchecked_before = len(ids_to_groups)
+                        await self.groups_process(WorkQueue(ids_to_groups))
+                        ids_to_groups = await self.db.get_profiles_to_group_check()
+                        if self.need_print:
+                            print(f'\tПредстоит проверить группы у {len(ids_to_groups)} пользователей')
+                        if len(ids_to_groups) == unchecked_before:
+                            break
+                    if len(ids_to_groups) != 0:
+                        self.need_repeat = True
+
+                # === ПОСТЫ ===
+                elif method == 'walls':
+                    await self.db.load_input_ids(self.all_users_id)
                     ids_to_posts = await self.db.get_profiles_to_wall_check()
                     if self.need_print:
                         print(f'\tПредстоит проверить посты у {len(ids_to_posts)} пользователей')
-                if len(ids_to_posts) != 0:
-                    self.need_repeat = True
-
-        await self.db.close()
+                    while len(ids_to_posts) != 0 and not self.limit_reached['walls']:
+                        unchecked_before = len(ids_to_posts)
+                        await self.posts_process(WorkQueue(ids_to_posts))
+                        ids_to_posts = await self.db.get_profiles_to_wall_check()
+                        if self.need_print:
+                            print(f'\tПредстоит проверить посты у {len(ids_to_posts)} пользователей')
+                        if len(ids_to_posts) == unchecked_before:
+                            break
+                    if len(ids_to_posts) != 0:
+                        self.need_repeat = True
+        finally:
+            # Свою БД закрываем и при ошибке: иначе поток её соединения не даст процессу сбора завершиться
+            if self.own_db:
+                await self.db.close()
 
         # Возврааем словарь достигнутых лимитов и нужно ли повторение
         return self.limit_reached, self.need_repeat
 
     # ========== ПРОЦЕССЫ ДЛЯ ОБРАБОТКИ API ==========
-    async def users_info_process(self, users_id):
-        """Разбитие на раунды сохранения и выполнение сбора информации по пользователям"""
-        start_event = asyncio.Event()
-        start_event.set()
-
-        # Собираем раунды со списками id пользователей (по 25 id в раунде)
-        users_id_str = [str(item) for item in users_id]     # Т.к. все id хранятся в int - преобразуем в str
-        id_rounds_to_info = [','.join(round_ids) for round_ids in self.list_split(users_id_str, 25)]
-        info_rounds = self.list_split(id_rounds_to_info, self.user_info_rounds)  # И разбиваем по раундам сохранения
-        if self.need_print:
-            print(f'\t[{get_current_time()}] Всего раундов: {len(info_rounds)}')
-
-        # Проходимся по всем раундам с id (примерно по 2 минуты на раунд)
-        for round_ids in info_rounds:
-            # Если API больше не отвечает на метод, то заканчиваем
-            if self.limit_reached['users']:
-                if self.need_print:
-                    print(f'\t[{get_current_time()}][ERROR] Достигнут лимит метода users!')
-                break
-
-            if self.need_print:
-                print(f'\t[{get_current_time()}] Начинается раунд {info_rounds.index(round_ids) + 1}')
-
-            # Подготавливаем задачи, в которых будут крутиться потоки со сбором информации
-            events = [asyncio.Event() for _ in range(len(round_ids))]  # Создаем события для каждого потока
-            # Создаем задачи для каждого потока
-            tasks = [asyncio.create_task(self.users_info_request(round_ids[0], start_event, events[0]))]
-            for i in range(1, len(round_ids)):
-                tasks.append(asyncio.create_task(self.users_info_request(round_ids[i], events[i - 1], events[i])))
-
-            # Запускаем задачи и ждем их завершения
-            results = await asyncio.gather(*tasks)
-
-            # Сохраняем результаты
-            save_tasks = []
-            for item in results:
-                if 'execute_errors' in item:
-                    self.need_repeat = True     # Если API вернул ошибку, то нужно будет снова собрать информацию
-                    limit_reached_here = False
-                    # Если есть ошибка 29, то запрещаем ключу дальнейшее взаимодействие с методом
-                    for error in item['execute_errors']:
-                        if error['error_code'] == 29:
-                            limit_reached_here = True
-                            self.limit_reached['groups'] = True
-                    if limit_reached_here:  # Если это была ошибка 29, то переходим к следующему ответу
-                        continue
-                if 'response' in item:
-                    save_tasks.append(asyncio.create_task(self.write_users_info(item['response'])))
-            await asyncio.gather(*save_tasks)
+    async def users_info_process(self, work_queue: WorkQueue):
+        """Сбор информации по пользователям (до 25 id в запросе)"""
+        await self.collect('users', work_queue, 25, self.users_info_request, self.write_users_info)
 
         # Иногда БД капризничает и не записывает некоторые профили в таблички, так что перепроверяем.
         # (Это было один раз и я не уверен с чем это было связано, но на всякий случай оставлю)
-        # Собираем из БД информацию по закрытым и открытым профилям
-        close_profiles, close_info, open_profiles, open_info = await self.db.get_all_profiles_info()
-
-        # Если профиль есть в списке профилей, но по неу нет информации, то его нужно перепроверить
-        to_recheck = sorted(list(set(close_profiles) - set(close_info)) + list(set(open_profiles) - set(open_info)))
+        # Если профиль есть в списке профилей, но по нему нет информации, то его нужно перепроверить
+        to_recheck = await self.db.get_profiles_to_recheck()
 
         # Если такие профили есть, то удаляем их, чтобы на следующем круге перепроверить
         if len(to_recheck) > 0:
             self.need_repeat = True
             # print(f'\t[{get_current_time()}] Нужно перепроверить {len(to_recheck)} профилей')
-        for item in to_recheck:
-            await self.db.remove_from_all_tables(int(item))
-        await self.db.save_db()
+            await self.db_writer.save_collected_batch(to_remove=to_recheck)
+            await self.db_writer.flush()
 
-    async def groups_process(self, users_id):
-        """Разбитие на раунды сохранения и выполнение сбора информации по группам пользователей"""
-        start_event = asyncio.Event()
-        start_event.set()
+    async def groups_process(self, work_queue: WorkQueue):
+        """Сбор информации по группам пользователей (до 25 id в запросе)"""
+        await self.collect('groups', work_queue, 25, self.groups_request, self.write_groups)
 
-        # Собираем раунды со списками id пользователей
-        users_id_str = [str(item) for item in users_id]
-        id_rounds_to_info = [','.join(round_ids) for round_ids in self.list_split(users_id_str, 25)]
-        rounds = self.list_split(id_rounds_to_info, self.group_rounds)  # И разбиваем по раундам сохранения
+    async def posts_process(self, work_queue: WorkQueue):
+        """Сбор информации по постам пользователей (до 10 id в запросе)"""
+        await self.collect('walls', work_queue, 10, self.walls_request, self.write_posts)
 
-        if self.need_print:
-            print(f'\t[{get_current_time()}] Всего раундов {len(rounds)}')
-
-        for round_ids in rounds:  # Примерно по две минуты на раунд
-            if self.limit_reached['groups']:
-                if self.need_print:
-                    print(f'\t[{get_current_time()}][ERROR] Достигнут лимит метода groups!')
-                break
-
-            if self.need_print:
-                print(f'\t[{get_current_time()}] Начинается раунд {rounds.index(round_ids) + 1}')
-
-            events = [asyncio.Event() for _ in range(len(round_ids))]  # Создаем события для каждого потока
-            # Создаем задачи для каждого потока
-            tasks = [asyncio.create_task(self.groups_request(round_ids[0], start_event, events[0]))]
-            for i in range(1, len(round_ids)):
-                tasks.append(asyncio.create_task(self.groups_request(round_ids[i], events[i - 1], events[i])))
-
-            # Запускаем задачи
-            results = await asyncio.gather(*tasks)
-
-            # Сохраняем результаты
-            save_tasks = []
-            for item in results:
-                if 'execute_errors' in item:
-                    self.need_repeat = True
-                    limit_reached_here = False
-                    # Если есть ошибка 29, то запрещаем ключу дальнейшее взаимодействие с методом
-                    for error in item['execute_errors']:
-                        if error['error_code'] == 29:
-                            limit_reached_here = True
-                            self.limit_reached['groups'] = True
-                    if limit_reached_here:  # Если это была ошибка 29, то переходим к следующему ответу
-                        continue
-                if 'response' in item:
-                    save_tasks.append(asyncio.create_task(self.write_groups(item['response'])))
-            await asyncio.gather(*save_tasks)
-
-    async def posts_process(self, users_id):
-        """Разбитие на раунды сохранения и выполнение сбора информации по постам пользователей"""
-        start_event = asyncio.Event()
-        start_event.set()
-
-        # Собираем раунды со списками id пользователей
-        users_id_str = [str(item) for item in users_id]
-        id_rounds_to_info = [','.join(round_ids) for round_ids in self.list_split(users_id_str, 10)]
-        rounds = self.list_split(id_rounds_to_info, self.wall_rounds)  # И разбиваем по раундам сохранения\
+    async def collect(self, method: Literal['users', 'groups', 'walls'], work_queue: WorkQueue, ids_in_request: int,
+                      request_func, write_func) -> None:
+        """
+        Непрерывный сбор информации по выбранному методу.
+        Сборщики забирают пакеты id из очереди работы (она может быть общей с другими полосами) и отправляют
+        запросы, как только это позволит ограничитель частоты, не дожидаясь ответов на предыдущие запросы.
+        Несобранный пакет сразу возвращается в очередь работы, а ответы складываются в ограниченную очередь записи.
+        Из неё их пачками забирает один писатель, так что сеть и диск работают одновременно,
+        а в памяти лежит не больше write_queue_size ответов.
+        Если писатель не успевает, то очередь заполняется и сборщики ждут, пока в ней появится место.
+        Размер пакета id подстраивается под ответы API (AdaptiveBatchSize): уменьшается при ошибках
+        и обрезанных ответах и снова растет, пока запросы проходят.
+        Ошибка 6 (слишком частые запросы) говорит о частоте, а не о размере пакета: меньший пакет только
+        добавил бы запросов, поэтому вместо этого запросы токена придерживаются в ограничителе частоты
+        :param method: Метод сбора, нужен для отметки о достижении лимита
+        :param work_queue: Очередь с id пользователей
+        :param ids_in_request: Максимум id в одном запросе
+        :param request_func: Функция запроса к API
+        :param write_func: Функция записи списка ответов в БД
+        """
+        write_queue = asyncio.Queue(maxsize=self.write_queue_size)
+        batch_size = AdaptiveBatchSize(ids_in_request)
+        done_requests = 0
 
         if self.need_print:
-            print(f'\t[{get_current_time()}] Всего раундов {len(rounds)}')
-
-        for round_ids in rounds:  # Примерно по две минуты на раунд
-            if self.limit_reached['walls']:
-                if self.need_print:
-                    print(f'\t[{get_current_time()}][ERROR] Достигнут лимит метода walls!')
-                break
-
-            if self.need_print:
-                print(f'\t[{get_current_time()}] Начинается раунд {rounds.index(round_ids) + 1}')
-
-            events = [asyncio.Event() for _ in range(len(round_ids))]  # Создаем события для каждого потока
-            # Создаем задачи для каждого потока
-            tasks = [asyncio.create_task(self.walls_request(round_ids[0], start_event, events[0]))]
-            for i in range(1, len(round_ids)):
-                tasks.append(asyncio.create_task(self.walls_request(round_ids[i], events[i - 1], events[i])))
-
-            # Запускаем задачи
-            results = await asyncio.gather(*tasks)
-
-            # Сохраняем результаты
-            save_tasks = []
-            for item in results:
-                if 'execute_errors' in item:
-                    self.need_repeat = True
-                    limit_reached_here = False
-                    # Если есть ошибка 29, то запрещаем ключу дальнейшее взаимодействие с методом
-                    for error in item['execute_errors']:
-                        if error['error_code'] == 29:
-                            limit_reached_here = True
-                            self.limit_reached['walls'] = True
-                    if limit_reached_here:  # Если это была ошибка 29, то переходим к следующему ответу
-                        continue
-                if 'response' in item:
-                    save_tasks.append(asyncio.create_task(self.write_posts(item['response'])))
-            await asyncio.gather(*save_tasks)
+            print(f'\t[{get_current_time()}] Всего запросов: {math.ceil(len(work_queue) / ids_in_request)}')
+
+        async def fetcher():
+            nonlocal done_requests
+            # Если API больше не отвечает на метод, то заканчиваем
+            while not self.limit_reached[method]:
+                # Сначала ждем разрешения на запрос и только потом берем пакет: иначе каждый сборщик держал бы
+                # взятый пакет, пока стоит в очереди ограничителя, и не давал забрать его свободным полосам
+                await self.rate_limiter.acquire()
+                if self.limit_reached[method]:
+                    self.rate_limiter.release()
+                    return
+                ids = await work_queue.take(batch_size.size)
+                if len(ids) == 0:
+                    self.rate_limiter.release()
+                    return
+
+                try:
+                    METRICS.inc('requests_total', method=method, token=self.token_label)
+                    METRICS.observe('batch_size', len(ids), buckets=BATCH_BUCKETS, method=method)
+                    request_start = time.perf_counter()
+                    result = await request_func(','.join([str(item) for item in ids]))
+                    METRICS.observe('response_seconds', time.perf_counter() - request_start, method=method)
+                except (aiohttp.ClientError, asyncio.TimeoutError):
+                    # Пакет не собран, возвращаем его в очередь - его сразу заберет другой сборщик
+                    METRICS.inc('api_errors_total', method=method, token=self.token_label, code='network')
+                    batch_size.failure(len(ids))
+                    await work_queue.give_back(ids)
+                    continue
+                except BaseException:
+                    await work_queue.give_back(ids)
+                    raise
+
+                response = self.check_response(method, result)
+                too_many_requests = self.is_too_many_requests(result)
+                if too_many_requests:
+                    self.rate_limiter.backoff(TOO_MANY_REQUESTS_BACKOFF)
+
+                if response is None:
+                    # Запрос не выполнился или токен уперся в лимит, пакет забирает другой сборщик или полоса
+                    if not self.limit_reached[method] and not too_many_requests:
+                        batch_size.failure(len(ids))
+                    await work_queue.give_back(ids)
+                    continue
+
+                if 'execute_errors' in result:
+                    if not too_many_requests:
+                        batch_size.failure(len(ids))
+                else:
+                    batch_size.success(len(ids), len(response))
+                self.requests_done[method] += 1
+
+                await write_queue.put(response)     # Если очередь заполнена, то ждем писателя
+                await work_queue.done(ids)
+                METRICS.inc('profiles_collected_total', len(ids), method=method)
+                METRICS.set('work_queue_depth', len(work_queue), method=method)
+                METRICS.set('write_queue_depth', write_queue.qsize(), method=method, token=self.token_label)
+
+                done_requests += 1
+                if self.need_print and done_requests % 250 == 0:
+                    print(f'\t[{get_current_time()}] Выполнено запросов: {done_requests}, '
+                          f'осталось собрать id: {len(work_queue)}')
+
+        async def fetch_all():
+            await asyncio.gather(*[fetcher() for _ in range(self.max_in_flight)])
+            await write_queue.put(None)     # Сообщаем писателю, что больше ответов не будет
+
+        fetch_task = asyncio.create_task(fetch_all())
+        writer_task = asyncio.create_task(self.writer(write_queue, write_func))
+
+        try:
+            await asyncio.gather(fetch_task, writer_task)
+        except BaseException:
+            # Если одна из сторон упала, то другая повиснет на очереди, поэтому останавливаем обе
+            fetch_task.cancel()
+            writer_task.cancel()
+            raise
+        await self.db_writer.flush()   # Дальше будем читать из БД, так что все собранное должно быть в ней
+
+        if self.limit_reached[method] and self.need_print:
+            print(f'\t[{get_current_time()}][ERROR] Достигнут лимит метода {method}!')
+
+    async def writer(self, write_queue: asyncio.Queue, write_func) -> None:
+        """
+        Забирает ответы из очереди и пачками по write_batch_size ответов передает их на запись в БД.
+        Заканчивает работу, когда получает из очереди None
+        """
+        while True:
+            batch = [await write_queue.get()]
+            # Добираем то, что уже лежит в очереди, не дожидаясь новых ответов
+            while len(batch) < self.write_batch_size and not write_queue.empty():
+                batch.append(write_queue.get_nowait())
+
+            finished = batch[-1] is None
+            results = [item for response in batch if response is not None for item in response]
+            if len(results) != 0:
+                await write_func(results)
+            if finished:
+                return
 
     @staticmethod
-    def list_split(data_list: list, items_in_round: int):
-        """Разделение списка на подсписки с items_in_round кол-вом элементов в каждом"""
-        rounds = []
-        for i in range(math.ceil(len(data_list) / items_in_round)):
-            rounds.append(data_list[i * items_in_round: i * items_in_round + items_in_round])
-        return rounds
+    def is_too_many_requests(result: dict) -> bool:
+        """Есть ли в ответе ошибка 6 (слишком много запросов в секунду), в самом запросе или внутри execute"""
+        if 'error' in result:
+            return result['error'].get('error_code') == TOO_MANY_REQUESTS
+        return any(error.get('error_code') == TOO_MANY_REQUESTS for error in result.get('execute_errors', []))
+
+    def check_response(self, method: str, result: dict) -> list | None:
+        """
+        Разбирает ответ API: отмечает ошибки и лимиты
+        :return: Данные из ответа для записи в БД или None, если запрос не выполнился и пакет нужно собрать заново
+        """
+        if 'error' in result:
+            # Запрос целиком не выполнился (например, слишком частые запросы)
+            METRICS.inc('api_errors_total', method=method, token=self.token_label,
+                        code=str(result['error'].get('error_code')))
+            if result['error'].get('error_code') == 29:
+                self.limit_reached[method] = True
+            return None
+
+        if 'execute_errors' in result:
+            for error in result['execute_errors']:
+                METRICS.inc('api_errors_total', method=method, token=self.token_label, code=str(error['error_code']))
+            # Если есть ошибка 29, то запрещаем ключу дальнейшее взаимодействие с методом
+            if any(error['error_code'] == 29 for error in result['execute_errors']):
+                self.limit_reached[method] = True
+                return None
+            self.need_repeat = True     # Если API вернул ошибку, то нужно будет снова собрать информацию
+
+        if isinstance(result.get('response'), list):
+            return result['response']
+        return None
 
     # ========== ЗАПРОСЫ К API ==========
-    async def users_info_request(self, users: str, wait_event: asyncio.Event, my_event: asyncio.Event):
+    async def users_info_request(self, users: str):
         """
         Запрос данных о пользователях через специальный метод API приложения
         :param users: Строка с id пользователей через запятую, НЕ БОЛЬШЕ 25!
-        :param wait_event: Событие, которого ждет процедура, чтобы отправить запрос.
-        :param my_event: Событие, в котором процедура сообщает, что запрос отправлен.
         :return: Словарь с ответами от API
         """
-        await wait_event.wait()     # Ожидание своей очереди на отправку запроса
-        await asyncio.sleep(0.4)    # Ждем минимум 0.34 секунды, чтобы API не выдал ошибку о слишком частых запросах
-        my_event.set()              # Говорим следующему в очереди потоку начинать считать свои 0.34 секунды
         params = {'users_id': users, 'fields': self.fields_str, 'access_token': self.access_token, 'v': self.version}
 
-        # Отправляем запрос к API и ждем ответа
-        async with self.requests_session.post(url=self.users_info_url, params=params) as response:
-            translate_json = await response.json()  # Преобразуем ответ в понятный словарь
+        # Отправляем запрос к API и ждем ответа. Параметры (в том числе токен и длинный список id)
+        # идут в теле запроса как форма, а не в адресе
+        async with self.requests_session.post(url=self.users_info_url, data=params) as response:
+            translate_json = await response.json(loads=json_loads)  # Преобразуем ответ в понятный словарь
             return translate_json
 
-    async def groups_request(self, users: str, wait_event: asyncio.Event, my_event: asyncio.Event):
+    async def groups_request(self, users: str):
         """
         Запрос данных о группах пользователей через специальный метод API приложения
         :param users: Строка с id пользователей через запятую, НЕ БОЛЬШЕ 25!
-        :param wait_event: Событие, которого ждет процедура, чтобы отправить запрос.
-        :param my_event: Событие, в котором процедура сообщает, что запрос отправлен.
         :return: Словарь с ответами от API
         """
-        await wait_event.wait()
-        await asyncio.sleep(0.4)
-        my_event.set()
         params = {'users_id': users, 'access_token': self.access_token, 'v': self.version}
-        async with self.requests_session.post(url=self.users_groups_url, params=params) as response:
-            translate_json = await response.json()
+        async with self.requests_session.post(url=self.users_groups_url, data=params) as response:
+            translate_json = await response.json(loads=json_loads)
             return translate_json
 
-    async def walls_request(self, users: str, wait_event: asyncio.Event, my_event: asyncio.Event):
+    async def walls_request(self, users: str):
         """
         Запрос данных о постах пользователей через специальный метод API приложения
         :param users: Строка с id пользователей через запятую, НЕ БОЛЬШЕ 10!
-        :param wait_event: Событие, которого ждет процедура, чтобы отправить запрос.
-        :param my_event: Событие, в котором процедура сообщает, что запрос отправлен.
         :return: Словарь с ответами от API
         """
-        await wait_event.wait()
-        await asyncio.sleep(0.4)
-        my_event.set()
         params = {'users_id': users, 'access_token': self.access_token, 'v': self.version}
-        async with self.requests_session.post(url=self.users_wall_url, params=params) as response:
-            translate_json = await response.json()
+        async with self.requests_session.post(url=self.users_wall_url, data=params) as response:
+            translate_json = await response.json(loads=json_loads)
             return translate_json
 
     # ========== УПОРЯДОЧИВАНИЕ ДАННЫХ ДЛЯ БД ==========
     @staticmethod
-    async def user_data_analyse(user_dict: dict, fillers_list: list, counters_list: list) -> tuple:
+    async def featurize(features_func, items: list, *args) -> list:
         """
-        Анализ данных профиля пользователя
-        :param user_dict: JSON информация о пользователе
-        :param fillers_list: Список заполнителей (поля у которых нет четкой структуры (например - статус))
-        :param counters_list: Список счетчиков
-        :return: Кортеж для записи в БД
+        Считает признаки сразу для всех профилей из пачки ответов (см. features.py).
+        Небольшие пачки считаются сразу, а большие - в пуле потоков, чтобы разбор не занимал цикл событий
+        надолго и сборщики продолжали отправлять запросы в своем темпе
+        :param features_func: Функция признаков: users_features, groups_features или walls_features
+        :param items: Профили из ответов API
+        :return: Строки для записи в БД
         """
-        rule = [None, '', [], 0]  # Правила, по которым считается, что параметра у пользователя нет
-
-        # === ЗАПОЛНИТЕЛИ ===
-        # Смотрим какие заполнители вообще есть
-        profile_fillers = [0 if user_dict.get(filler) in rule else 1 for filler in fillers_list]
-
-        # Отдельно смотрим наличие screen_name у пользователя, ставим 0 если он стандартный и не менялся
-        profile_fillers.append(0 if user_dict['screen_name'] == 'id' + str(user_dict['id']) else 1)
-        profile_fullness = sum(profile_fillers) / len(profile_fillers)  # Насколько заполнен профиль
-
-        # === СЧЕТЧКИК ===
-        # Смотрим, какие вообще счетчики есть
-        if user_dict.get('counters') is not None:   # У некоторых профилей вообще нет счетчиков, как так - без понятия
-            # Если ли данный счетчик
-            haves_counter_list = [0 if user_dict['counters'].get(counter) in rule else 1 for counter in counters_list]
-            # И значение счетчика
-            profile_counter_list = [user_dict['counters'].get(counter, 0) for counter in counters_list]
-        else:
-            # Если счетчиков у профиля нет, то везде 0
-            haves_counter_list = [0 for _ in counters_list]
-            profile_counter_list = [0 for _ in counters_list]
-
-        # Объединяем в структуру типа [есть ли счетчик1, сам счетчик1, есть ли счетчик2, сам счетчик2, ...]
-        profile_counters = [item for pair in zip(haves_counter_list, profile_counter_list) for item in pair]
-        counters_fullness = sum(haves_counter_list) / len(haves_counter_list)  # На сколько заполнены счетчики
-
-        # Собираем всё в единый кортеж, главное - сохранить порядок
-        save_values = [user_dict['id']]
-        save_values.extend(profile_fillers)
-        save_values.extend([profile_fullness])
-        save_values.extend(profile_counters)
-        save_values.extend([counters_fullness])
-        return tuple(save_values)
-
-    @staticmethod
-    async def group_data_analyse(user_dict: list):
-        """Анализ данных групп профиля"""
-        items = user_dict[1]
-        without_photo = 0
-        closed_groups = 0
-        type_page = 0
-        type_group = 0
-        for item in items['items']:
-            without_photo += item.get('has_photo', 0)
-            closed_groups += item['is_closed']
-            if item['type'] == 'group':
-                type_group += 1
-            elif item['type'] == 'page':
-                type_page += 1
-
-        save_values = [int(user_dict[0]), items['count'], without_photo, closed_groups, type_page, type_group]
-        return save_values
-
-    @staticmethod
-    async def wall_data_analyse(user_dict: list):
-        """Анализ данных со стены профиля"""
-        items = user_dict[1]
-        posts = 0                   # Кол-во постов
-        reposts = 0                 # Кол-во репостов
-        max_id = items['count']     # Максимальный id с удаленными
-        comments_counter = []       # Кол-во комментариев под всеми постами
-        likes_counter = []          # Кол-во лайков под всеми постами
-        views_counter = []          # Кол-во просмотров под всеми постами
-        reposts_counter = []        # Кол-во репостов под всеми постами
-        posts_with_text = 0         # Кол-во постов с текстом
-
-        # Кол-во постов в ответе (если их всего больше 100, то и здесь обычно 100)
-        posts_in_response = len(items['items']) if len(items['items']) != 0 else 1
-
-        for item in items['items']:
-            # Проходимся по всем постам и забираем разную статистику
-            max_id = max(item['id'], max_id)    # Смотрим есть ли удаленные посты
-            if 'copy_history' in item:          # Определяем репост это или нет
-                reposts += 1
-            else:
-                posts += 1
-
-            if 'comments' in item:
-                comments_counter.append(item['comments']['count'])  # Смотрим сколько комментариев
-            if 'likes' in item:
-                likes_counter.append(item['likes']['count'])        # Смотрим сколько лайков
-            if 'views' in item:
-                views_counter.append(item['views']['count'])        # Смотрим сколько просмотров (не всегда есть)
-            if 'reposts' in item:
-                reposts_counter.append(item['reposts']['count'])    # Смотрим сколько репостов
-            if item['text'].strip() != '':                          # И смотрим есть ли текст в посте
-                posts_with_text += 1
-
-        def mmmm(counter: list):
-            """min, max, mean, median"""
-            if len(counter) == 0:
-                return [0, 0, 0, 0]
-            else:
-                return [min(counter), max(counter), fmean(counter), median(counter)]
-
-        # Складываем все в правильном порядке
-        save_values = [int(user_dict[0]), items['count'], posts/posts_in_response, reposts/posts_in_response, max_id]
-        save_values.extend(mmmm(comments_counter))
-        save_values.extend(mmmm(likes_counter))
-        save_values.extend(mmmm(views_counter))
-        save_values.extend(mmmm(reposts_counter))
-        save_values.append(posts_with_text/posts_in_response)
-        return save_values
+        if len(items) < FEATURES_IN_THREAD:
+            return features_func(items, *args)
+        return await asyncio.get_running_loop().run_in_executor(None, features_func, items, *args)
 
     # ========== ЗАПИСЬ ДАННЫХ В БД ==========
     async def write_users_info(self, results: list) -> None:
-        """Сохраняет данные по пользователям в БД"""
+        """Сохраняет пачку данных по пользователям в БД одной транзакцией"""
+        users_rows, open_users, close_users = [], [], []
         for item in results:
-            # Записываем общую информацию о профиле (его id, удален ли, закрыт ли)
-            await self.db.save_user_result(item)
+            # Общая информация о профиле (его id, удален ли, закрыт ли)
+            users_rows.append((item['id'],
+                               0 if item.get('deactivated') is None else 1,
+                               1 if item['is_closed'] else 0))
 
-            # Если профиль не удален и открыт, то упорядочиваем данные как для открытого профиля
+            # Если профиль не удален, то упорядочиваем данные как для открытого или закрытого профиля
             if item.get('deactivated') is None and not item['is_closed']:
-                save_values = await self.user_data_analyse(item, self.open_fillers_list, self.open_counters_list)
-                await self.db.save_open_profile_data(save_values)        # Записываем конкретно для открытого
-
-            # Если профиль не удален, но закрыт, то упорядочиваем данные как для закрытого профиля
+                open_users.append(item)
             elif item.get('deactivated') is None and item['is_closed']:
-                save_values = await self.user_data_analyse(item, self.close_fillers_list, self.close_counters_list)
-                await self.db.save_close_profile_data(save_values)       # Записываем конкретно для закрытого
+                close_users.append(item)
+
+        open_rows = await self.featurize(users_features, open_users, self.open_fillers_list, self.open_counters_list)
+        close_rows = await self.featurize(users_features, close_users, self.close_fillers_list,
+                                          self.close_counters_list)
+        open_ids = [item['id'] for item in open_users]
 
-            # Сохраняем БД только сейчас, чтобы при ошибке запись об этом профиле полностью отсутствовала
-            # Это позволит легко найти непроверенные или профили с ошибкой
-            # + немного оптимизации, так как это одно сохранение вместо двух
-            await self.db.save_db()
+        # Сохраняем всю пачку одной транзакцией, чтобы при ошибке записи об этих профилях полностью отсутствовали
+        # Это позволит легко найти непроверенные или профили с ошибкой
+        await self.db_writer.save_collected_batch(users=users_rows, open_profiles=open_rows, close_profiles=close_rows)
+
+        # Группы и посты есть смысл собирать только у открытых профилей, и только когда они уже есть в БД
+        for next_stage in self.next_stages:
+            await next_stage.add(open_ids)
 
     async def write_groups(self, results: list):
-        """Сохраняет данные об группах пользователей в БД"""
+        """
+        Сохраняет пачку данных о группах пользователей в БД одной транзакцией.
+        Если VK не отдал группы профиля (False, например, группы скрыты), то профиль отмечается проверенным
+        с пустыми признаками: повторный сбор получил бы то же самое, и сбор бы не заканчивался
+        """
+        groups, hidden_rows = [], []
         for item in results:
             if item[1] is False:
-                await self.db.remove_from_all_tables(int(item[0]))
-                self.need_repeat = True
-                # print(int(item[0]))
-                # print(item)
+                hidden_rows.append([int(item[0])] + [None] * 5)
             else:
-                await self.db.update_user_group(item)
-                save_values = await self.group_data_analyse(item)
-                await self.db.save_group_data(save_values)
-            await self.db.save_db()
+                groups.append(item)
+        groups_rows = await self.featurize(groups_features, groups)
+        await self.db_writer.save_collected_batch(groups=groups_rows + hidden_rows)
 
     async def write_posts(self, results: list):
-        """Сохраняет данные об постах пользователей в БД"""
+        """Сохраняет пачку данных о постах пользователей в БД одной транзакцией (скрытые стены - как в write_groups)"""
+        walls, hidden_rows = [], []
         for item in results:
             if item[1] is False:
-                await self.db.remove_from_all_tables(int(item[0]))
-                self.need_repeat = True
-                # print(int(item[0]))
-                # print(item)
+                hidden_rows.append([int(item[0])] + [None] * 21)
             else:
-                await self.db.update_user_wall(item)
-                save_values = await self.wall_data_analyse(item)
-                await self.db.save_wall_data(save_values)
-            await self.db.save_db()
+                walls.append(item)
+        walls_rows = await self.featurize(walls_features, walls)
+        await self.db_writer.save_collected_batch(walls=walls_rows + hidden_rows)
 
 
 def main():
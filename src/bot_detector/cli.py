@@ -4,10 +4,14 @@ import argparse
 
 from src.bot_detector.config_manager import TokenManager, ProxyManager
 from src.bot_detector.file_parser import txt_parser, xlsx_parser
-from src.bot_detector.data_collector import take_data
+from src.bot_detector.data_collector import take_data, CACHE_TTL_DAYS, CACHE_MAX_PROFILES, STAGES
 from src.bot_detector.data_analysis import start_analyse
 from src.bot_detector.paths import DATA_DIR
 from src.bot_detector.file_builder import create_statistic_file, create_output_file
+from src.bot_detector.metrics import MetricsExporter, profile_stage, PROFILERS
+from src.bot_detector.numpy_models import PARITY_TOLERANCE
+
+PROFILE_STAGES = ['collect', 'analyse', 'output']   # Этапы команды analyse, которые можно профилировать
 
 
 def red(text: str):
@@ -36,12 +40,61 @@ def parsing_arguments(args) -> tuple[argparse.ArgumentParser, argparse.Namespace
                                      'прокси (игнорируется если нет прокси).')
     parser_analyse.add_argument('-s', '--statistic', action='store_true',
                                 help='Помещает в папку с выходным файлом .txt файл со статистикой по ботам')
+    parser_analyse.add_argument('--thresholds', type=str, default='0.5',
+                                help='Пороги вероятности для статистики (-s), с которых профиль считается ботом. '
+                                     'Если их несколько, то писать через запятую без пробелов: 0.5,0.8,0.9 '
+                                     '(первый - основной, по умолчанию 0.5).')
     parser_analyse.add_argument('-c', '--columns', type=str,
                                 help='Только для .xlsx файлов! Нужно указать индексы колонок, в которых лежат '
                                      'id профилей (отсчет индексов идет от нуля). '
                                      'Если их несколько, то писать через запятую без пробелов: 0,1,2')
     parser_analyse.add_argument('-t', '--titled', action='store_true',
                                 help='Только для .xlsx файлов! Указать, если внутри файла есть заголовки.')
+    parser_analyse.add_argument('-p', '--processes', action='store_true',
+                                help='Запускать отдельный процесс на каждый токен (по умолчанию все токены '
+                                     'работают в одном процессе, что экономит память).')
+    parser_analyse.add_argument('-b', '--backend', type=str, choices=['torch', 'numpy'], default='torch',
+                                help='На чем считать нейросеть: torch (по умолчанию) или numpy - не загружает '
+                                     'PyTorch, но нужны веса, выгруженные командой "model export".')
+    parser_analyse.add_argument('--batch-size', type=int, default=1000,
+                                help='Сколько профилей за раз проходит через нейросеть (по умолчанию 1000).')
+    parser_analyse.add_argument('-r', '--reanalyse', action='store_true',
+                                help='Заново прогнать через нейросеть все профили (по умолчанию только те, '
+                                     'у которых еще нет результата или он посчитан другой версией модели).')
+    parser_analyse.add_argument('--cache-ttl', type=float, default=CACHE_TTL_DAYS,
+                                help=f'Сколько дней профиль из общего кэша профилей считается актуальным и не '
+                                     f'собирается заново (по умолчанию {CACHE_TTL_DAYS}, 0 - не использовать кэш).')
+    parser_analyse.add_argument('--cache-size', type=int, default=CACHE_MAX_PROFILES,
+                                help=f'Сколько профилей максимум хранить в общем кэше, самые старые удаляются '
+                                     f'(по умолчанию {CACHE_MAX_PROFILES}).')
+    parser_analyse.add_argument('--stages', type=str, default='users',
+                                help='Какие стадии сбора запускать: users (по умолчанию, только она нужна для '
+                                     'анализа), groups, walls. Если их несколько, то писать через запятую без '
+                                     'пробелов: users,groups,walls. Группы и посты собираются только у открытых '
+                                     'профилей, одновременно со сбором users.')
+    parser_analyse.add_argument('--format', type=str, choices=['xlsx', 'csv', 'parquet'], default='xlsx',
+                                help='Формат выходного файла: xlsx (по умолчанию, листы больше ~1 млн строк '
+                                     'делятся на несколько), csv или parquet (нужен пакет pyarrow).')
+    parser_analyse.add_argument('--feature-store', action='store_true',
+                                help='Хранить признаки профилей еще и в колоночном хранилище (.npy рядом с БД) '
+                                     'и читать их для нейросети оттуда одним последовательным проходом, '
+                                     'а не из таблиц БД. Ускоряет анализ больших списков.')
+    parser_analyse.add_argument('--metrics-log', type=str,
+                                help='Файл, в который во время сбора периодически дописываются метрики '
+                                     '(JSON lines: запросы, ошибки API по токенам, задержки, очереди, запись в БД).')
+    parser_analyse.add_argument('--metrics-snapshot', type=str,
+                                help='Файл, в котором во время сбора всегда лежит последний снимок метрик (JSON).')
+    parser_analyse.add_argument('--metrics-port', type=int,
+                                help='Отдавать метрики сбора в формате Prometheus на http://127.0.0.1:порт/metrics.')
+    parser_analyse.add_argument('--metrics-interval', type=float, default=10,
+                                help='Как часто выгружать метрики в файлы, сек (по умолчанию 10).')
+    parser_analyse.add_argument('--profile', type=str,
+                                help=f'Профилировать этапы: {", ".join(PROFILE_STAGES)}. Если их несколько, то '
+                                     f'писать через запятую без пробелов. Профили (.prof, формат pstats) '
+                                     f'сохраняются в папку с БД.')
+    parser_analyse.add_argument('--profiler', type=str, choices=PROFILERS, default='cprofile',
+                                help='Чем профилировать: cprofile (по умолчанию, только основной поток) или yappi '
+                                     '(нужен пакет yappi, видит все потоки).')
 
     # === Команды для управления прокси ===
     parser_proxy = subparsers.add_parser('proxy', help='Управление прокси')
@@ -62,6 +115,14 @@ def parsing_arguments(args) -> tuple[argparse.ArgumentParser, argparse.Namespace
     # Вывести список
     proxy_subparser.add_parser('show', help='Показать все доступные прокси')
 
+    # === Команды для моделей ===
+    parser_model = subparsers.add_parser('model', help='Управление моделями нейросети')
+    model_subparser = parser_model.add_subparsers(dest='model_command', help='Действия с моделями')
+
+    # Выгрузить веса для NumPy
+    model_subparser.add_parser('export', help='Выгрузить веса моделей в .npz для работы без PyTorch '
+                                              '(нужен установленный PyTorch) и сверить предсказания')
+
     # === Команды для управления токенами API ===
     parser_token = subparsers.add_parser('token', help='Управление токенами VK API')
     token_subparser = parser_token.add_subparsers(dest='token_command', help='Действия с токенами VK API')
@@ -110,6 +171,25 @@ def main(args):
         elif not os.path.isdir(args.output):
             raise parser.error(red('[ANALYSE OUTPUT] Такой папки не существует!'))
 
+        # Проверяем пороги статистики
+        try:
+            thresholds = [float(item) for item in args.thresholds.split(',')]
+        except ValueError:
+            raise parser.error(red('[ANALYSE THRESHOLDS] Пороги должны быть числами через запятую!'))
+        if not all(0 <= threshold <= 1 for threshold in thresholds):
+            raise parser.error(red('[ANALYSE THRESHOLDS] Пороги должны быть от 0 до 1!'))
+
+        # Проверяем стадии сбора
+        stages = args.stages.split(',')
+        if not all(stage in STAGES for stage in stages):
+            raise parser.error(red(f'[ANALYSE STAGES] Стадии сбора могут быть только: {", ".join(STAGES)}!'))
+
+        # Проверяем этапы профилирования
+        profile_stages = args.profile.split(',') if args.profile else []
+        if not all(stage in PROFILE_STAGES for stage in profile_stages):
+            raise parser.error(red(f'[ANALYSE PROFILE] Профилировать можно только этапы: '
+                                   f'{", ".join(PROFILE_STAGES)}!'))
+
         original_file_name = os.path.splitext(os.path.split(args.input)[1])[0]
 
         # Разбираем входной файл
@@ -125,12 +205,21 @@ def main(args):
         if not os.path.exists(data_folder):
             os.mkdir(data_folder)
 
-        take_data(user_ids, data_folder)
-        start_analyse(data_folder)
-        create_output_file(data_folder, sheet_dict, args.output, original_file_name)
+        def profiler(stage: str):
+            return profile_stage(stage, args.profiler if stage in profile_stages else None,
+                                 os.path.join(data_folder, f'profile_{stage}.prof'))
+
+        metrics = MetricsExporter(args.metrics_log, args.metrics_snapshot, args.metrics_port, args.metrics_interval)
+        with profiler('collect'):
+            take_data(user_ids, data_folder, False if args.original_off else True, args.processes,
+                      args.cache_ttl, args.cache_size, stages, metrics, args.feature_store)
+        with profiler('analyse'):
+            start_analyse(data_folder, args.backend, args.batch_size, args.reanalyse, args.feature_store)
+        with profiler('output'):
+            create_output_file(data_folder, sheet_dict, args.output, original_file_name, args.format)
 
         if args.statistic:
-            create_statistic_file(data_folder, sheet_dict, args.output, original_file_name)
+            create_statistic_file(data_folder, sheet_dict, args.output, original_file_name, thresholds)
 
         print(green('[INFO] Программа закончила работу'))
 
@@ -162,6 +251,19 @@ def main(args):
         elif args.proxy_command == 'show':
             show_list('Список прокси:', proxy.get_proxies())
 
+    elif args.command == 'model':
+        if args.model_command == 'export':
+            from src.bot_detector.neural_models import export_numpy_weights, check_numpy_parity
+
+            export_numpy_weights()
+            max_difference = check_numpy_parity()
+            if max_difference <= PARITY_TOLERANCE:
+                print(green(f'[MODEL EXPORT] Веса выгружены, расхождение с PyTorch: {max_difference:.6f}'))
+            else:
+                print(red(f'[MODEL EXPORT] Веса выгружены, но расхождение с PyTorch слишком большое: '
+                          f'{max_difference:.6f}! Не используйте --backend numpy'))
+                sys.exit(1)
+
     elif args.command == 'token':
         token_manager = TokenManager()
         if args.token_command == 'new':
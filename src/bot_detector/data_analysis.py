@@ -1,8 +1,12 @@
+import os
 import asyncio
 import math
 import datetime
 
+import numpy as np
+
 from src.bot_detector.database import DatabaseManager
+from src.bot_detector.feature_store import FeatureStore
 
 
 def get_current_time() -> str:
@@ -11,42 +15,151 @@ def get_current_time() -> str:
     return cur_time.strftime('%H:%M:%S')
 
 
-async def analyse_all_profiles(data_folder: str):
-    """Проводит все собранные профили через нейросеть для определения вероятности бота"""
-    db = DatabaseManager(fr'{data_folder}\data.db')
-    await db.connect()
-    await db.create_tables()
-
-    _, close_profiles, _, open_profiles = await db.get_all_profiles_info()
-
-    print(f'[{get_current_time()}][INFO] Загружаем PyTorch для нейросети')
-    from src.bot_detector.neural_models import PredictionModel
+async def database_batches(read_db: DatabaseManager, is_close: bool, batch_size: int, model_checksum: str | None):
+    """Пачки (id, признаки) для нейросети прямо из таблицы признаков БД"""
+    generator = read_db.get_batched_data(is_close=is_close, batch_size=batch_size, model_checksum=model_checksum)
+    async for batch in generator:
+        ids = [row[0] for row in batch]
+        features = np.array([row[1:] for row in batch], dtype=np.float32)   # Убираем id для нейронки
+        yield ids, features
+    await generator.aclose()
+
+
+async def feature_store_batches(read_db: DatabaseManager, store: FeatureStore, batch_size: int,
+                                model_checksum: str | None):
+    """Пачки (id, признаки) для нейросети из колоночного хранилища: из БД читаются только id для анализа"""
+    for ids, features in store.batches(await read_db.get_ids_to_analyse(store.is_close, model_checksum), batch_size):
+        yield ids, features
+
+
+async def update_feature_store(db: DatabaseManager, store: FeatureStore) -> None:
+    """
+    Приводит колоночное хранилище признаков в соответствие с таблицей БД: выбрасывает удаленные из БД профили,
+    дописывает в журнал признаки профилей, которых в хранилище нет (например, взятых из кэша профилей
+    или собранных без хранилища), и сливает журнал с хранилищем
+    """
+    removed_ids, last_removed = await db.get_removed_features(store.is_close)
+    table_ids = await db.get_ids_to_analyse(store.is_close)
+    store.compact(table_ids, removed_ids)   # Сначала выбрасываем устаревшие признаки, даже если их уже дописали снова
+
+    missing_ids = np.setdiff1d(table_ids, store.open()[0], assume_unique=True)
+    if len(missing_ids) != 0:
+        print(f'[{get_current_time()}][INFO] Дописываем в хранилище признаков профили из БД: {len(missing_ids)}')
+        async for batch in db.get_features_by_ids(store.is_close, missing_ids):
+            store.append(batch)
+        store.compact(table_ids, np.empty(0, dtype=np.int64))
+    await db.clear_removed_features(store.is_close, last_removed)
+
+
+async def analyse_pipeline(batches, write_db: DatabaseManager, nn_worker, batch_size: int, batches_number: int,
+                           queue_size: int = 2):
+    """
+    Конвейер анализа одной таблицы профилей: пока пачка k+1 читается, по пачке k считается нейросеть,
+    а пачка k-1 записывается в БД. Нейросеть считается в отдельном потоке, чтобы не блокировать цикл событий
+    :param batches: Асинхронный генератор пачек (id, признаки): database_batches или feature_store_batches
+    :param write_db: Соединение для записи результатов
+    :param nn_worker: Модель с методом model_predict
+    :param batch_size: Сколько профилей в пачке
+    :param batches_number: Сколько всего пачек, нужно для вывода прогресса
+    :param queue_size: Сколько пачек может ждать следующего этапа конвейера
+    """
+    loop = asyncio.get_running_loop()
+    to_predict = asyncio.Queue(maxsize=queue_size)
+    to_save = asyncio.Queue(maxsize=queue_size)
+
+    async def reader():
+        async for ids, features in batches:
+            await to_predict.put((ids, features))
+        await to_predict.put(None)
+
+    async def predictor():
+        while True:
+            item = await to_predict.get()
+            if item is None:
+                await to_save.put(None)
+                return
+            ids, features = item
+            result = await loop.run_in_executor(None, nn_worker.model_predict, features)
+            await to_save.put(list(zip(ids, result.tolist())))
+
+    async def writer():
+        iterator = 0
+        while True:
+            item = await to_save.get()
+            if item is None:
+                return
+            await write_db.save_analyse_result(item, nn_worker.checksum)
+            iterator += 1
+            print(f'\r\tГруппа (х{batch_size}): {iterator}/{batches_number}', end='')
+
+    tasks = [asyncio.create_task(stage()) for stage in [reader, predictor, writer]]
+    try:
+        await asyncio.gather(*tasks)
+    except BaseException:
+        # Если один этап упал, то остальные повиснут на очередях, поэтому останавливаем все
+        for task in tasks:
+            task.cancel()
+        raise
+    print('')
+
+
+async def analyse_all_profiles(data_folder: str, backend: str = 'torch', batch_size: int = 1000,
+                               full_analysis: bool = False, feature_store: bool = False):
+    """
+    Проводит собранные профили через нейросеть для определения вероятности бота.
+    По умолчанию только те, у которых еще нет результата или он посчитан другой версией модели
+    :param data_folder: Папка с БД
+    :param backend: На чем считать нейросеть: 'torch' или 'numpy' (не загружает PyTorch)
+    :param batch_size: Сколько профилей за раз проходит через нейросеть
+    :param full_analysis: Заново проанализировать все профили
+    :param feature_store: Читать признаки из колоночного хранилища (FeatureStore), а не из таблиц БД
+    """
+    # Чтение и запись идут одновременно, так что у каждого свое соединение
+    read_db = DatabaseManager(os.path.join(data_folder, 'data.db'))
+    await read_db.connect()
+    await read_db.create_tables()
+    # Удаления профилей отмечаются для хранилища признаков, пока оно есть. Если его нет, то отметки
+    # никто не очистит, а хранилище, созданное позже, все равно целиком соберется из таблиц БД
+    await read_db.track_removed_features(
+        feature_store or any(FeatureStore(data_folder, is_close).exists() for is_close in [False, True]))
+    write_db = DatabaseManager(os.path.join(data_folder, 'data.db'))
+    await write_db.connect()
+
+    if backend == 'numpy':
+        from src.bot_detector.numpy_models import NumpyPredictionModel as PredictionModel
+    else:
+        print(f'[{get_current_time()}][INFO] Загружаем PyTorch для нейросети')
+        from src.bot_detector.neural_models import PredictionModel
 
     for is_close in [False, True]:
-        data_len = math.ceil((len(close_profiles) if is_close else len(open_profiles))/1000)
-        print(f'[{get_current_time()}][INFO] Анализируем {"закрытые" if is_close else "открытые"} профили')
-
         nn_worker = PredictionModel(is_close)                                # Грузим нейронку
-        generator = db.get_batched_data(is_close=is_close)   # Генератором забираем данные в батчах из БД
 
-        iterator = 0
-        async for batch in generator:
-            iterator += 1
-            print(f'\r\tГруппа (х1000): {iterator}/{data_len}', end='')
+        profiles_number = await read_db.count_profiles_to_analyse(
+            is_close, None if full_analysis else nn_worker.checksum)
+        print(f'[{get_current_time()}][INFO] Анализируем {"закрытые" if is_close else "открытые"} профили: '
+              f'{profiles_number}')
+        if profiles_number == 0:
+            continue
+
+        model_checksum = None if full_analysis else nn_worker.checksum
+        if feature_store:
+            store = FeatureStore(data_folder, is_close)
+            await update_feature_store(read_db, store)
+            batches = feature_store_batches(read_db, store, batch_size, model_checksum)
+        else:
+            batches = database_batches(read_db, is_close, batch_size, model_checksum)
 
-            data_to_neuro = [(row[0], row[1:]) for row in batch]    # Убираем id для нейронки
-            result = nn_worker.model_predict(data_to_neuro)       # Получаем предсказание
-            await db.save_analyse_result(result)             # И сохраняем все в таблицу
-        print('')
+        await analyse_pipeline(batches, write_db, nn_worker, batch_size, math.ceil(profiles_number / batch_size))
 
-        await generator.aclose()
-    await db.close()
+    await read_db.close()
+    await write_db.close()
 
 
-def start_analyse(data_folder: str):
+def start_analyse(data_folder: str, backend: str = 'torch', batch_size: int = 1000, full_analysis: bool = False,
+                  feature_store: bool = False):
     """Запускает проверку на ботность у всех собранных профилей"""
     print(f'\n\n[{get_current_time()}][INFO] Начинаем анализ!')
-    asyncio.run(analyse_all_profiles(data_folder))
+    asyncio.run(analyse_all_profiles(data_folder, backend, batch_size, full_analysis, feature_store))
 
 
 if __name__ == '__main__':
@@ -1,11 +1,32 @@
 import os
+import time
+import queue
 import asyncio
 import datetime
 from math import ceil
-from multiprocessing import Process, Manager
+from contextlib import nullcontext
+from multiprocessing import Process, Manager, Queue
+from multiprocessing.shared_memory import SharedMemory
 
-from src.bot_detector.async_api import AIOInfoGrabber
+import numpy as np
+
+from src.bot_detector.async_api import AIOInfoGrabber, MIN_REQUEST_INTERVAL, MAX_IN_FLIGHT, VK_API_URL
+from src.bot_detector.http_session import create_session
+from src.bot_detector.database_writer import QueueWriter, writer_process
 from src.bot_detector.config_manager import TokenManager, ProxyManager
+from src.bot_detector.database import DatabaseManager
+from src.bot_detector.work_queue import WorkQueue
+from src.bot_detector.rate_limiter import TokenBucket
+from src.bot_detector.paths import PROFILE_CACHE_FILE, TOKEN_LIMITS_FILE
+from src.bot_detector.token_limits import TokenLimits
+from src.bot_detector.metrics import MetricsExporter
+
+CACHE_TTL_DAYS = 30                 # Сколько дней профиль из кэша считается актуальным
+CACHE_MAX_PROFILES = 10_000_000     # Сколько профилей максимум хранить в кэше, лишние (самые старые) удаляются
+MAX_COOLDOWN_WAIT = 60 * 60         # Сколько секунд можно ждать конца паузы токенов, если все токены на паузе
+IDS_IN_REQUEST = {'users': 25, 'groups': 25, 'walls': 10}   # Максимум id в одном запросе по каждому методу
+STAGES = ['users', 'groups', 'walls']   # Стадии сбора по порядку: группы и посты собираются у открытых профилей
+PROCESS_CHECK_INTERVAL = 0.5        # Как часто (сек) проверять, живы ли процессы сбора и писатель
 
 
 def list_to_chunks(lst: list, n: int):
@@ -14,43 +35,90 @@ def list_to_chunks(lst: list, n: int):
     return list(map(lambda x: lst[x * size:x * size + size], list(range(n))))
 
 
+def share_ids(ids: np.ndarray) -> SharedMemory:
+    """Копирует id в общую память, откуда процессы сбора читают их без пересылки (pickle) каждому процессу"""
+    memory = SharedMemory(create=True, size=max(ids.nbytes, 1))    # Блок нулевого размера создать нельзя
+    np.ndarray(ids.shape, dtype=np.int64, buffer=memory.buf)[:] = ids
+    return memory
+
+
 def get_current_time() -> str:
     """Возвращает строку с текущим временем, нужно для логирования"""
     cur_time = datetime.datetime.now()
     return cur_time.strftime('%H:%M:%S')
 
 
+async def use_profile_cache(db: DatabaseManager, cache_ttl_days: float, cache_size: int) -> None:
+    """
+    Чистит общий кэш профилей от устаревших профилей и переносит в БД те профили из input_ids, что есть в кэше,
+    чтобы не собирать их заново. БД должна быть открыта с кэшем и с загруженными input_ids
+    """
+    ttl = cache_ttl_days * 24 * 60 * 60
+    removed = await db.evict_cache(ttl, cache_size)
+    from_cache = await db.fill_from_cache(ttl)
+    print(f'[{get_current_time()}][INFO] Взято из кэша профилей: {from_cache} '
+          f'(удалено устаревших из кэша: {removed})')
+
+
+async def fill_from_profile_cache(all_ids: np.ndarray, data_folder: str, cache_ttl_days: float,
+                                  cache_size: int) -> None:
+    """Переносит профили из общего кэша в БД списка до запуска процессов сбора"""
+    db = DatabaseManager(os.path.join(data_folder, 'data.db'), PROFILE_CACHE_FILE)
+    await db.connect()
+    await db.create_tables()
+    await db.load_input_ids(all_ids)
+    await use_profile_cache(db, cache_ttl_days, cache_size)
+    await db.close()
+
+
 class InfoProcess:
     """Класс для ПРОЦЕССА сбора информации"""
     def __init__(self, process_id: int,
                  max_process_id: int,
-                 user_ids: list,
+                 ids_memory_name: str,
+                 ids_number: int,
                  tokens: dict,
                  data_folder: str,
                  proxy: str | None,
                  proxy_auth: list[str, str] | None,
                  barrier,
-                 need_repeat: int):
+                 need_repeat: int,
+                 write_queue,
+                 applied,
+                 stages: list[str] = ('users', ),
+                 api_url: str = VK_API_URL,
+                 requests_per_second: float = 1 / MIN_REQUEST_INTERVAL):
         """
         :param process_id: Номер процесса
         :param max_process_id: Сколько всего процессов
-        :param user_ids: Все id пользователей
-        :param tokens: Все токены API
+        :param ids_memory_name: Имя блока общей памяти с id всех пользователей (share_ids)
+        :param ids_number: Сколько id в блоке общей памяти
+        :param tokens: Все токены API, у каждого словарь {метод: до какого времени (unix) токен на паузе в методе}
         :param data_folder: Папка с данными этого списка пользователей
         :param proxy: Адрес прокси, если нет, то None
         :param proxy_auth: Данные для аутентификации прокси, если нет, то None
         :param barrier: Блокиратор для синхронизации процессов
         :param need_repeat: Переменная нужности повтора в общей памяти процессов
+        :param write_queue: Очередь процесса-писателя, единственного, кто пишет в БД
+        :param applied: Общий словарь писателя с количеством записанных пачек по каждому процессу
+        :param stages: Какие стадии сбора запускать, по очереди (все процессы работают над одним методом)
+        :param api_url: Адрес API, можно заменить на локальный для тестов
+        :param requests_per_second: Сколько запросов в секунду можно отправлять с одного токена
         """
         self.process_id = process_id
         self.max_id = max_process_id
-        self.user_id_list = user_ids
+        # Массив id смотрит прямо в общую память, каждый процесс берет из него только свой срез
+        ids_memory = SharedMemory(name=ids_memory_name)
+        self.user_id_list = np.ndarray((ids_number, ), dtype=np.int64, buffer=ids_memory.buf)
         self.tokens_dict = tokens
         self.data_folder = data_folder
         self.proxy = proxy
         self.proxy_auth = proxy_auth
         self.barrier = barrier
         self.need_repeat = need_repeat
+        self.api_url = api_url
+        self.requests_per_second = requests_per_second
+        self.db_writer = QueueWriter(write_queue, applied, process_id)   # Все записи в БД идут через писателя
 
         while self.need_repeat.value == 1:
             print(f'[{get_current_time()}][INFO P_{self.process_id}] Ожидание запуска других процессов')
@@ -62,11 +130,10 @@ class InfoProcess:
             if self.need_repeat.value == 1:
                 self.need_repeat.value = 0
 
-            # Запускаем нужные методы
-            # (для больших наборов советую только users, т.к. он не ограничен по кол-ву вызовов)
-            self.grab_info_method('users')
-            # self.grab_info_method('groups')   # Ограничение  ~800 id после чего блокируется метод
-            # self.grab_info_method('walls')    # Ограничение ~2000 id после чего блокируется метод
+            # Запускаем нужные методы по очереди
+            # (groups и walls ограничены ~800 и ~2000 id на токен, после чего токен уходит на паузу)
+            for method in stages:
+                self.grab_info_method(method)
 
             # Ожидание пока все процессы завершат сбор информации
             self.barrier.wait()
@@ -74,6 +141,9 @@ class InfoProcess:
             if self.need_repeat.value == 1:
                 self.informing(f'[{get_current_time()}][INFO] Требуется повторение процесса сбора информации\n\n')
 
+        del self.user_id_list   # Пока на общую память есть ссылки, её нельзя закрыть
+        ids_memory.close()
+
     def grab_info_method(self, method) -> None:
         """
         Конкурентный сбор информации для каждого процесса через его прокси, в соответствии с выбранным методом
@@ -83,10 +153,10 @@ class InfoProcess:
         self.barrier.wait()
 
         # Выделяем токены API, которые могут взаимодействовать с выбранным методом.
-        # То есть те, которые еще не достигли своего лимита в выбранном методе
-        available_tokens = [key for key in self.tokens_dict.keys() if not self.tokens_dict[key][method]]
+        # То есть те, которые сейчас не на паузе после лимита в выбранном методе
+        available_tokens = [key for key in self.tokens_dict.keys() if self.tokens_dict[key][method] <= time.time()]
         if len(available_tokens) == 0:
-            self.informing(f'[{get_current_time()}][ERROR] Все токены ограничены в методе {method}!'
+            self.informing(f'[{get_current_time()}][ERROR] Все токены на паузе в методе {method}!'
                            f'\n\tПроцесс сбора продолжится, но этот метод не будет собран до конца')
 
         # Если доступных токенов осталось меньше, чем процессов, то оставшиеся процессы бездействуют
@@ -104,43 +174,279 @@ class InfoProcess:
                            f'методу {method}, время сбора с нуля: ~{time_to_wait} мин.')
 
             # Запускаем конкурентный сбор данных по пользователям с использованием переменных процесса
-            limits, need_repeat_from_method = asyncio.run(AIOInfoGrabber(
-                current_process_users, self.data_folder, current_process_token, self.proxy, self.proxy_auth,
-                True if self.process_id == 0 else False).start(method))
+            grabber = AIOInfoGrabber(current_process_users, self.data_folder, current_process_token, self.proxy,
+                                     self.proxy_auth, True if self.process_id == 0 else False,
+                                     requests_per_second=self.requests_per_second, db_writer=self.db_writer,
+                                     api_url=self.api_url)
+            limits, need_repeat_from_method = asyncio.run(grabber.start(method))
 
             # Если после выполнения метода нужно повторно собрать информацию
             if need_repeat_from_method and self.need_repeat.value == 0:
                 self.need_repeat.value = 1
 
-            # Если лимиты изменились, то прописываем их
+            # Если токен уперся в лимит, то ставим его на паузу
             for limit_name in limits.keys():
-                if limits[limit_name]:  # Если лимит сменился на True, то применяем его
-                    self.tokens_dict[current_process_token][limit_name] = limits[limit_name]
+                if limits[limit_name]:
+                    cooldown = TokenLimits(TOKEN_LIMITS_FILE).record_limit(
+                        current_process_token, limit_name, grabber.requests_done[limit_name])
+                    self.tokens_dict[current_process_token][limit_name] = time.time() + cooldown
 
     def informing(self, message):
         if self.process_id == 0:
             print(message)
 
 
-def take_data(all_ids: list, data_folder: str, need_original_address: bool = True) -> None:
+class InfoLoop:
+    """Класс для сбора информации всеми токенами в ОДНОМ процессе и одном цикле событий"""
+    def __init__(self, user_ids: np.ndarray, token_keys: list[str], proxys: list, data_folder: str,
+                 cache_ttl_days: float = CACHE_TTL_DAYS, cache_size: int = CACHE_MAX_PROFILES,
+                 stages: list[str] = ('users', ), api_url: str = VK_API_URL,
+                 requests_per_second: float = 1 / MIN_REQUEST_INTERVAL, metrics: MetricsExporter | None = None,
+                 feature_store: bool = False):
+        """
+        Каждый токен - это отдельная полоса сбора. Прокси раздаются полосам по кругу, так что если токенов
+        больше, чем прокси, то несколько полос делят одну сессию (пул соединений) прокси, но не простаивают.
+        Сбор почти полностью состоит из ожидания сети, так что одного процесса хватает на любое количество полос,
+        а запись в БД идет через одно общее соединение.
+        Стадии сбора (users, groups, walls) идут одновременно, у каждой свои полосы и свои паузы токенов
+        по лимитам метода, а ограничитель частоты у токена один на все стадии.
+        Открытые профили попадают в очереди групп и постов сразу после записи в БД
+        :param user_ids: Все id пользователей
+        :param token_keys: Все токены API
+        :param proxys: Все прокси с данными для аутентификации
+        :param data_folder: Папка с данными этого списка пользователей
+        :param cache_ttl_days: Сколько дней профиль из общего кэша считается актуальным, 0 - не использовать кэш
+        :param cache_size: Сколько профилей максимум хранить в общем кэше
+        :param stages: Какие стадии сбора запускать
+        :param api_url: Адрес API, можно заменить на локальный для тестов
+        :param requests_per_second: Сколько запросов в секунду можно отправлять с одного токена
+        :param metrics: Выгрузка метрик сбора, работает на время сбора, None - не выгружать
+        :param feature_store: Дописывать признаки профилей еще и в колоночное хранилище (FeatureStore)
+        """
+        self.user_id_list = user_ids
+        self.api_url = api_url
+        self.requests_per_second = requests_per_second
+        self.stages = [method for method in STAGES if method in stages]
+        self.cache_ttl_days = cache_ttl_days
+        self.cache_size = cache_size
+        self.token_keys = token_keys
+        self.token_limits = TokenLimits(TOKEN_LIMITS_FILE)     # Паузы токенов сохраняются между запусками
+        self.proxys = proxys
+        self.data_folder = data_folder
+        self.lanes_number = len(token_keys)     # Кол-во полос сбора, по одной на токен
+        self.rate_limiters: dict[str, TokenBucket] = {}
+        self.sessions = []      # Сессия (пул соединений) на каждый прокси, общая для всех его полос
+        self.db: DatabaseManager | None = None
+        self.metrics = metrics
+        self.feature_store = feature_store
+
+    async def start(self) -> None:
+        """Сбор информации, пока все профили не будут собраны или все токены не упрутся в лимиты"""
+        self.db = DatabaseManager(os.path.join(self.data_folder, 'data.db'),
+                                  PROFILE_CACHE_FILE if self.cache_ttl_days > 0 else None,
+                                  self.data_folder if self.feature_store else None)
+        await self.db.connect()
+        await self.db.create_tables()
+        await self.db.load_input_ids(self.user_id_list)     # Непроверенные профили ищутся запросом к БД
+        if self.cache_ttl_days > 0:
+            await use_profile_cache(self.db, self.cache_ttl_days, self.cache_size)
+
+        # Запросы всех стадий с одним токеном идут через один ограничитель частоты
+        self.rate_limiters = {key: TokenBucket(self.requests_per_second) for key in self.token_keys}
+
+        # Соединения прокси живут весь сбор и переиспользуются всеми стадиями, кругами и полосами этого прокси
+        lanes_per_proxy = ceil(self.lanes_number / len(self.proxys))
+        self.sessions = [create_session(proxy, proxy_auth, MAX_IN_FLIGHT * len(self.stages) * lanes_per_proxy)
+                         for proxy, proxy_auth in self.proxys[:self.lanes_number]]
+        try:
+            async with self.metrics if self.metrics is not None else nullcontext():
+                need_repeat = True
+                while need_repeat:
+                    print(f'[{get_current_time()}][INFO] Начинаем процесс сбора информации')
+
+                    need_repeat = await self.grab_stages()
+
+                    if need_repeat:
+                        print(f'[{get_current_time()}][INFO] Требуется повторение процесса сбора информации\n\n')
+        finally:
+            for session in self.sessions:
+                await session.close()
+
+        await self.db.close()
+
+    async def grab_stages(self) -> bool:
+        """
+        Один круг сбора всеми выбранными стадиями одновременно.
+        Если собираются и users, и следующие стадии, то их очереди остаются открытыми, пока идет users:
+        в них попадают открытые профили, собранные на этом круге
+        :return: Нужен ли повтор сбора
+        """
+        work_queues = {}
+        for method in self.stages:
+            feeds_from_users = method != 'users' and 'users' in self.stages
+            work_queues[method] = WorkQueue(await self.get_ids_to_collect(method), closed=not feeds_from_users)
+        next_stages = [work_queues[method] for method in self.stages if method != 'users']
+
+        async def users_stage() -> bool:
+            try:
+                return await self.grab_info_method('users', work_queues['users'], next_stages)
+            finally:
+                # Новых открытых профилей на этом круге больше не будет
+                for next_stage in next_stages:
+                    await next_stage.close()
+
+        results = await asyncio.gather(*[users_stage() if method == 'users'
+                                         else self.grab_info_method(method, work_queues[method])
+                                         for method in self.stages])
+        return any(results)
+
+    async def grab_info_method(self, method, work_queue: WorkQueue,
+                               next_stages: list[WorkQueue] | None = None) -> bool:
+        """
+        Конкурентный сбор информации всеми доступными полосами по выбранному методу
+        :param method: метод сбора, может быть ТОЛЬКО 'users', 'groups', 'walls'
+        :param work_queue: Очередь id стадии, может пополняться по ходу сбора
+        :param next_stages: Очереди следующих стадий, куда отправляются собранные открытые профили (для users)
+        :return: Нужен ли повтор сбора
+        """
+        if len(work_queue) == 0 and work_queue.closed:
+            return False
+
+        available_tokens = [key for key in self.token_keys if self.token_limits.is_available(key, method)]
+        if len(available_tokens) == 0:
+            # Все токены на паузе после лимита. Если пауза скоро кончится, то ждем её, иначе бросаем метод
+            wait_time = min(self.token_limits.limited_until(key, method) for key in self.token_keys) - time.time()
+            if wait_time <= MAX_COOLDOWN_WAIT:
+                print(f'[{get_current_time()}][INFO] Все токены на паузе в методе {method}, '
+                      f'ждем ~{ceil(wait_time / 60)} мин.')
+                await asyncio.sleep(max(wait_time, 0))
+                return True
+            print(f'[{get_current_time()}][ERROR] Все токены ограничены в методе {method}!'
+                  f'\n\tПроцесс сбора продолжится, но этот метод не будет собран до конца')
+            return False
+
+        # Все полосы забирают пакеты id из общей очереди, так что быстрые полосы забирают работу медленных,
+        # а пакеты полосы, чей токен уперся в лимит, сразу достаются остальным
+        lanes_number = min(self.lanes_number, len(available_tokens))
+
+        count_users_method = {'users': 6525, 'groups': 6575, 'walls': 2380}
+        time_to_wait = int((len(work_queue) / lanes_number / count_users_method[method]) * 2) + 1
+        print(f'[{get_current_time()}][INFO] Собираем информацию по методу {method} у {len(work_queue)} '
+              f'профилей{"" if work_queue.closed else " (и у открытых профилей из users)"} в {lanes_number} полос, '
+              f'время сбора с нуля: ~{time_to_wait} мин.')
+
+        # Если токены уже упирались в лимит метода, то заранее предупреждаем, что их может не хватить
+        known_limits = [self.token_limits.requests_before_limit(key, method) for key in available_tokens]
+        requests_needed = ceil(len(work_queue) / IDS_IN_REQUEST[method])
+        if all(known_limits) and sum(known_limits) < requests_needed:
+            print(f'\tПо прошлым запускам токенов хватит примерно на {sum(known_limits)} запросов '
+                  f'из {requests_needed}, остальное будет собрано после паузы токенов')
+
+        # Полоса работает через прокси с номером lane_id % кол-во прокси
+        grabbers = [AIOInfoGrabber([], self.data_folder, available_tokens[lane_id],
+                                   *self.proxys[lane_id % len(self.sessions)],
+                                   True if lane_id == 0 else False, db=self.db,
+                                   rate_limiter=self.rate_limiters[available_tokens[lane_id]],
+                                   next_stages=next_stages, session=self.sessions[lane_id % len(self.sessions)],
+                                   api_url=self.api_url)
+                    for lane_id in range(lanes_number)]
+        results = await asyncio.gather(*[grabber.start(method, work_queue) for grabber in grabbers])
+
+        # Токен, упершийся в лимит, уже отдал свои пакеты остальным полосам, а сам уходит на паузу
+        limited = False
+        for lane_id, (limits, _) in enumerate(results):
+            if limits[method]:
+                limited = True
+                cooldown = self.token_limits.record_limit(available_tokens[lane_id], method,
+                                                          grabbers[lane_id].requests_done[method])
+                print(f'[{get_current_time()}][INFO] Токен полосы {lane_id} уперся в лимит метода {method}, '
+                      f'пауза {ceil(cooldown / 60)} мин.')
+
+        # Повторяем, только если что-то осталось и круг хоть что-то собрал (иначе, например, нет сети).
+        # Обработанный пакет еще не значит собранный (в коротком ответе execute может не быть части id),
+        # так что, как и в AIOInfoGrabber.start, сравниваем, сколько осталось собрать до и после круга.
+        # Если круг ничего не собрал из-за лимитов, то на следующем круге дождемся конца паузы токенов
+        remaining = await self.get_ids_to_collect(method)
+        if len(remaining) > 0 and len(remaining) >= work_queue.total and not limited:
+            print(f'[{get_current_time()}][ERROR] Не удалось собрать {len(remaining)} профилей по методу {method}')
+            return False
+        # Сборщик тоже просит повтор, если удалил профиль из всех таблиц для перепроверки (профиль без информации
+        # после записи users): такой профиль пропадает из оставшихся этого метода и заново собирается с users
+        return len(remaining) != 0 or any(need_repeat for _, need_repeat in results)
+
+    async def get_ids_to_collect(self, method) -> list:
+        """Возвращает id, которые еще нужно собрать по выбранному методу"""
+        if method == 'users':
+            return await self.db.get_unchecked_profiles()
+        elif method == 'groups':
+            return await self.db.get_profiles_to_group_check()
+        else:
+            return await self.db.get_profiles_to_wall_check()
+
+
+def take_data(all_ids: np.ndarray, data_folder: str, need_original_address: bool = True,
+              use_processes: bool = False, cache_ttl_days: float = CACHE_TTL_DAYS,
+              cache_size: int = CACHE_MAX_PROFILES, stages: list[str] = ('users', ),
+              metrics: MetricsExporter | None = None, feature_store: bool = False) -> None:
     """
-    Создание и запуск Процессов для сбора информации пользователей
-    :param all_ids: Список со всеми id, у которых нужно собрать информацию.
+    Сбор информации пользователей всеми токенами
+    :param all_ids: Массив int64 со всеми id, у которых нужно собрать информацию.
     :param data_folder: Папка, в которую помещается БД с данными анализа.
     :param need_original_address: Нужен ли адрес оригинальной машины в прокси
+    :param use_processes: Запускать ли отдельный процесс на каждый токен.
+        По умолчанию все токены работают в одном процессе, т.к. сбор почти полностью состоит из ожидания сети
+    :param cache_ttl_days: Сколько дней профиль из общего кэша профилей считается актуальным и не собирается
+        заново, 0 - не использовать кэш
+    :param cache_size: Сколько профилей максимум хранить в общем кэше
+    :param stages: Какие стадии сбора запускать: 'users' (нужна для анализа), 'groups', 'walls'.
+        В одном процессе стадии идут одновременно, а в режиме процессов - по очереди
+    :param metrics: Выгрузка метрик сбора. Метрики собираются только в одном процессе,
+        в режиме процессов не выгружаются
+    :param feature_store: Дописывать признаки профилей еще и в колоночное хранилище (FeatureStore)
     """
-    manager = Manager()         # Менеджер управления данными для процессов
-
     proxys = ProxyManager(need_original_address).get_proxies()  # Забираем все прокси
     token_keys = TokenManager().get_tokens()                    # Забираем все токены
 
     if len(token_keys) == 0:
         raise ValueError('Необходимо указать как минимум один токен API!')
 
-    # И преобразуем их в общий словарь с ограничениями по методам
+    if use_processes:
+        if metrics is not None and metrics.enabled:
+            print(f'[{get_current_time()}][WARNING] Метрики сбора выгружаются только при сборе в одном процессе')
+        if cache_ttl_days > 0:
+            asyncio.run(fill_from_profile_cache(all_ids, data_folder, cache_ttl_days, cache_size))
+        take_data_in_processes(all_ids, data_folder, token_keys, proxys,
+                               PROFILE_CACHE_FILE if cache_ttl_days > 0 else None, stages,
+                               feature_store=feature_store)
+    else:
+        asyncio.run(InfoLoop(all_ids, token_keys, proxys, data_folder, cache_ttl_days, cache_size, stages,
+                             metrics=metrics, feature_store=feature_store).start())
+
+
+def take_data_in_processes(all_ids: np.ndarray, data_folder: str, token_keys: list[str], proxys: list,
+                           cache_file: str | None = None, stages: list[str] = ('users', ),
+                           api_url: str = VK_API_URL, requests_per_second: float = 1 / MIN_REQUEST_INTERVAL,
+                           feature_store: bool = False) -> None:
+    """
+    Создание и запуск Процессов для сбора информации пользователей
+    :param all_ids: Массив int64 со всеми id, у которых нужно собрать информацию.
+    :param data_folder: Папка, в которую помещается БД с данными анализа.
+    :param token_keys: Все токены API
+    :param proxys: Все прокси с данными для аутентификации
+    :param cache_file: Файл общего кэша профилей, в который писатель дублирует собранные профили
+    :param stages: Какие стадии сбора запускать
+    :param api_url: Адрес API, можно заменить на локальный для тестов
+    :param requests_per_second: Сколько запросов в секунду можно отправлять с одного токена
+    :param feature_store: Дописывать признаки профилей еще и в колоночное хранилище (FeatureStore)
+    """
+    manager = Manager()         # Менеджер управления данными для процессов
+
+    # Преобразуем токены в общий словарь с паузами по методам (паузы от прошлых запусков тоже учитываются)
+    token_limits = TokenLimits(TOKEN_LIMITS_FILE)
     tokens = {}
     for key in token_keys:
-        tokens[key] = manager.dict({'users': False, 'groups': False, 'walls': False})
+        tokens[key] = manager.dict({method: token_limits.limited_until(key, method)
+                                    for method in ['users', 'groups', 'walls']})
 
     # Узнаем сколько потоков мы можем задействовать (если не можем узнать, то 8)
     cores_num = os.cpu_count()
@@ -150,14 +456,50 @@ def take_data(all_ids: list, data_folder: str, need_original_address: bool = Tru
     barrier = manager.Barrier(process_number)           # Блокиратор для синхронизации процессов
     need_repeat_val = manager.Value('i', 1)             # Переменная для повторения
 
+    # Единственный процесс, который пишет в БД. Сборщики только читают из неё,
+    # а собранные данные отправляют писателю, так что процессы не борются за блокировку файла БД
+    write_queue = Queue(maxsize=process_number * 20)
+    applied = manager.dict()
+    writer = Process(target=writer_process, args=(os.path.join(data_folder, 'data.db'), write_queue, applied,
+                                                  cache_file, data_folder if feature_store else None))
+    writer.start()
+
+    # id передаются процессам через общую память, а не копией списка в каждый процесс
+    all_ids = np.asarray(all_ids, dtype=np.int64)
+    ids_memory = share_ids(all_ids)
+
     # Создание процессов сбора информации
     process = [Process(target=InfoProcess, args=(
-        proc_id, process_number, all_ids, tokens, data_folder,
-        proxys[proc_id][0], proxys[proc_id][1], barrier, need_repeat_val
+        proc_id, process_number, ids_memory.name, len(all_ids), tokens, data_folder,
+        proxys[proc_id][0], proxys[proc_id][1], barrier, need_repeat_val, write_queue, applied,
+        [method for method in STAGES if method in stages], api_url, requests_per_second
     )) for proc_id in range(process_number)]
 
-    # Запуск и ожидание завершения
-    for proc in process:
-        proc.start()
-    for proc in process:
-        proc.join()
+    # Запуск и ожидание завершения. Если сборщик или писатель упал, то остальные сборщики не дождутся его
+    # на барьере, поэтому барьер снимается, и они тоже завершаются
+    try:
+        for proc in process:
+            proc.start()
+        while any(proc.is_alive() for proc in process):
+            if not writer.is_alive() or any(proc.exitcode not in (None, 0) for proc in process):
+                barrier.abort()
+            time.sleep(PROCESS_CHECK_INTERVAL)
+    finally:
+        ids_memory.close()
+        ids_memory.unlink()
+
+    # Сборщики закончили, писатель дописывает остатки и завершается (если он еще жив)
+    while writer.is_alive():
+        try:
+            write_queue.put(None, timeout=PROCESS_CHECK_INTERVAL)
+            break
+        except queue.Full:
+            continue
+    writer.join()
+
+    # Иначе анализ пошел бы по неполным данным
+    if writer.exitcode != 0 or 'error' in applied:
+        raise RuntimeError(f'Процесс записи в БД завершился с ошибкой: {applied.get("error", writer.exitcode)}')
+    failed = [proc_id for proc_id, proc in enumerate(process) if proc.exitcode != 0]
+    if failed:
+        raise RuntimeError(f'Процессы сбора {failed} завершились с ошибкой, собраны не все профили')
@@ -1,19 +1,48 @@
+import time
+import asyncio
+
 import aiosqlite
+import numpy as np
+
+from src.bot_detector.metrics import METRICS, DB_BUCKETS
+from src.bot_detector.feature_store import FeatureStore
+
+BUSY_TIMEOUT_MS = 60000     # Сколько ждать освобождения БД другим соединением, прежде чем выдать ошибку
+IDS_CHUNK_SIZE = 100000     # По сколько id читать из БД и загружать в неё за раз
+CACHE_TABLES = ['users_info_open', 'users_info_close']     # Таблицы с информацией профилей, которые кэшируются
 
 
 class DatabaseManager:
-    def __init__(self, file: str):
+    def __init__(self, file: str, cache_file: str | None = None, feature_folder: str | None = None):
         """
         Класс, предназначенный для асинхронной работы с БД
         :param file: Файл Базы Данных
+        :param cache_file: Файл общего кэша профилей (один на все входные файлы). Если указан, то он подключается
+            к БД как схема cache, и все собранные профили записываются еще и в него
+        :param feature_folder: Папка колоночного хранилища признаков (FeatureStore). Если указана, то признаки
+            собранных профилей после сохранения БД дописываются еще и в него
         """
         self.session: aiosqlite.Connection | None = None
         self.db_file = file
+        self.cache_file = cache_file
+        self.feature_stores = None if feature_folder is None else \
+            {is_close: FeatureStore(feature_folder, is_close) for is_close in [False, True]}
+        self.write_lock = asyncio.Lock()    # Соединение может быть общим у нескольких сборщиков, транзакции не смешиваем
 
     async def connect(self):
         """Соединение с БД"""
         self.session = await aiosqlite.connect(self.db_file)
 
+        # WAL позволяет читать БД из других процессов, пока в неё пишут,
+        # а при занятой на запись БД соединение подождет, вместо ошибки "database is locked"
+        await self.session.execute('PRAGMA journal_mode=WAL')
+        await self.session.execute('PRAGMA synchronous=NORMAL')
+        await self.session.execute(f'PRAGMA busy_timeout={BUSY_TIMEOUT_MS}')
+
+        if self.cache_file is not None:
+            await self.session.execute('ATTACH DATABASE ? AS cache', (str(self.cache_file), ))
+            await self.session.execute('PRAGMA cache.journal_mode=WAL')     # Кэшем могут пользоваться разные запуски
+
     async def close(self):
         await self.session.close()
 
@@ -28,43 +57,177 @@ class DatabaseManager:
             result_list = [item[0] for item in result]          # Преобразование в удобочитаемый список
             return result_list
 
-    async def get_checked_profiles(self):
-        """Возвращает все id, которые уже записаны в БД"""
-        return await self.get_data_in_list('SELECT user_id FROM users')
+    async def get_ids_array(self, request: str) -> np.ndarray:
+        """Возвращает первый столбец ответа на запрос массивом int64, читая ответ частями"""
+        chunks = []
+        async with self.session.cursor() as curr:
+            await curr.execute(request)
+            while rows := await curr.fetchmany(IDS_CHUNK_SIZE):
+                chunks.append(np.fromiter((row[0] for row in rows), dtype=np.int64, count=len(rows)))
+        return np.concatenate(chunks) if chunks else np.empty(0, dtype=np.int64)
 
     async def get_profiles_to_group_check(self):
-        """Возвращает id профилей, у которых еще не проверены группы """
-        return await self.get_data_in_list(
-            'SELECT user_id FROM users WHERE deactivated = 0 AND is_close = 0 AND group_checked = 0')
+        """
+        Возвращает id профилей из input_ids (load_input_ids), у которых еще не проверены группы.
+        В режиме процессов у каждого процесса в input_ids только его срез, так что профиль собирает один процесс
+        """
+        return await self.get_ids_array(
+            'SELECT u.user_id FROM users u JOIN input_ids i ON i.user_id = u.user_id '
+            'WHERE u.deactivated = 0 AND u.is_close = 0 AND u.group_checked = 0')
 
     async def get_profiles_to_wall_check(self):
-        """Возвращает id профилей, у которых еще не проверена стена """
-        return await self.get_data_in_list(
-            'SELECT user_id FROM users WHERE deactivated = 0 AND is_close = 0 AND wall_checked = 0')
-
-    async def get_all_profiles_info(self):
-        """Собирает все данные по всем профилям (и только профилям, без групп и стен)"""
-        close_profiles = await self.get_data_in_list(
-            'SELECT user_id FROM users WHERE deactivated = 0 AND is_close = 1')
-        close_info = await self.get_data_in_list(
-            'SELECT user_id FROM users_info_close')
-        open_profiles = await self.get_data_in_list(
-            'SELECT user_id FROM users WHERE deactivated = 0 AND is_close = 0')
-        open_info = await self.get_data_in_list(
-            'SELECT user_id FROM users_info_open')
-        return close_profiles, close_info, open_profiles, open_info
-
-    async def get_batched_data(self, is_close: bool, batch_size=1000):
-        """Генератор, который выдает по batch_size записей из нужной таблицы"""
+        """Возвращает id профилей из input_ids (load_input_ids), у которых еще не проверена стена"""
+        return await self.get_ids_array(
+            'SELECT u.user_id FROM users u JOIN input_ids i ON i.user_id = u.user_id '
+            'WHERE u.deactivated = 0 AND u.is_close = 0 AND u.wall_checked = 0')
+
+    async def load_input_ids(self, user_ids) -> int:
+        """
+        Загружает id из входного файла во временную таблицу input_ids (она своя у каждого соединения),
+        чтобы искать непроверенные профили запросом к БД, а не разностью списков в Python
+        :return: Сколько уникальных id загружено
+        """
+        async with self.session.cursor() as curr:
+            await curr.execute('CREATE TEMP TABLE IF NOT EXISTS input_ids (user_id INTEGER PRIMARY KEY)')
+            await curr.execute('DELETE FROM input_ids')
+            user_ids = np.asarray(user_ids, dtype=np.int64)
+            for start in range(0, len(user_ids), IDS_CHUNK_SIZE):
+                chunk = user_ids[start:start + IDS_CHUNK_SIZE].tolist()    # sqlite3 не принимает числа numpy
+                await curr.executemany('INSERT OR IGNORE INTO input_ids VALUES (?)',
+                                       ((user_id, ) for user_id in chunk))
+            await self.session.commit()
+            await curr.execute('SELECT COUNT(*) FROM input_ids')
+            return (await curr.fetchone())[0]
+
+    async def get_unchecked_profiles(self):
+        """Возвращает id из input_ids (load_input_ids), которых еще нет в БД, по возрастанию"""
+        return await self.get_ids_array(
+            'SELECT i.user_id FROM input_ids i '
+            'WHERE NOT EXISTS (SELECT 1 FROM users u WHERE u.user_id = i.user_id) '
+            'ORDER BY i.user_id')
+
+    async def get_profiles_to_recheck(self):
+        """
+        Возвращает id профилей, которые есть в users, но у которых нет записи в таблице с их информацией.
+        Читает под блокировкой записи: на общем соединении видна незавершенная транзакция другого сборщика,
+        и профиль из середины его пачки иначе выглядел бы недописанным
+        """
+        async with self.write_lock:
+            return await self.get_data_in_list(
+                """
+                SELECT u.user_id FROM users u
+                WHERE u.deactivated = 0 AND (
+                    (u.is_close = 1 AND NOT EXISTS (SELECT 1 FROM users_info_close c WHERE c.user_id = u.user_id))
+                    OR (u.is_close = 0 AND NOT EXISTS (SELECT 1 FROM users_info_open o WHERE o.user_id = u.user_id))
+                )
+                """)
+
+    @staticmethod
+    def _to_analyse_condition(only_new: bool) -> str:
+        """Условие на профили, которые нужно прогнать через нейросеть (для таблицы признаков f и results r)"""
+        if not only_new:
+            return ''
+        # Нет результата или результат посчитан другой моделью. Признаки профиля на месте не меняются:
+        # при повторном сборе профиль удаляется из всех таблиц вместе с результатом
+        return 'AND (r.user_id IS NULL OR r.model_checksum IS NOT ?)'
+
+    async def count_profiles_to_analyse(self, is_close: bool, model_checksum: str | None = None) -> int:
+        """Сколько профилей нужно проанализировать. Если model_checksum не указан, то все профили"""
+        only_new = model_checksum is not None
+        async with self.session.cursor() as curr:
+            await curr.execute(f"""
+                SELECT COUNT(*) FROM users_info_{'close' if is_close else 'open'} f
+                LEFT JOIN results r ON r.user_id = f.user_id
+                WHERE 1 {self._to_analyse_condition(only_new)}
+            """, (model_checksum, ) if only_new else ())
+            return (await curr.fetchone())[0]
+
+    async def get_ids_to_analyse(self, is_close: bool, model_checksum: str | None = None) -> np.ndarray:
+        """id профилей по возрастанию, которые нужно проанализировать. Если model_checksum не указан, то все профили"""
+        only_new = model_checksum is not None
+        async with self.session.cursor() as curr:
+            await curr.execute(f"""
+                SELECT f.user_id FROM users_info_{'close' if is_close else 'open'} f
+                LEFT JOIN results r ON r.user_id = f.user_id
+                WHERE 1 {self._to_analyse_condition(only_new)}
+                ORDER BY f.user_id
+            """, (model_checksum, ) if only_new else ())
+            chunks = []
+            while rows := await curr.fetchmany(IDS_CHUNK_SIZE):
+                chunks.append(np.fromiter((row[0] for row in rows), dtype=np.int64, count=len(rows)))
+        return np.concatenate(chunks) if chunks else np.empty(0, dtype=np.int64)
+
+    async def get_removed_features(self, is_close: bool) -> tuple[np.ndarray, int]:
+        """
+        id, удаленные из таблицы признаков (это отмечает триггер), для обновления колоночного хранилища
+        :return: id и номер последней отметки, до которого их потом нужно очистить (clear_removed_features)
+        """
+        async with self.session.cursor() as curr:
+            await curr.execute('SELECT COALESCE(MAX(rowid), 0) FROM features_removed')
+            last_rowid = (await curr.fetchone())[0]
+        ids = await self.get_ids_array(f'SELECT DISTINCT user_id FROM features_removed '
+                                       f'WHERE is_close = {int(is_close)} AND rowid <= {last_rowid}')
+        return np.sort(ids), last_rowid
+
+    async def clear_removed_features(self, is_close: bool, last_rowid: int) -> None:
+        """Очищает отметки об удалении, которые уже учтены в колоночном хранилище"""
+        await self.session.execute('DELETE FROM features_removed WHERE is_close = ? AND rowid <= ?',
+                                   (int(is_close), last_rowid))
+        await self.session.commit()
+
+    async def track_removed_features(self, enabled: bool) -> None:
+        """
+        Включает или выключает отметки об удалении профилей из таблиц признаков (триггеры на features_removed).
+        Отметки очищает только обновление хранилища признаков, так что без хранилища они не нужны:
+        при выключении триггеры удаляются, а накопленные отметки стираются
+        """
+        async with self.session.cursor() as curr:
+            for table, is_close in [('users_info_open', 0), ('users_info_close', 1)]:
+                if enabled:
+                    await curr.execute(f"""
+                        CREATE TRIGGER IF NOT EXISTS {table}_removed AFTER DELETE ON {table}
+                        BEGIN
+                            INSERT INTO features_removed VALUES (old.user_id, {is_close});
+                        END
+                    """)
+                else:
+                    await curr.execute(f'DROP TRIGGER IF EXISTS {table}_removed')
+            if not enabled:
+                await curr.execute('DELETE FROM features_removed')
+        await self.session.commit()
+
+    async def get_features_by_ids(self, is_close: bool, user_ids: np.ndarray, batch_size: int = IDS_CHUNK_SIZE):
+        """Генератор, который выдает по batch_size строк таблицы признаков только для указанных id"""
+        async with self.session.cursor() as curr:
+            await curr.execute('CREATE TEMP TABLE IF NOT EXISTS feature_ids (user_id INTEGER PRIMARY KEY)')
+            await curr.execute('DELETE FROM feature_ids')
+            for start in range(0, len(user_ids), IDS_CHUNK_SIZE):
+                await curr.executemany('INSERT OR IGNORE INTO feature_ids VALUES (?)',
+                                       [(user_id, ) for user_id in user_ids[start:start + IDS_CHUNK_SIZE].tolist()])
+            await curr.execute(f"""
+                SELECT f.* FROM users_info_{'close' if is_close else 'open'} f
+                JOIN feature_ids USING (user_id)
+                ORDER BY f.user_id
+            """)
+            while batch := await curr.fetchmany(batch_size):
+                yield batch
+
+    async def get_batched_data(self, is_close: bool, batch_size=1000, model_checksum: str | None = None):
+        """
+        Генератор, который выдает по batch_size записей из нужной таблицы.
+        Если указан model_checksum, то только те профили, у которых нет результата этой модели
+        """
+        only_new = model_checksum is not None
         last_id = 0
         async with self.session.cursor() as curr:
             while True:
                 await curr.execute(f"""
-                    SELECT * FROM users_info_{'close' if is_close else 'open'} 
-                    WHERE user_id > ? 
-                    ORDER BY user_id 
+                    SELECT f.* FROM users_info_{'close' if is_close else 'open'} f
+                    LEFT JOIN results r ON r.user_id = f.user_id
+                    WHERE f.user_id > ? {self._to_analyse_condition(only_new)}
+                    ORDER BY f.user_id 
                     LIMIT ?
-                """, (last_id, batch_size))
+                """, (last_id, model_checksum, batch_size) if only_new else (last_id, batch_size))
 
                 batch = await curr.fetchall()
                 if not batch:
@@ -73,67 +236,291 @@ class DatabaseManager:
                 last_id = batch[-1][0]  # Запоминаем последний ID
                 yield batch
 
-    async def get_result_data(self):
+    async def load_sheet_ids(self, sheet_dict: dict) -> None:
+        """
+        Загружает id со всех листов входного файла во временную таблицу sheet_ids
+        (номер листа по порядку, позиция id на листе, id), чтобы соединять их с результатами запросом к БД
+        :param sheet_dict: Словарь с массивом id на каждом листе
+        """
         async with self.session.cursor() as curr:
-            db_response = await curr.execute('SELECT * FROM results')
-            result = await db_response.fetchall()
-            return result
+            await curr.execute("""
+                CREATE TEMP TABLE IF NOT EXISTS sheet_ids
+                (
+                    sheet INTEGER,
+                    position INTEGER,
+                    user_id INTEGER,
+                    PRIMARY KEY (sheet, position)
+                ) WITHOUT ROWID
+                """)
+            await curr.execute('DELETE FROM sheet_ids')
+            for sheet_number, sheet_ids in enumerate(sheet_dict.values()):
+                sheet_ids = np.asarray(sheet_ids, dtype=np.int64)
+                for start in range(0, len(sheet_ids), IDS_CHUNK_SIZE):
+                    chunk = sheet_ids[start:start + IDS_CHUNK_SIZE].tolist()
+                    await curr.executemany('INSERT INTO sheet_ids VALUES (?, ?, ?)',
+                                           ((sheet_number, position, user_id)
+                                            for position, user_id in enumerate(chunk, start)))
+            await self.session.commit()
 
-    async def save_analyse_result(self, data: list):
+    async def get_sheet_results(self, sheet_number: int, batch_size: int = IDS_CHUNK_SIZE):
+        """
+        Генератор, который выдает пачками результаты для id листа из sheet_ids (load_sheet_ids) в порядке листа.
+        Строка - (id, вероятность бота), вероятность None, если по профилю нет результата
+        """
         async with self.session.cursor() as curr:
-            for item in data:
-                await curr.execute("""
-                    INSERT INTO results (user_id, bot_prob)
-                    VALUES (?, ?)
-                    ON CONFLICT(user_id) DO UPDATE SET
-                        bot_prob = excluded.bot_prob
-                    """, item)
+            await curr.execute("""
+                SELECT s.user_id, r.bot_prob FROM sheet_ids s
+                LEFT JOIN results r ON r.user_id = s.user_id
+                WHERE s.sheet = ?
+                ORDER BY s.position
+                """, (sheet_number, ))
+            while rows := await curr.fetchmany(batch_size):
+                yield rows
+
+    async def get_sheet_statistics(self, thresholds: list[float], buckets: int = 10) -> dict[int, dict]:
+        """
+        Статистика по каждому листу из sheet_ids (load_sheet_ids) одним сгруппированным запросом.
+        Профиль без результата (удален) считается ботом, как и в выходном файле
+        :param thresholds: Пороги вероятности, с которых профиль считается ботом
+        :param buckets: На сколько равных частей делить вероятность для гистограммы
+        :return: Словарь {номер листа: {'accounts', 'deleted', 'closed', 'mean', 'bots': [...], 'histogram': [...]}}
+        """
+        bots_columns = ', '.join('SUM(COALESCE(r.bot_prob, 1.0) >= ?)' for _ in thresholds)
+        # Вероятность 1.0 попадает в последний столбец гистограммы
+        histogram_columns = ', '.join(f'SUM(MIN(CAST(r.bot_prob * {buckets} AS INTEGER), {buckets - 1}) = {bucket})'
+                                      for bucket in range(buckets))
+
+        statistics = {}
+        async with self.session.cursor() as curr:
+            await curr.execute(f"""
+                SELECT s.sheet, COUNT(*), SUM(r.bot_prob IS NULL), SUM(r.bot_prob IS NOT NULL AND u.is_close = 1),
+                    AVG(r.bot_prob), {bots_columns}, {histogram_columns}
+                FROM sheet_ids s
+                LEFT JOIN results r ON r.user_id = s.user_id
+                LEFT JOIN users u ON u.user_id = s.user_id
+                GROUP BY s.sheet
+                """, thresholds)
+            for row in await curr.fetchall():
+                statistics[row[0]] = {
+                    'accounts': row[1],
+                    'deleted': row[2],
+                    'closed': row[3],
+                    'mean': row[4],
+                    'bots': list(row[5:5 + len(thresholds)]),
+                    'histogram': [value or 0 for value in row[5 + len(thresholds):]],
+                }
+        return statistics
+
+    async def save_analyse_result(self, data: list, model_checksum: str | None = None):
+        """
+        Пакетно сохраняет результаты анализа (id, вероятность бота) одной транзакцией
+        :param data: Список кортежей (id, вероятность бота)
+        :param model_checksum: Контрольная сумма модели, которая посчитала результаты
+        """
+        async with self.session.cursor() as curr:
+            await curr.executemany("""
+                INSERT INTO results (user_id, bot_prob, model_checksum)
+                VALUES (?, ?, ?)
+                ON CONFLICT(user_id) DO UPDATE SET
+                    bot_prob = excluded.bot_prob,
+                    model_checksum = excluded.model_checksum
+                """, [(user_id, bot_prob, model_checksum) for user_id, bot_prob in data])
             await self.session.commit()
 
-    async def save_user_result(self, data):
-        """Сохраняет первоначальные данные о пользователе, то есть его id, удален ли он и закрыт ли"""
+    # ========== ПАКЕТНАЯ ЗАПИСЬ ==========
+    async def save_users_results(self, rows: list[tuple]):
+        """Пакетно сохраняет первоначальные данные о пользователях: кортежи (id, удален ли, закрыт ли)"""
         async with self.session.cursor() as curr:
-            await curr.execute(
-                'INSERT INTO users (user_id, deactivated, is_close) VALUES(?, ?, ?)',
-                (data['id'],
-                 0 if data.get('deactivated') is None else 1,
-                 1 if data['is_closed'] else 0))
+            await curr.executemany('INSERT INTO users (user_id, deactivated, is_close) VALUES(?, ?, ?)', rows)
 
-    async def save_open_profile_data(self, data):
-        """Сохраняет упорядоченные данные об открытом профиле в БД"""
+    async def save_open_profiles_data(self, rows: list[tuple]):
+        """Пакетно сохраняет упорядоченные данные об открытых профилях"""
         async with self.session.cursor() as curr:
-            await curr.execute(  # Сохраняем в БД
-                f'INSERT INTO users_info_open VALUES({", ".join(["?" for _ in range(46)])})', data)
+            await curr.executemany(f'INSERT INTO users_info_open VALUES({", ".join(["?" for _ in range(46)])})', rows)
 
-    async def save_close_profile_data(self, data):
-        """Сохраняет упорядоченные данные о закрытом профиле в БД"""
+    async def save_close_profiles_data(self, rows: list[tuple]):
+        """Пакетно сохраняет упорядоченные данные о закрытых профилях"""
         async with self.session.cursor() as curr:
-            await curr.execute(
-                f'INSERT INTO users_info_close VALUES({", ".join(["?" for _ in range(17)])})', data)
+            await curr.executemany(f'INSERT INTO users_info_close VALUES({", ".join(["?" for _ in range(17)])})', rows)
 
-    async def update_user_group(self, data):
-        """Сохраняет отметку о прохождении профилем проверки групп в БД"""
+    async def save_groups_data(self, rows: list):
+        """
+        Пакетно сохраняет данные о группах профилей и отмечает, что группы проверены.
+        Стадии идут одновременно, поэтому профиль, удаленный для перепроверки, может успеть получить группы
+        от уже отправленного запроса, а на следующем круге собирается заново - новые данные заменяют старые
+        """
         async with self.session.cursor() as curr:
-            await curr.execute(
-                'UPDATE users SET group_checked = ? WHERE user_id = ?', (1, int(data[0])))
+            await curr.executemany('UPDATE users SET group_checked = 1 WHERE user_id = ?',
+                                   [(int(row[0]), ) for row in rows])
+            await curr.executemany(f'INSERT OR REPLACE INTO users_groups VALUES({", ".join(["?" for _ in range(6)])})',
+                                   rows)
 
-    async def save_group_data(self, data):
-        """Сохраняет упорядоченные данные о группах профиля в БД"""
+    async def save_walls_data(self, rows: list):
+        """
+        Пакетно сохраняет данные о постах профилей и отмечает, что стены проверены.
+        Повторный сбор заменяет старые данные, см. save_groups_data
+        """
         async with self.session.cursor() as curr:
-            await curr.execute(
-                f'INSERT INTO users_groups VALUES({", ".join(["?" for _ in range(6)])})', data)
+            await curr.executemany('UPDATE users SET wall_checked = 1 WHERE user_id = ?',
+                                   [(int(row[0]), ) for row in rows])
+            await curr.executemany(f'INSERT OR REPLACE INTO users_posts VALUES({", ".join(["?" for _ in range(22)])})',
+                                   rows)
 
-    async def update_user_wall(self, data):
-        """Сохраняет отметку о прохождении профилем проверки постов в БД"""
+    async def remove_many_from_all_tables(self, profile_ids: list[int]):
+        """Пакетно удаляет пользователей из всех таблиц в БД для их переопределения, БЕЗ сохранения БД"""
+        rows = [(int(profile_id), ) for profile_id in profile_ids]
         async with self.session.cursor() as curr:
-            await curr.execute(
-                'UPDATE users SET wall_checked = ? WHERE user_id = ?', (1, int(data[0])))
+            for table in ['users', 'users_info_open', 'users_info_close', 'users_groups', 'users_posts', 'results']:
+                await curr.executemany(f'DELETE FROM {table} WHERE user_id = ?', rows)
+
+    async def save_collected_batch(self, users: list = None, open_profiles: list = None, close_profiles: list = None,
+                                   groups: list = None, walls: list = None, to_remove: list = None):
+        """
+        Записывает пачку собранных данных одной транзакцией с одним сохранением на всю пачку.
+        Либо записывается вся пачка, либо (при ошибке) ничего из неё, так что у профиля не может быть
+        записи в users без записи в таблице с его информацией - такие профили легко найти и перепроверить
+        :param users: Кортежи для таблицы users
+        :param open_profiles: Кортежи для таблицы users_info_open
+        :param close_profiles: Кортежи для таблицы users_info_close
+        :param groups: Строки для таблицы users_groups
+        :param walls: Строки для таблицы users_posts
+        :param to_remove: id профилей, которые нужно удалить из всех таблиц для перепроверки
+        """
+        await self.save_collected_batches([{'users': users, 'open_profiles': open_profiles,
+                                            'close_profiles': close_profiles, 'groups': groups,
+                                            'walls': walls, 'to_remove': to_remove}])
+
+    async def save_collected_batches(self, batches: list[dict]):
+        """
+        Записывает несколько пачек (словарей с аргументами save_collected_batch) по порядку одной транзакцией
+        """
+        async with self.write_lock:
+            start = time.perf_counter()
+            try:
+                for batch in batches:
+                    if batch.get('to_remove'):
+                        await self.remove_many_from_all_tables(batch['to_remove'])
+                    if batch.get('users'):
+                        await self.save_users_results(batch['users'])
+                    if batch.get('open_profiles'):
+                        await self.save_open_profiles_data(batch['open_profiles'])
+                    if batch.get('close_profiles'):
+                        await self.save_close_profiles_data(batch['close_profiles'])
+                    if self.cache_file is not None:
+                        await self.save_to_cache(batch)
+                    if batch.get('groups'):
+                        await self.save_groups_data(batch['groups'])
+                    if batch.get('walls'):
+                        await self.save_walls_data(batch['walls'])
+                await self.session.commit()
+            except BaseException:
+                await self.session.rollback()
+                raise
+            METRICS.observe('db_commit_seconds', time.perf_counter() - start, buckets=DB_BUCKETS)
+            METRICS.inc('db_batches_total', len(batches))
+
+            # В хранилище признаков только то, что уже точно есть в БД
+            if self.feature_stores is not None:
+                for is_close, key in [(False, 'open_profiles'), (True, 'close_profiles')]:
+                    self.feature_stores[is_close].append([row for batch in batches for row in batch.get(key) or []])
 
-    async def save_wall_data(self, data):
-        """Сохраняет упорядоченные данные о постах профиля в БД"""
+    # ========== КЭШ ПРОФИЛЕЙ ==========
+    async def create_cache_tables(self):
+        """Создает таблицы кэша с теми же колонками, что и у таблиц этой БД. Время сбора хранится в cache.users"""
         async with self.session.cursor() as curr:
-            await curr.execute(
-                f'INSERT INTO users_posts VALUES({", ".join(["?" for _ in range(22)])})', data)
+            await curr.execute("""
+                CREATE TABLE IF NOT EXISTS cache.users
+                (
+                    user_id INTEGER PRIMARY KEY,
+                    deactivated INTEGER,
+                    is_close INTEGER,
+                    fetched_at REAL --Когда профиль был собран (unix время)
+                )
+                """)
+            await curr.execute('CREATE INDEX IF NOT EXISTS cache.users_fetched_at ON users (fetched_at)')
+            for table in CACHE_TABLES:
+                await curr.execute(f'PRAGMA main.table_info({table})')
+                columns = [f'{column[1]} {column[2]}' for column in await curr.fetchall()]
+                await curr.execute(f'CREATE TABLE IF NOT EXISTS cache.{table} '
+                                   f'({columns[0]} PRIMARY KEY, {", ".join(columns[1:])})')
+            await self.session.commit()
+
+    async def save_to_cache(self, batch: dict):
+        """Записывает профили из пачки (save_collected_batch) в кэш, БЕЗ сохранения БД"""
+        fetched_at = time.time()
+        async with self.session.cursor() as curr:
+            if batch.get('to_remove'):
+                for table in ['users'] + CACHE_TABLES:
+                    await curr.executemany(f'DELETE FROM cache.{table} WHERE user_id = ?',
+                                           [(int(profile_id), ) for profile_id in batch['to_remove']])
+            if batch.get('users'):
+                await curr.executemany('INSERT OR REPLACE INTO cache.users VALUES (?, ?, ?, ?)',
+                                       [(*row, fetched_at) for row in batch['users']])
+            for table, key in zip(CACHE_TABLES, ['open_profiles', 'close_profiles']):
+                if batch.get(key):
+                    await curr.executemany(
+                        f'INSERT OR REPLACE INTO cache.{table} VALUES ({", ".join("?" * len(batch[key][0]))})',
+                        batch[key])
+
+    async def fill_from_cache(self, ttl: float) -> int:
+        """
+        Переносит из кэша в эту БД профили из input_ids (load_input_ids), которых в ней еще нет,
+        а в кэше они собраны не раньше ttl секунд назад. Такие профили не нужно собирать заново
+        :return: Сколько профилей взято из кэша
+        """
+        async with self.session.cursor() as curr:
+            await curr.execute('CREATE TEMP TABLE IF NOT EXISTS cached_ids (user_id INTEGER PRIMARY KEY)')
+            await curr.execute('DELETE FROM cached_ids')
+
+            # Только профили с полной информацией: удаленные или с записью в таблице информации
+            await curr.execute("""
+                INSERT INTO cached_ids
+                SELECT c.user_id FROM input_ids i
+                JOIN cache.users c ON c.user_id = i.user_id
+                WHERE c.fetched_at >= ?
+                    AND NOT EXISTS (SELECT 1 FROM main.users u WHERE u.user_id = c.user_id)
+                    AND (c.deactivated = 1
+                         OR EXISTS (SELECT 1 FROM cache.users_info_open o WHERE o.user_id = c.user_id)
+                         OR EXISTS (SELECT 1 FROM cache.users_info_close l WHERE l.user_id = c.user_id))
+                """, (time.time() - ttl, ))
+
+            await curr.execute("""
+                INSERT INTO main.users (user_id, deactivated, is_close)
+                SELECT c.user_id, c.deactivated, c.is_close FROM cache.users c
+                JOIN cached_ids USING (user_id)
+                """)
+            for table in CACHE_TABLES:
+                await curr.execute(f'INSERT OR IGNORE INTO main.{table} '
+                                   f'SELECT c.* FROM cache.{table} c JOIN cached_ids USING (user_id)')
+            await self.session.commit()
+
+            await curr.execute('SELECT COUNT(*) FROM cached_ids')
+            return (await curr.fetchone())[0]
+
+    async def evict_cache(self, ttl: float, max_profiles: int) -> int:
+        """
+        Удаляет из кэша профили старше ttl секунд, а если профилей больше max_profiles, то и самые старые из них
+        :return: Сколько профилей удалено
+        """
+        async with self.session.cursor() as curr:
+            await curr.execute('DELETE FROM cache.users WHERE fetched_at < ?', (time.time() - ttl, ))
+            removed = curr.rowcount
+            await curr.execute("""
+                DELETE FROM cache.users WHERE user_id IN
+                (SELECT user_id FROM cache.users ORDER BY fetched_at DESC LIMIT -1 OFFSET ?)
+                """, (max_profiles, ))
+            removed += curr.rowcount
+
+            if removed > 0:
+                for table in CACHE_TABLES:
+                    await curr.execute(f'DELETE FROM cache.{table} WHERE NOT EXISTS '
+                                       f'(SELECT 1 FROM cache.users c WHERE c.user_id = cache.{table}.user_id)')
+            await self.session.commit()
+            return removed
+
+    async def flush(self):
+        """Запись идет напрямую в БД, так что все записанное уже в ней. Нужен для совместимости с QueueWriter"""
+        return
 
     async def remove_from_all_tables(self, profile_id):
         """Удаляет пользователя из всех таблиц в БД для его переопределения"""
@@ -216,6 +603,10 @@ class DatabaseManager:
                 """
             )
 
+            # Удаленные из таблиц признаков профили. Колоночное хранилище признаков (FeatureStore) по ним понимает,
+            # что признаки профиля устарели, как бы он ни был удален (перепроверка, повторный сбор и т.д.)
+            await curr.execute('CREATE TABLE IF NOT EXISTS features_removed (user_id INTEGER, is_close INTEGER)')
+
             # Таблица информации о группах открытых пользователей
             await curr.execute(
                 """
@@ -256,10 +647,21 @@ class DatabaseManager:
                 CREATE TABLE IF NOT EXISTS results
                 (
                     user_id INTEGER PRIMARY KEY,
-                    bot_prob REAL --Вероятность того, что профиль - бот
+                    bot_prob REAL, --Вероятность того, что профиль - бот
+                    model_checksum TEXT --Контрольная сумма модели, которая посчитала bot_prob
                 );
                 """
             )
 
+            # В БД от старых версий нет колонки с контрольной суммой модели, добавляем её
+            await curr.execute('PRAGMA table_info(results)')
+            if 'model_checksum' not in [column[1] for column in await curr.fetchall()]:
+                await curr.execute('ALTER TABLE results ADD COLUMN model_checksum TEXT')
+
             # И запись изменений на диск
             await self.session.commit()
+
+        if self.feature_stores is not None:
+            await self.track_removed_features(True)
+        if self.cache_file is not None:
+            await self.create_cache_tables()
@@ -0,0 +1,98 @@
+import asyncio
+import queue
+
+from src.bot_detector.database import DatabaseManager
+
+
+class QueueWriter:
+    def __init__(self, write_queue, applied, lane_id: int):
+        """
+        Заменяет запись в БД для сборщика из отдельного процесса:
+        вместо записи в БД пачки отправляются единственному процессу-писателю (writer_process).
+        Создается один раз на процесс сбора и передается во все его AIOInfoGrabber
+        :param write_queue: Очередь multiprocessing, которую читает процесс-писатель
+        :param applied: Общий словарь (Manager().dict()) с количеством записанных пачек по каждому сборщику
+        :param lane_id: Номер сборщика
+        """
+        self.write_queue = write_queue
+        self.applied = applied
+        self.lane_id = lane_id
+        self.sent = 0   # Сколько пачек отправлено писателю
+
+    async def save_collected_batch(self, **batch) -> None:
+        """Отправляет пачку писателю. Если очередь писателя заполнена, то ждет, пока в ней появится место"""
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self._put, (self.lane_id, batch))
+        self.sent += 1
+
+    def _put(self, message: tuple) -> None:
+        """Кладет сообщение в очередь писателя, а если писатель упал - выдает ошибку, а не ждет вечно"""
+        while True:
+            self._check_writer()
+            try:
+                self.write_queue.put(message, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+    def _check_writer(self) -> None:
+        if 'error' in self.applied:
+            # Писатель уже не заберет пачки из очереди, так что при выходе процесс не должен ждать их отправки
+            self.write_queue.cancel_join_thread()
+            raise RuntimeError(f'Процесс записи в БД завершился с ошибкой: {self.applied["error"]}')
+
+    async def flush(self) -> None:
+        """Ждет, пока писатель запишет в БД все отправленные этим сборщиком пачки"""
+        while self.applied.get(self.lane_id, 0) < self.sent:
+            self._check_writer()
+            await asyncio.sleep(0.05)
+
+
+async def write_loop(db_file: str, write_queue, applied, max_batches: int = 50, cache_file: str | None = None,
+                     feature_folder: str | None = None) -> None:
+    """
+    Забирает пачки из очереди и записывает их в БД. Все, что накопилось в очереди (до max_batches пачек),
+    записывается одной транзакцией. Заканчивает работу, когда получает из очереди None.
+    Если указан cache_file, то профили записываются еще и в общий кэш профилей,
+    а если feature_folder - то их признаки еще и в колоночное хранилище признаков
+    """
+    db = DatabaseManager(db_file, cache_file, feature_folder)
+    await db.connect()
+    await db.create_tables()
+
+    loop = asyncio.get_running_loop()
+    finished = False
+    try:
+        while not finished:
+            messages = [await loop.run_in_executor(None, write_queue.get)]
+            while len(messages) < max_batches and messages[-1] is not None:
+                try:
+                    messages.append(write_queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            if messages[-1] is None:
+                finished = True
+                messages.pop()
+            if len(messages) == 0:
+                continue
+
+            await db.save_collected_batches([batch for _, batch in messages])
+
+            # Отмечаем, сколько пачек каждого сборщика уже в БД
+            lanes_count = {}
+            for lane_id, _ in messages:
+                lanes_count[lane_id] = lanes_count.get(lane_id, 0) + 1
+            for lane_id, count in lanes_count.items():
+                applied[lane_id] = applied.get(lane_id, 0) + count
+    except Exception as error:
+        applied['error'] = repr(error)  # Чтобы сборщики не ждали записи вечно
+        raise
+    finally:
+        await db.close()
+
+
+def writer_process(db_file: str, write_queue, applied, cache_file: str | None = None,
+                   feature_folder: str | None = None) -> None:
+    """Процесс, который единственный пишет в БД, пока сборщики в других процессах работают с сетью"""
+    asyncio.run(write_loop(db_file, write_queue, applied, cache_file=cache_file, feature_folder=feature_folder))
@@ -0,0 +1,133 @@
+import os
+
+import numpy as np
+from numpy.lib.format import open_memmap
+
+FEATURES_NUMBER = {False: 45, True: 16}     # Признаков у открытого и закрытого профиля (без id)
+COMPACT_CHUNK_SIZE = 100000                 # По сколько строк переписывать при сжатии хранилища
+
+
+class FeatureStore:
+    def __init__(self, data_folder: str, is_close: bool):
+        """
+        Колоночное хранилище признаков одной таблицы (users_info_open или users_info_close) рядом с БД.
+        Основное хранилище - два .npy файла: id по возрастанию и матрица признаков float32 в том же порядке.
+        Сборщик дописывает новые строки пачками в конец журнала (сырые id и признаки), а перед анализом журнал
+        сливается с основным хранилищем (compact). Анализ открывает хранилище через memmap и отдает нейросети
+        срезы без копирования, так что чтение признаков всех профилей - один последовательный проход по файлу.
+        Источник правды - по-прежнему БД, хранилище только повторяет её таблицы признаков
+        :param data_folder: Папка с БД
+        :param is_close: Признаки закрытых или открытых профилей
+        """
+        name = 'close' if is_close else 'open'
+        self.is_close = is_close
+        self.width = FEATURES_NUMBER[is_close]
+        self.ids_file = os.path.join(data_folder, f'features_{name}_ids.npy')
+        self.features_file = os.path.join(data_folder, f'features_{name}.npy')
+        self.ids_log = os.path.join(data_folder, f'features_{name}_ids.log')
+        self.features_log = os.path.join(data_folder, f'features_{name}.log')
+
+    def exists(self) -> bool:
+        """Есть ли у хранилища файлы на диске (основное хранилище или журнал)"""
+        return any(os.path.exists(file)
+                   for file in [self.ids_file, self.features_file, self.ids_log, self.features_log])
+
+    def append(self, rows: list[tuple]) -> None:
+        """
+        Дописывает пачку строк таблицы признаков (id, признаки...) в конец журнала.
+        Сначала пишутся признаки, потом id, так что прерванная запись оставляет лишь хвост без id, который не читается
+        """
+        if len(rows) == 0:
+            return
+        ids = np.array([row[0] for row in rows], dtype=np.int64)
+        features = np.array([row[1:] for row in rows], dtype=np.float32)
+        with open(self.features_log, 'ab') as file:
+            file.write(features.tobytes())
+        with open(self.ids_log, 'ab') as file:
+            file.write(ids.tobytes())
+
+    def read_log(self) -> tuple[np.ndarray, np.ndarray]:
+        """id и признаки из журнала в порядке записи, признаки не загружаются в память (memmap)"""
+        if not os.path.exists(self.ids_log) or not os.path.exists(self.features_log):
+            return np.empty(0, dtype=np.int64), np.empty((0, self.width), dtype=np.float32)
+
+        row_size = self.width * np.dtype(np.float32).itemsize
+        rows = min(os.path.getsize(self.ids_log) // 8, os.path.getsize(self.features_log) // row_size)
+        if rows == 0:
+            return np.empty(0, dtype=np.int64), np.empty((0, self.width), dtype=np.float32)
+        ids = np.fromfile(self.ids_log, dtype=np.int64, count=rows)
+        features = np.memmap(self.features_log, dtype=np.float32, mode='r', shape=(rows, self.width))
+        return ids, features
+
+    def open(self) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Основное хранилище через memmap: id по возрастанию и их признаки.
+        Признаки открываются на копирование при записи, так что срезы можно отдавать в torch без предупреждений,
+        а файл при этом не меняется. Если хранилища нет или оно повреждено, то оно пустое
+        """
+        empty = np.empty(0, dtype=np.int64), np.empty((0, self.width), dtype=np.float32)
+        if not os.path.exists(self.ids_file) or not os.path.exists(self.features_file):
+            return empty
+        ids = np.load(self.ids_file, mmap_mode='r')
+        features = np.load(self.features_file, mmap_mode='c')
+        if features.shape != (len(ids), self.width):
+            return empty    # Например, сжатие прервалось между заменой двух файлов
+        return ids, features
+
+    def compact(self, table_ids: np.ndarray, removed_ids: np.ndarray) -> None:
+        """
+        Сливает журнал с основным хранилищем. Если у профиля несколько строк, то остается последняя записанная.
+        Профили, удаленные из БД после прошлого сжатия, выбрасываются целиком (их новые признаки нужно дописать
+        в журнал из БД заново), а остаются только профили, которые есть в таблице БД
+        :param table_ids: Все id таблицы признаков в БД
+        :param removed_ids: id, удаленные из таблицы признаков после прошлого сжатия
+        """
+        ids, features = self.open()
+        log_ids, log_features = self.read_log()
+        if len(log_ids) == 0 and len(removed_ids) == 0 and np.array_equal(ids, table_ids):
+            return
+
+        # Последняя строка каждого id: np.unique по перевернутому массиву находит первое вхождение с конца
+        all_ids = np.concatenate([ids, log_ids])
+        unique_ids, first_from_end = np.unique(all_ids[::-1], return_index=True)
+        sources = len(all_ids) - 1 - first_from_end
+        keep = np.isin(unique_ids, table_ids, assume_unique=True) & ~np.isin(unique_ids, removed_ids)
+        unique_ids, sources = unique_ids[keep], sources[keep]
+
+        # Новое хранилище пишется кусками во временные файлы, так что в памяти не бывает всей матрицы признаков
+        new_features = open_memmap(f'{self.features_file}.tmp', mode='w+', dtype=np.float32,
+                                   shape=(len(unique_ids), self.width))
+        for start in range(0, len(sources), COMPACT_CHUNK_SIZE):
+            chunk = sources[start:start + COMPACT_CHUNK_SIZE]
+            from_store = chunk < len(ids)
+            block = np.empty((len(chunk), self.width), dtype=np.float32)
+            block[from_store] = features[chunk[from_store]]
+            block[~from_store] = log_features[chunk[~from_store] - len(ids)]
+            new_features[start:start + len(chunk)] = block
+        new_features.flush()
+        del new_features, ids, features, log_features   # Под Windows файл с открытым memmap нельзя заменить
+
+        with open(f'{self.ids_file}.tmp', 'wb') as file:
+            np.save(file, unique_ids)
+        os.replace(f'{self.features_file}.tmp', self.features_file)
+        os.replace(f'{self.ids_file}.tmp', self.ids_file)
+        for log_file in [self.ids_log, self.features_log]:
+            if os.path.exists(log_file):
+                os.remove(log_file)
+
+    def batches(self, ids_to_analyse: np.ndarray, batch_size: int):
+        """
+        Генератор пачек (id, признаки) для нейросети. Подряд идущие профили отдаются срезом memmap без копирования,
+        а остальные (если часть профилей уже проанализирована) - выборкой по индексам
+        :param ids_to_analyse: id по возрастанию, все они должны быть в хранилище
+        :param batch_size: Сколько профилей в пачке
+        """
+        ids, features = self.open()
+        positions = np.searchsorted(ids, ids_to_analyse)
+        for start in range(0, len(positions), batch_size):
+            chunk = positions[start:start + batch_size]
+            if chunk[-1] - chunk[0] + 1 == len(chunk):
+                batch = features[chunk[0]:chunk[-1] + 1]
+            else:
+                batch = features[chunk]
+            yield ids_to_analyse[start:start + batch_size].tolist(), batch
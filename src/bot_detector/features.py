@@ -0,0 +1,116 @@
+import numpy as np
+
+EMPTY_VALUES = [None, '', [], 0]    # Правила, по которым считается, что параметра у пользователя нет
+
+
+def users_features(users: list[dict], fillers_list: list, counters_list: list) -> list[tuple]:
+    """
+    Признаки профилей пользователей сразу для всего ответа API
+    :param users: JSON информация о пользователях (не удаленных, только открытых или только закрытых)
+    :param fillers_list: Список заполнителей (поля у которых нет четкой структуры (например - статус))
+    :param counters_list: Список счетчиков
+    :return: Кортежи для записи в БД: id, заполнители, заполненность профиля,
+        пары (есть ли счетчик, сам счетчик), заполненность счетчиков
+    """
+    if len(users) == 0:
+        return []
+
+    # === ЗАПОЛНИТЕЛИ ===
+    # Какие заполнители есть у профиля, последний - менялся ли screen_name (0, если он стандартный)
+    fillers = np.array([[0 if user.get(filler) in EMPTY_VALUES else 1 for filler in fillers_list] +
+                        [0 if user['screen_name'] == 'id' + str(user['id']) else 1] for user in users],
+                       dtype=np.int64)
+    profile_fullness = fillers.mean(axis=1)    # Насколько заполнен профиль
+
+    # === СЧЕТЧИКИ ===
+    # У некоторых профилей вообще нет счетчиков, как так - без понятия. Тогда все счетчики 0
+    counters_dicts = [user.get('counters') or {} for user in users]
+    values = np.array([[counters.get(counter) or 0 for counter in counters_list] for counters in counters_dicts],
+                      dtype=np.int64)
+    haves = (values != 0).astype(np.int64)
+    counters_fullness = haves.mean(axis=1)     # На сколько заполнены счетчики
+
+    # Объединяем в структуру типа [есть ли счетчик1, сам счетчик1, есть ли счетчик2, сам счетчик2, ...]
+    counters = np.empty((len(users), 2 * len(counters_list)), dtype=np.int64)
+    counters[:, 0::2] = haves
+    counters[:, 1::2] = values
+
+    # Собираем всё в единые кортежи, главное - сохранить порядок
+    return [(user['id'], *user_fillers, fullness, *user_counters, user_counters_fullness)
+            for user, user_fillers, fullness, user_counters, user_counters_fullness
+            in zip(users, fillers.tolist(), profile_fullness.tolist(), counters.tolist(),
+                   counters_fullness.tolist())]
+
+
+def groups_features(groups: list[list]) -> list[list]:
+    """
+    Признаки групп профилей сразу для всего ответа API.
+    На каждую группу приходится всего пара сравнений, так что обычный проход быстрее, чем перекладывать
+    группы в массивы NumPy
+    :param groups: Ответы execute.groups_info по профилям: [id, {count, items}]
+    :return: Строки для записи в БД: id, кол-во групп, с фото, закрытых, страниц, групп
+    """
+    rows = []
+    for user_groups in groups:
+        with_photo = closed_groups = type_page = type_group = 0
+        for item in user_groups[1]['items']:
+            with_photo += item.get('has_photo', 0)
+            closed_groups += item['is_closed']
+            if item['type'] == 'group':
+                type_group += 1
+            elif item['type'] == 'page':
+                type_page += 1
+        rows.append([int(user_groups[0]), user_groups[1]['count'], with_photo, closed_groups, type_page, type_group])
+    return rows
+
+
+def counter_stats(counter: list) -> list:
+    """min, max, mean и median за одну сортировку (список сортируется на месте)"""
+    if len(counter) == 0:
+        return [0, 0, 0, 0]
+    counter.sort()
+    length = len(counter)
+    # Как statistics.median: при нечетной длине - средний элемент как есть, при четной - среднее двух средних
+    median = counter[length // 2] if length % 2 else (counter[length // 2 - 1] + counter[length // 2]) / 2
+    return [counter[0], counter[-1], sum(counter) / length, median]
+
+
+def walls_features(walls: list[list]) -> list[list]:
+    """
+    Признаки стен профилей сразу для всего ответа API. Каждый пост просматривается один раз,
+    а min, max, mean и median счетчиков считаются за одну сортировку вместо statistics.fmean и median
+    :param walls: Ответы execute.walls_info по профилям: [id, {count, items}]
+    :return: Строки для записи в БД: id, кол-во постов, доля постов, доля репостов, максимальный id поста,
+        (min, max, mean, median) комментариев, лайков, просмотров и репостов, доля постов с текстом
+    """
+    rows = []
+    for wall in walls:
+        items = wall[1]['items']
+        reposts = 0                 # Кол-во репостов
+        max_id = wall[1]['count']   # Максимальный id с удаленными
+        posts_with_text = 0         # Кол-во постов с текстом
+        comments_counter, likes_counter, views_counter, reposts_counter = [], [], [], []
+
+        for item in items:
+            max_id = max(item['id'], max_id)    # Смотрим есть ли удаленные посты
+            if 'copy_history' in item:          # Определяем репост это или нет
+                reposts += 1
+            if 'comments' in item:
+                comments_counter.append(item['comments']['count'])
+            if 'likes' in item:
+                likes_counter.append(item['likes']['count'])
+            if 'views' in item:                 # Просмотры есть не всегда
+                views_counter.append(item['views']['count'])
+            if 'reposts' in item:
+                reposts_counter.append(item['reposts']['count'])
+            if item['text'].strip() != '':
+                posts_with_text += 1
+
+        # Кол-во постов в ответе (если их всего больше 100, то и здесь обычно 100)
+        posts_in_response = len(items) if len(items) != 0 else 1
+        rows.append([int(wall[0]), wall[1]['count'], (len(items) - reposts) / posts_in_response,
+                     reposts / posts_in_response, max_id,
+                     *counter_stats(comments_counter), *counter_stats(likes_counter),
+                     *counter_stats(views_counter), *counter_stats(reposts_counter),
+                     posts_with_text / posts_in_response])
+    return rows
@@ -1,80 +1,198 @@
+import os
+import csv
 import asyncio
 
-import pandas as pd
+import openpyxl
 
 from src.bot_detector.database import DatabaseManager
 
 
-async def build_output_file(data_folder: str, sheet_dict: dict, output_folder: str, original_file_name: str):
-    """Создает выходной .xlsx файл"""
-    output_file = fr'{output_folder}\{original_file_name} Прогноз.xlsx'
+EXCEL_MAX_ROWS = 1048576     # Максимум строк на листе Excel, включая заголовок
+EXCEL_MAX_SHEET_NAME = 31    # Максимальная длина имени листа Excel
+OUTPUT_HEADER = ['ID', 'Значение', 'Статус']
+
+
+def result_row(user_id: int, bot_prob: float | None) -> list:
+    """Строка выходного файла: id, вероятность бота и статус. Если результата нет, значит профиль удален"""
+    if bot_prob is None:
+        return [user_id, 1, 'Удален']
+    return [user_id, bot_prob, '']
 
-    db = DatabaseManager(fr'{data_folder}\data.db')
+
+class XlsxResultWriter:
+    """
+    Пишет .xlsx в режиме write_only: строки сразу уходят во временные файлы листов, и книга целиком в памяти
+    не собирается. Если на лист не помещаются все строки, то продолжение идет на листе "<имя> (2)" и т.д.
+    """
+    extension = 'xlsx'
+
+    def __init__(self, output_file: str):
+        self.output_file = output_file
+        self.workbook = openpyxl.Workbook(write_only=True)
+        self.sheet = None
+        self.sheet_name = ''
+        self.sheet_part = 0
+        self.sheet_rows = 0
+
+    def start_sheet(self, sheet_name: str) -> None:
+        self.sheet_name = sheet_name
+        self.sheet_part = 0
+        self._new_sheet()
+
+    def _new_sheet(self) -> None:
+        self.sheet_part += 1
+        suffix = '' if self.sheet_part == 1 else f' ({self.sheet_part})'
+        self.sheet = self.workbook.create_sheet(f'{self.sheet_name[:EXCEL_MAX_SHEET_NAME - len(suffix)]}{suffix}')
+        self.sheet.append(OUTPUT_HEADER)
+        self.sheet_rows = 1
+
+    def write_rows(self, rows: list[tuple]) -> None:
+        for user_id, bot_prob in rows:
+            if self.sheet_rows == EXCEL_MAX_ROWS:
+                self._new_sheet()
+            row = result_row(user_id, bot_prob)
+            row[0] = str(row[0])    # Иначе Excel покажет длинные id в экспоненциальной записи
+            self.sheet.append(row)
+            self.sheet_rows += 1
+
+    def close(self) -> None:
+        self.workbook.save(self.output_file)
+
+
+class CsvResultWriter:
+    """Пишет все листы в один .csv с колонкой листа. Ограничения на количество строк нет"""
+    extension = 'csv'
+
+    def __init__(self, output_file: str):
+        # utf-8-sig, чтобы Excel сам понял кодировку при открытии
+        self.file = open(output_file, 'w', encoding='utf-8-sig', newline='')
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(['Лист'] + OUTPUT_HEADER)
+        self.sheet_name = ''
+
+    def start_sheet(self, sheet_name: str) -> None:
+        self.sheet_name = sheet_name
+
+    def write_rows(self, rows: list[tuple]) -> None:
+        self.writer.writerows([self.sheet_name] + result_row(user_id, bot_prob) for user_id, bot_prob in rows)
+
+    def close(self) -> None:
+        self.file.close()
+
+
+class ParquetResultWriter:
+    """Пишет все листы в один .parquet с колонкой листа, каждая пачка строк - отдельная группа строк файла"""
+    extension = 'parquet'
+
+    def __init__(self, output_file: str):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise ImportError('Для вывода в .parquet нужен пакет pyarrow: pip install pyarrow') from None
+
+        self.pyarrow = pyarrow
+        self.schema = pyarrow.schema([('Лист', pyarrow.string()), ('ID', pyarrow.int64()),
+                                      ('Значение', pyarrow.float64()), ('Статус', pyarrow.string())])
+        self.writer = pyarrow.parquet.ParquetWriter(output_file, self.schema)
+        self.sheet_name = ''
+
+    def start_sheet(self, sheet_name: str) -> None:
+        self.sheet_name = sheet_name
+
+    def write_rows(self, rows: list[tuple]) -> None:
+        rows = [result_row(user_id, bot_prob) for user_id, bot_prob in rows]
+        self.writer.write_table(self.pyarrow.Table.from_arrays([
+            self.pyarrow.array([self.sheet_name] * len(rows), self.pyarrow.string()),
+            self.pyarrow.array([row[0] for row in rows], self.pyarrow.int64()),
+            self.pyarrow.array([row[1] for row in rows], self.pyarrow.float64()),
+            self.pyarrow.array([row[2] for row in rows], self.pyarrow.string()),
+        ], schema=self.schema))
+
+    def close(self) -> None:
+        self.writer.close()
+
+
+OUTPUT_WRITERS = {writer.extension: writer for writer in [XlsxResultWriter, CsvResultWriter, ParquetResultWriter]}
+
+
+async def build_output_file(data_folder: str, sheet_dict: dict, output_folder: str, original_file_name: str,
+                            output_format: str = 'xlsx'):
+    """
+    Создает выходной файл. Результаты соединяются с id листов запросом к БД и пишутся в файл пачками,
+    так что в памяти не держатся ни все результаты, ни весь выходной файл
+    :param output_format: Формат выходного файла: 'xlsx', 'csv' или 'parquet'
+    """
+    writer_class = OUTPUT_WRITERS[output_format]
+    output_file = os.path.join(output_folder, f'{original_file_name} Прогноз.{writer_class.extension}')
+
+    db = DatabaseManager(os.path.join(data_folder, 'data.db'))
     await db.connect()
     await db.create_tables()
-
-    results = await db.get_result_data()
-
-    # Преобразуем список с результатами в словарь
-    value_dict = {item[0]: item[1] for item in results}
-
-    with pd.ExcelWriter(output_file, engine="openpyxl") as writer:
-        for sheet_name, id_list in sheet_dict.items():
-            # Создаем данные для листа в нужном порядке
-            sheet_data = []
-            for item_id in id_list:
-                # Если ID есть в данных - добавляем значение, иначе NaN
-                value = value_dict.get(item_id, None)
-                if value is None:
-                    sheet_data.append([str(item_id), 1, 'Удален'])
-                else:
-                    sheet_data.append([str(item_id), value, ''])
-
-            # Создаем DataFrame
-            df = pd.DataFrame(sheet_data, columns=["ID", "Значение", "Статус"])
-
-            # Записываем на лист
-            df.to_excel(writer, sheet_name=sheet_name, index=False)
-
-    await db.close()
-
-
-async def build_statistic_file(data_folder: str, sheet_dict: dict, output_folder: str, original_file_name: str):
-    """Создает .txt файл со статистикой по ботам"""
-    output_file = fr'{output_folder}\{original_file_name} Статистика.txt'
-
-    db = DatabaseManager(fr'{data_folder}\data.db')
+    await db.load_sheet_ids(sheet_dict)
+
+    writer = writer_class(output_file)
+    try:
+        for sheet_number, sheet_name in enumerate(sheet_dict.keys()):
+            writer.start_sheet(sheet_name)
+            async for rows in db.get_sheet_results(sheet_number):
+                writer.write_rows(rows)
+    finally:
+        writer.close()
+        await db.close()
+
+
+async def build_statistic_file(data_folder: str, sheet_dict: dict, output_folder: str, original_file_name: str,
+                               thresholds: list[float] = None, buckets: int = 10):
+    """
+    Создает .txt файл со статистикой по ботам. Все считается в БД одним запросом по всем листам и порогам
+    :param thresholds: Пороги вероятности, с которых профиль считается ботом (по умолчанию 0.5)
+    :param buckets: На сколько частей делить вероятность для гистограммы
+    """
+    output_file = os.path.join(output_folder, f'{original_file_name} Статистика.txt')
+    thresholds = [0.5] if not thresholds else thresholds
+
+    db = DatabaseManager(os.path.join(data_folder, 'data.db'))
     await db.connect()
     await db.create_tables()
+    await db.load_sheet_ids(sheet_dict)
 
-    results = await db.get_result_data()
-
-    # Преобразуем список с результатами в словарь
-    value_dict = {item[0]: item[1] for item in results}
+    statistics = await db.get_sheet_statistics(thresholds, buckets)
 
     with open(output_file, 'w', encoding='utf-8') as file:
-        for sheet_name, id_list in sheet_dict.items():
-            ids_number = len(id_list)
-            if ids_number == 0:
+        for sheet_number, sheet_name in enumerate(sheet_dict.keys()):
+            sheet = statistics.get(sheet_number)
+            if sheet is None:
                 file.write(f'{sheet_name} -\tАккаунты: 0,\tБоты: 0,\tОтношение: 0.0\n')
                 continue
 
-            bots = 0
-            for item_id in id_list:
-                value = value_dict.get(item_id, 1.0)
-                if value >= 0.5:
-                    bots += 1
+            ids_number = sheet['accounts']
+            bots = sheet['bots'][0]
             file.write(
-                f'{sheet_name} -\tАккаунты: {ids_number},\tБоты: {bots},\tОтношение: {round(bots/ids_number, 4)}')
+                f'{sheet_name} -\tАккаунты: {ids_number},\tБоты: {bots},\tОтношение: {round(bots/ids_number, 4)}\n')
+
+            for threshold, bots in zip(thresholds[1:], sheet['bots'][1:]):
+                file.write(f'\tПорог {threshold} -\tБоты: {bots},\tОтношение: {round(bots/ids_number, 4)}\n')
+
+            mean = 'нет' if sheet['mean'] is None else round(sheet['mean'], 4)
+            file.write(f'\tСредняя вероятность: {mean},\t'
+                       f'Удаленные: {round(sheet["deleted"] / ids_number, 4)},\t'
+                       f'Закрытые: {round(sheet["closed"] / ids_number, 4)}\n')
+
+            histogram = ', '.join(f'{bucket / buckets:g}-{(bucket + 1) / buckets:g}: {count}'
+                                  for bucket, count in enumerate(sheet['histogram']))
+            file.write(f'\tГистограмма: {histogram}\n')
 
     await db.close()
 
 
-def create_output_file(data_folder: str, sheet_dict: dict, output_folder: str, original_file_name: str):
-    print('[INFO] Собираем выходной .xlsx файл')
-    asyncio.run(build_output_file(data_folder, sheet_dict, output_folder, original_file_name))
+def create_output_file(data_folder: str, sheet_dict: dict, output_folder: str, original_file_name: str,
+                       output_format: str = 'xlsx'):
+    print(f'[INFO] Собираем выходной .{output_format} файл')
+    asyncio.run(build_output_file(data_folder, sheet_dict, output_folder, original_file_name, output_format))
 
 
-def create_statistic_file(data_folder: str, sheet_dict: dict, output_folder: str, original_file_name: str):
+def create_statistic_file(data_folder: str, sheet_dict: dict, output_folder: str, original_file_name: str,
+                          thresholds: list[float] = None):
     print('[INFO] Собираем файл статистики')
-    asyncio.run(build_statistic_file(data_folder, sheet_dict, output_folder, original_file_name))
+    asyncio.run(build_statistic_file(data_folder, sheet_dict, output_folder, original_file_name, thresholds))
@@ -1,81 +1,258 @@
-import pandas as pd
-import openpyxl
+import re
+import time
+import zipfile
+import posixpath
+from array import array
+from itertools import islice
+from xml.etree import ElementTree
 
+import numpy as np
 
-def txt_parser(file_path: str) -> tuple[list, dict]:
+TXT_CHUNK_SIZE = 4 * 1024 * 1024      # По сколько байт читать .txt файл
+TXT_INVALID_EXAMPLES = 5               # Сколько неправильных строк показать в предупреждении
+
+# Строка с одним id: 123, id123 или ссылка на профиль (https://vk.com/id123). Перенос строки \n или \r\n.
+# Ссылка без id перед числом (vk.com/123) - это не профиль, а, например, группа, такие строки не берутся
+TXT_ID_PATTERN = re.compile(rb'^(?:\xef\xbb\xbf)?[ \t]*(?:(?:(?:https?://)?(?:m\.)?vk\.com/)?id)?(\d{1,18})[ \t]*\r?$',
+                            re.MULTILINE)
+TXT_NOT_EMPTY_PATTERN = re.compile(rb'^[ \t\r]*\S', re.MULTILINE)
+TXT_MAX_ID_DIGITS = 18                  # Больше цифр в int64 может не поместиться
+
+# Какие байты могут быть в куске, который состоит только из числовых id
+PLAIN_ID_BYTES = np.zeros(256, dtype=bool)
+PLAIN_ID_BYTES[list(b'0123456789\n')] = True
+
+# Пространства имен xml внутри .xlsx
+XLSX_MAIN_NS = '{http://schemas.openxmlformats.org/spreadsheetml/2006/main}'
+XLSX_RELATIONS_NS = '{http://schemas.openxmlformats.org/officeDocument/2006/relationships}'
+XLSX_PACKAGE_NS = '{http://schemas.openxmlformats.org/package/2006/relationships}'
+XLSX_ROW_TAG = f'{XLSX_MAIN_NS}row'
+
+# Ячейка с одним id: id123 или ссылка на профиль (https://vk.com/id123). Просто числа в таблицах
+# (123, vk.com/123) не берутся - часто это номера групп и пабликов, а не профилей
+XLSX_ID_PATTERN = re.compile(r'\s*(?:\S*/)?id(\d{1,18})\s*$')
+
+
+def unique_ids(*id_arrays: np.ndarray) -> np.ndarray:
+    """Объединяет массивы id в один отсортированный массив без повторов"""
+    if len(id_arrays) == 0:
+        return np.empty(0, dtype=np.int64)
+    # То же, что np.unique, но через сортировку на месте: в новых numpy np.unique
+    # ищет повторы хэш-таблицей, а на десятках миллионов id это в разы медленнее
+    ids = np.concatenate(id_arrays)
+    ids.sort()
+    return ids[np.concatenate(([True], ids[1:] != ids[:-1]))] if len(ids) else ids
+
+
+def read_line_blocks(file, chunk_size: int):
+    """Читает бинарный файл кусками по chunk_size байт, обрезая каждый кусок по концу последней целой строки"""
+    tail = b''      # Незаконченная строка с конца прошлого куска
+    while chunk := file.read(chunk_size):
+        chunk = tail + chunk
+        last_newline = chunk.rfind(b'\n')
+        if last_newline == -1:
+            tail = chunk
+            continue
+        tail = chunk[last_newline + 1:]
+        yield chunk[:last_newline + 1]
+    if tail:
+        yield tail + b'\n'    # Последняя строка может быть без переноса
+
+
+def parse_plain_ids(block: bytes) -> np.ndarray | None:
+    """
+    Быстрый разбор куска, в котором только числа по одному на строку (самый частый вид выгрузки id).
+    Числа разбираются numpy без создания Python объекта на каждую строку
+    :return: Массив id или None, если в куске есть что-то кроме чисел и его нужно разбирать регулярным выражением
+    """
+    block = block.replace(b'\r', b'')
+    buffer = np.frombuffer(block, dtype=np.uint8)
+    if not PLAIN_ID_BYTES[buffer].all():
+        return None
+
+    # Длина самой длинной строки без переноса
+    newlines = np.flatnonzero(buffer == ord('\n'))
+    if len(newlines) == 0 or np.diff(newlines, prepend=-1).max() - 1 > TXT_MAX_ID_DIGITS:
+        return None
+
+    if newlines[-1] == len(newlines) - 1:      # Одни пустые строки
+        return np.empty(0, dtype=np.int64)
+    return np.fromstring(block, dtype=np.int64, sep=' ')
+
+
+def txt_parser(file_path: str, chunk_size: int = TXT_CHUNK_SIZE) -> tuple[np.ndarray, dict[str, np.ndarray]]:
     """
-    Разбирает .txt файл на список id.
+    Разбирает .txt файл на список id (по одному на строку).
+    Файл читается кусками по chunk_size байт, так что кроме самих id в памяти держится только один кусок.
 
-    ТОЛЬКО ЧИСЛОВЫЕ ID! **123456** и **id123456** можно, но **vasya_pupkin** уже нельзя.
+    ТОЛЬКО ЧИСЛОВЫЕ ID! **123456**, **id123456** и ссылки **vk.com/id123456** можно, но **vasya_pupkin** уже нельзя.
     Еще - группы (**club123456**) **не** обрабатываются, только профили пользователей!
     :param file_path: Путь до разбираемого файла.
-    :return: Список всех ID и словарь с ID на каждой странице
+    :param chunk_size: По сколько байт читать файл
+    :return: Отсортированный массив всех ID без повторов и словарь с массивом ID на каждой странице
     """
-    with open(file_path, 'r') as file:
-        ids = file.read().strip().split('\n')
+    id_chunks = []
+    invalid_lines, invalid_examples = 0, []
+
+    with open(file_path, 'rb') as file:
+        for block in read_line_blocks(file, chunk_size):
+            plain_ids = parse_plain_ids(block)
+            if plain_ids is not None:
+                id_chunks.append(plain_ids)
+                continue
+
+            ids = TXT_ID_PATTERN.findall(block)
+            id_chunks.append(np.fromiter(map(int, ids), dtype=np.int64, count=len(ids)))
+
+            # Строки, из которых не удалось достать id (пустые не в счет)
+            bad_number = len(TXT_NOT_EMPTY_PATTERN.findall(block)) - len(ids)
+            if bad_number > 0:
+                invalid_lines += bad_number
+                if len(invalid_examples) < TXT_INVALID_EXAMPLES:
+                    invalid_examples.extend(islice(
+                        (line.strip().decode(errors='replace') for line in block.splitlines()
+                         if line.strip() and not TXT_ID_PATTERN.fullmatch(line)),
+                        TXT_INVALID_EXAMPLES - len(invalid_examples)))
+
+    if invalid_lines:
+        print(f'[ID WARNING] В файле {invalid_lines} строк без числового id, они не будут включены в список id. '
+              f'Например: {invalid_examples}')
+
+    ids_array = np.concatenate(id_chunks) if id_chunks else np.empty(0, dtype=np.int64)
+    return unique_ids(ids_array), {'1': ids_array}
+
+
+def parse_cell_id(value: str) -> int | None:
+    """Достает id профиля из текста ячейки: id123456 или ссылка на профиль. Если id нет, то None"""
+    match = XLSX_ID_PATTERN.match(value)
+    return int(match.group(1)) if match else None
+
 
-    result_list = []
-    for profile_id in ids:
-        if not profile_id.isdigit():
-            if not profile_id[:2] == 'id' or not profile_id[2:].isdigit():
-                print(f'[ID WARNING] В файле есть id с буквами: "{profile_id}". Он не будет включен в список id. ')
-            else:
-                profile_id = profile_id[2:]
-                result_list.append(int(profile_id))
-        else:
-            result_list.append(int(profile_id))
+def column_index(reference: str) -> int:
+    """Индекс колонки (с 0) по адресу ячейки, например 'C15' -> 2"""
+    index = 0
+    for char in reference:
+        if char.isdigit():
+            break
+        index = index * 26 + ord(char) - 64
+    return index - 1
 
-    return list(set(result_list)), {'1': result_list}
 
+def read_xlsx_sheets(archive: zipfile.ZipFile) -> list[tuple[str, str]]:
+    """Возвращает имена листов книги и пути до их xml в архиве .xlsx, в порядке листов"""
+    workbook = ElementTree.fromstring(archive.read('xl/workbook.xml'))
+    relations = ElementTree.fromstring(archive.read('xl/_rels/workbook.xml.rels'))
+    targets = {relation.get('Id'): relation.get('Target')
+               for relation in relations.iter(f'{XLSX_PACKAGE_NS}Relationship')}
 
-def xlsx_parser(file_path: str, columns_with_id: list, have_headings: bool) -> tuple[list, dict]:
+    sheets = []
+    for sheet in workbook.iter(f'{XLSX_MAIN_NS}sheet'):
+        target = targets[sheet.get(f'{XLSX_RELATIONS_NS}id')]
+        path = target[1:] if target.startswith('/') else posixpath.normpath(posixpath.join('xl', target))
+        sheets.append((sheet.get('name'), path))
+    return sheets
+
+
+def read_shared_ids(archive: zipfile.ZipFile) -> np.ndarray:
+    """
+    Разбирает таблицу общих строк книги (в ней лежат все текстовые ячейки) сразу в id.
+    Сами строки в памяти не хранятся
+    :return: id для каждой общей строки по её номеру, -1 если в строке нет id
+    """
+    ids = array('q')
+    if 'xl/sharedStrings.xml' not in archive.namelist():
+        return np.empty(0, dtype=np.int64)
+
+    with archive.open('xl/sharedStrings.xml') as file:
+        for _, element in ElementTree.iterparse(file):
+            if element.tag == f'{XLSX_MAIN_NS}si':
+                profile_id = parse_cell_id(''.join(element.itertext()))
+                ids.append(-1 if profile_id is None else profile_id)
+                element.clear()
+    return np.frombuffer(ids, dtype=np.int64) if ids else np.empty(0, dtype=np.int64)
+
+
+def read_cell_id(cell: ElementTree.Element, shared_ids: np.ndarray) -> int | None:
+    """Достает id из xml элемента ячейки, учитывая её тип. Если id нет, то None"""
+    cell_type = cell.get('t', 'n')
+    if cell_type == 'inlineStr':
+        return parse_cell_id(''.join(cell.itertext()))
+
+    value = cell.findtext(f'{XLSX_MAIN_NS}v')
+    if value is None:
+        return None
+    if cell_type == 's':
+        profile_id = int(shared_ids[int(value)])
+        return None if profile_id == -1 else profile_id
+    if cell_type == 'str':
+        return parse_cell_id(value)
+    return None     # Числа (см. XLSX_ID_PATTERN), логические значения и ошибки
+
+
+def read_sheet_ids(archive: zipfile.ZipFile, sheet_path: str, columns: set[int], have_headings: bool,
+                   shared_ids: np.ndarray) -> tuple[np.ndarray, int]:
+    """
+    Построчно читает xml листа и достает id из нужных колонок. В памяти держится только текущая строка
+    :return: Массив id в порядке строк и сколько непустых ячеек в нужных колонках оказались без id
+    """
+    ids = array('q')        # Компактнее списка Python чисел
+    invalid_cells = 0
+    skip_row = have_headings
+
+    with archive.open(sheet_path) as file:
+        for _, element in ElementTree.iterparse(file):
+            if element.tag != XLSX_ROW_TAG:
+                continue
+            if skip_row:
+                skip_row = False
+                element.clear()
+                continue
+
+            column = -1
+            for cell in element:
+                reference = cell.get('r')
+                column = column_index(reference) if reference else column + 1   # Адрес у ячейки необязателен
+                if column not in columns or len(cell) == 0:
+                    continue
+
+                profile_id = read_cell_id(cell, shared_ids)
+                if profile_id is None:
+                    invalid_cells += 1
+                else:
+                    ids.append(profile_id)
+            element.clear()
+
+    return np.frombuffer(ids, dtype=np.int64) if ids else np.empty(0, dtype=np.int64), invalid_cells
+
+
+def xlsx_parser(file_path: str, columns_with_id: list,
+                have_headings: bool) -> tuple[np.ndarray, dict[str, np.ndarray]]:
     """
     Разбирает .xlsx файл на список id.
+    xml листов читается напрямую из архива потоком, без построения листа целиком,
+    и из каждой строки берутся только нужные колонки.
 
-    ТОЛЬКО ЧИСЛОВЫЕ ID! **123456** и **id123456** можно, но **vasya_pupkin** уже нельзя.
+    ТОЛЬКО ЧИСЛОВЫЕ ID С ПРЕФИКСОМ! **id123456** и ссылки **vk.com/id123456** можно, но **vasya_pupkin**
+    уже нельзя. Просто числа (**123456**) тоже не берутся - в таблицах это часто номера групп и пабликов.
     Еще - группы (**club123456**) **не** обрабатываются, только профили пользователей!
     :param file_path: Путь до разбираемого файла
     :param columns_with_id: Список индексов колонок с id профилей
     :param have_headings: Есть ли у файла заголовки
-    :return: Список всех ID и словарь с ID на каждой странице
+    :return: Отсортированный массив всех ID без повторов и словарь с массивом ID на каждой странице
     """
-    with pd.ExcelFile(file_path, engine='openpyxl') as xls:
-        all_ids = []        # Список всех id в файле
-        sheet_dict = {}     # Для сортировки выходного файла
-
-        for sheet_name in xls.sheet_names:
-            # Берем информацию с листа и преобразуем её в список
-            # (Да, оно выделено как предупреждение, но лишь потому что разрабы pd забыли поменять тип данных у usecols)
-            flat_list = list(pd.read_excel(
-                xls, sheet_name, usecols=columns_with_id, header=0 if have_headings else None
-            ).values.flatten().tolist())
-
-            # Избавляемся от nan
-            ids_list = [item for item in flat_list if item == item]
-
-            new_list = []
-            for item in ids_list:
-                # Если это ссылка, то получаем последнюю часть
-                if '/' in item:
-                    item = item.split('/')[-1]
-
-                    # И если оно начинается с id, то добавляем в список
-                    if item.startswith('id'):
-                        new_list.append(item[2:])
-                else:
-                    # Если это не ссылка, а так же id в начале или это просто число, то записываем его в список
-                    if item.startswith('id'):
-                        new_list.append(item[2:])
-                    elif item.isdigit():
-                        new_list.append(item)
-
-            # Избавляемся от id групп, оставляем только числа
-            ids_list = [int(item[item.rfind('/') + 3:])
-                        for item in ids_list
-                        if item[item.rfind('/') + 1: item.rfind('/') + 3] == 'id']
-
-            # Записываем в список всех id и в словарь для сортировки
-            all_ids.extend(ids_list)
-            sheet_dict[sheet_name] = ids_list
-
-        return list(set(all_ids)), sheet_dict
+    columns = set(columns_with_id)
+    sheet_dict = {}     # Для сортировки выходного файла
+
+    with zipfile.ZipFile(file_path) as archive:
+        start_time = time.perf_counter()
+        shared_ids = read_shared_ids(archive)
+        print(f'[INFO] Общие строки книги: {len(shared_ids)}, разобраны за {time.perf_counter() - start_time:.2f} сек.')
+
+        for sheet_name, sheet_path in read_xlsx_sheets(archive):
+            start_time = time.perf_counter()
+            sheet_dict[sheet_name], invalid_cells = read_sheet_ids(archive, sheet_path, columns,
+                                                                   have_headings, shared_ids)
+            print(f'[INFO] Лист "{sheet_name}": {len(sheet_dict[sheet_name])} id, ячеек без id: {invalid_cells}, '
+                  f'разобран за {time.perf_counter() - start_time:.2f} сек.')
+
+    return unique_ids(*sheet_dict.values()), sheet_dict
@@ -0,0 +1,58 @@
+import json
+
+import aiohttp
+from aiohttp import ClientSession, ClientTimeout, TCPConnector
+
+try:
+    import orjson   # Необязательная зависимость: разбирает JSON ответов в несколько раз быстрее json
+except ImportError:
+    orjson = None
+
+try:
+    import brotli   # Необязательная зависимость: без неё aiohttp не умеет распаковывать br
+except ImportError:
+    try:
+        import brotlicffi as brotli
+    except ImportError:
+        brotli = None
+
+CONNECT_TIMEOUT = 10        # Сколько секунд ждать подключения (к прокси или API)
+READ_TIMEOUT = 20           # Сколько секунд ждать очередной порции ответа, ответ API приходит через 4-15 секунд
+TOTAL_TIMEOUT = 30          # Сколько секунд максимум на весь запрос
+KEEPALIVE_TIMEOUT = 60      # Сколько секунд держать простаивающее соединение открытым
+DNS_CACHE_TTL = 10 * 60     # Сколько секунд помнить адрес API, чтобы не спрашивать DNS на каждое соединение
+
+
+def json_loads(text: str):
+    """Разбор JSON ответа через orjson, если он установлен, иначе через стандартный json"""
+    if orjson is not None:
+        return orjson.loads(text)
+    return json.loads(text)
+
+
+def accept_encoding(compress: bool = True) -> str:
+    """Какие сжатия ответа просить у API: br только если есть чем его распаковать"""
+    if not compress:
+        return 'identity'
+    return 'gzip, deflate, br' if brotli is not None else 'gzip, deflate'
+
+
+def create_session(proxy: str | None = None, proxy_auth: list[str, str] | None = None, max_connections: int = 50,
+                   compress: bool = True) -> ClientSession:
+    """
+    Создает сессию со своим пулом соединений. Одна сессия на один прокси: все запросы через этот прокси
+    (в том числе разных стадий сбора) переиспользуют уже открытые соединения, а не открывают новые.
+    Подключение и чтение ответа ограничены отдельно, так что зависший прокси или запрос отсекается быстро,
+    не дожидаясь общего таймаута
+    :param proxy: Прокси, если есть
+    :param proxy_auth: Логин и пароль для прокси, если есть
+    :param max_connections: Сколько соединений может быть открыто одновременно
+        (не меньше, чем запросов одновременно ожидают ответа)
+    :param compress: Просить ли API сжимать ответы
+    """
+    connector = TCPConnector(limit=max_connections, limit_per_host=max_connections,
+                             ttl_dns_cache=DNS_CACHE_TTL, keepalive_timeout=KEEPALIVE_TIMEOUT)
+    timeout = ClientTimeout(total=TOTAL_TIMEOUT, sock_connect=CONNECT_TIMEOUT, sock_read=READ_TIMEOUT)
+    auth = aiohttp.BasicAuth(proxy_auth[0], proxy_auth[1]) if proxy_auth is not None else None
+    return ClientSession(connector=connector, timeout=timeout, proxy=proxy, proxy_auth=auth,
+                         headers={'Accept-Encoding': accept_encoding(compress)})
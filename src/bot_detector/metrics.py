@@ -0,0 +1,251 @@
+import os
+import json
+import time
+import asyncio
+import cProfile
+import pstats
+from bisect import bisect_left
+from contextlib import contextmanager
+
+from aiohttp import web
+
+LATENCY_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 15, 20, 30]     # Задержка ответа API, сек
+DB_BUCKETS = [0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5]  # Запись пачки в БД, сек
+BATCH_BUCKETS = [1, 2, 5, 10, 15, 20, 25]                               # id в одном запросе
+PROFILERS = ['cprofile', 'yappi']
+
+
+class Histogram:
+    def __init__(self, buckets: list[float]):
+        """
+        Гистограмма в стиле Prometheus: количество значений не больше каждой из границ, сумма и количество
+        :param buckets: Верхние границы корзин по возрастанию, последняя корзина (+Inf) добавляется сама
+        """
+        self.buckets = list(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> float | None:
+        """Оценка квантиля сверху: граница корзины, в которую он попадает"""
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        passed = 0
+        for bound, count in zip(self.buckets + [float('inf')], self.counts):
+            passed += count
+            if passed >= rank:
+                return bound
+        return float('inf')
+
+
+class MetricsRegistry:
+    """
+    Счетчики, текущие значения и гистограммы сбора с метками (метод, токен и т.д.).
+    Всё в одном процессе и одном цикле событий, так что блокировки не нужны
+    """
+    def __init__(self):
+        self.counters: dict[tuple[str, tuple], float] = {}
+        self.gauges: dict[tuple[str, tuple], float] = {}
+        self.histograms: dict[tuple[str, tuple], Histogram] = {}
+
+    @staticmethod
+    def _key(name: str, labels: dict) -> tuple[str, tuple]:
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        key = self._key(name, labels)
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels) -> None:
+        self.gauges[self._key(name, labels)] = value
+
+    def observe(self, name: str, value: float, buckets: list[float] = LATENCY_BUCKETS, **labels) -> None:
+        key = self._key(name, labels)
+        if key not in self.histograms:
+            self.histograms[key] = Histogram(buckets)
+        self.histograms[key].observe(value)
+
+    def clear(self) -> None:
+        self.counters.clear()
+        self.gauges.clear()
+        self.histograms.clear()
+
+    def snapshot(self) -> dict:
+        """Все метрики словарем, пригодным для JSON"""
+        return {
+            'time': round(time.time(), 3),
+            'counters': [{'name': name, 'labels': dict(labels), 'value': value}
+                         for (name, labels), value in self.counters.items()],
+            'gauges': [{'name': name, 'labels': dict(labels), 'value': value}
+                       for (name, labels), value in self.gauges.items()],
+            'histograms': [{'name': name, 'labels': dict(labels), 'count': histogram.count,
+                            'sum': round(histogram.sum, 6), 'p50': histogram.quantile(0.5),
+                            'p99': histogram.quantile(0.99)}
+                           for (name, labels), histogram in self.histograms.items()],
+        }
+
+    def to_prometheus(self) -> str:
+        """Все метрики в текстовом формате Prometheus"""
+        def escape_label(value) -> str:
+            # В значениях меток формат требует экранировать обратный слэш, кавычку и перевод строки
+            return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+        def labels_str(labels: tuple, extra: dict = None) -> str:
+            items = list(labels) + list((extra or {}).items())
+            if not items:
+                return ''
+            return '{' + ','.join(f'{key}="{escape_label(value)}"' for key, value in items) + '}'
+
+        lines = []
+        for kind, metrics in [('counter', self.counters), ('gauge', self.gauges)]:
+            for name in sorted({name for name, _ in metrics}):
+                lines.append(f'# TYPE bot_detector_{name} {kind}')
+                lines.extend(f'bot_detector_{name}{labels_str(labels)} {value}'
+                             for (metric_name, labels), value in metrics.items() if metric_name == name)
+
+        for name in sorted({name for name, _ in self.histograms}):
+            lines.append(f'# TYPE bot_detector_{name} histogram')
+            for (metric_name, labels), histogram in self.histograms.items():
+                if metric_name != name:
+                    continue
+                passed = 0
+                for bound, count in zip(histogram.buckets + ['+Inf'], histogram.counts):
+                    passed += count
+                    lines.append(f'bot_detector_{name}_bucket{labels_str(labels, {"le": bound})} {passed}')
+                lines.append(f'bot_detector_{name}_sum{labels_str(labels)} {histogram.sum}')
+                lines.append(f'bot_detector_{name}_count{labels_str(labels)} {histogram.count}')
+        return '\n'.join(lines) + '\n'
+
+
+METRICS = MetricsRegistry()     # Общий реестр процесса, в него пишут сборщики и БД
+
+
+class MetricsExporter:
+    def __init__(self, log_file: str | None = None, snapshot_file: str | None = None, port: int | None = None,
+                 interval: float = 10.0, registry: MetricsRegistry = METRICS):
+        """
+        Раз в interval секунд выгружает метрики: дописывает строку в JSON lines лог и/или перезаписывает файл
+        со снимком, а также отдает их в формате Prometheus по адресу http://127.0.0.1:port/metrics.
+        Перед выгрузкой по счетчику собранных профилей считается скорость сбора (profiles_per_second).
+        Запускается в цикле событий сбора: async with MetricsExporter(...)
+        :param log_file: JSON lines файл, в который дописывается снимок метрик
+        :param snapshot_file: Файл, в котором всегда лежит последний снимок метрик
+        :param port: Порт для Prometheus, None - не поднимать сервер
+        :param interval: Как часто выгружать метрики, сек
+        """
+        self.log_file = log_file
+        self.snapshot_file = snapshot_file
+        self.port = port
+        self.interval = interval
+        self.registry = registry
+        self._task: asyncio.Task | None = None
+        self._runner: web.AppRunner | None = None
+        self._last_profiles: dict[tuple, float] = {}
+        self._last_time: float | None = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.log_file is not None or self.snapshot_file is not None or self.port is not None
+
+    async def __aenter__(self):
+        if self.port is not None:
+            app = web.Application()
+            app.router.add_get('/metrics', self._prometheus_handler)
+            self._runner = web.AppRunner(app)
+            await self._runner.setup()
+            await web.TCPSite(self._runner, '127.0.0.1', self.port).start()
+        if self.log_file is not None or self.snapshot_file is not None:
+            self._task = asyncio.create_task(self._export_loop())
+        return self
+
+    async def __aexit__(self, *exc_info):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self.export()   # Последний снимок, чтобы в файлах было состояние на конец сбора
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+    async def _prometheus_handler(self, request: web.Request) -> web.Response:
+        self._update_rates()
+        return web.Response(text=self.registry.to_prometheus(), content_type='text/plain')
+
+    async def _export_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            self.export()
+
+    def _update_rates(self) -> None:
+        """Скорость сбора профилей по каждому методу с прошлой выгрузки"""
+        now = time.monotonic()
+        for (name, labels), value in list(self.registry.counters.items()):
+            if name != 'profiles_collected_total':
+                continue
+            key = (name, labels)
+            if self._last_time is not None and now > self._last_time:
+                rate = (value - self._last_profiles.get(key, 0)) / (now - self._last_time)
+                self.registry.set('profiles_per_second', round(rate, 2), **dict(labels))
+            self._last_profiles[key] = value
+        self._last_time = now
+
+    def export(self) -> None:
+        self._update_rates()
+        snapshot = json.dumps(self.registry.snapshot(), ensure_ascii=False)
+        if self.log_file is not None:
+            with open(self.log_file, 'a', encoding='utf-8') as file:
+                file.write(snapshot + '\n')
+        if self.snapshot_file is not None:
+            # Через временный файл, чтобы читающий снимок никогда не увидел его недописанным
+            with open(f'{self.snapshot_file}.tmp', 'w', encoding='utf-8') as file:
+                file.write(snapshot)
+            os.replace(f'{self.snapshot_file}.tmp', self.snapshot_file)
+
+
+@contextmanager
+def profile_stage(stage: str, profiler: str | None, output_file: str):
+    """
+    Профилирует этап работы (сбор, анализ, выходной файл), если указан профилировщик.
+    Результат сохраняется в формате pstats (можно открыть через snakeviz или python -m pstats),
+    а самые тяжелые функции выводятся в консоль.
+    cProfile видит только основной поток процесса, yappi (нужно установить) - все потоки и корутины
+    :param stage: Название этапа, для вывода
+    :param profiler: 'cprofile', 'yappi' или None - без профилирования
+    :param output_file: Куда сохранить результат
+    """
+    if profiler is None:
+        yield
+        return
+
+    if profiler == 'yappi':
+        try:
+            import yappi
+        except ImportError:
+            raise ImportError('Для профилирования через yappi нужен пакет yappi: pip install yappi') from None
+        yappi.set_clock_type('wall')    # Сбор почти полностью состоит из ожидания, так что считаем реальное время
+        yappi.start()
+        try:
+            yield
+        finally:
+            yappi.stop()
+            yappi.get_func_stats().save(output_file, type='pstat')
+            yappi.clear_stats()
+    else:
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            profile.dump_stats(output_file)
+
+    print(f'[INFO] Профиль этапа {stage} сохранен в {output_file}')
+    pstats.Stats(output_file).sort_stats('cumulative').print_stats(15)
@@ -1,7 +1,9 @@
+import numpy as np
 import torch
 import torch.nn as nn
 
-from src.bot_detector.paths import OPEN_MODEL, CLOSE_MODEL
+from src.bot_detector.numpy_models import CLOSE_MAX_CLIP, OPEN_MAX_CLIP, NumpyPredictionModel, weights_checksum
+from src.bot_detector.paths import OPEN_MODEL, CLOSE_MODEL, OPEN_MODEL_NPZ, CLOSE_MODEL_NPZ
 
 torch.set_num_threads(8)
 
@@ -11,16 +13,13 @@ class DataNormalizer(torch.nn.Module):
         super().__init__()
         self.device = device
 
-        if is_close:
-            mc_max = [1, 1, 1, 1, 1, 1, 1, 1, 648, 1, 764, 1, 28, 1, 261, 1]
-        else:
-            mc_max = [1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 10, 1,
-                      835, 1, 716, 1, 1095, 1, 1173, 1, 426, 1, 56, 1, 545, 1, 1, 1, 1714, 1, 62, 1]
+        mc_max = CLOSE_MAX_CLIP if is_close else OPEN_MAX_CLIP
         self.max_clip = torch.tensor(mc_max, dtype=torch.float32, device=self.device)
         self.min_clip = torch.zeros_like(self.max_clip)
 
     def forward(self, item):
-        tensor = torch.tensor(item, dtype=torch.float32, device=self.device)
+        """Нормализует один профиль или сразу пачку профилей размером (N, кол-во признаков)"""
+        tensor = torch.as_tensor(item, dtype=torch.float32, device=self.device)
         clip_tensor = tensor.clip(self.min_clip, self.max_clip)
         return (clip_tensor - self.min_clip) / (self.max_clip - self.min_clip)
 
@@ -31,6 +30,7 @@ class PredictionModel:
         self.input_size = 16 if is_close else 45
         self.is_close = is_close
         self.transform = DataNormalizer(is_close, 'cpu')
+        self.checksum: str | None = None     # Контрольная сумма весов, записывается вместе с результатами
 
         self.load_model_from_params()
 
@@ -56,12 +56,42 @@ class PredictionModel:
         )
         self.model.load_state_dict(model_params)
         self.model.eval()
+        self.checksum = weights_checksum({key: value.cpu().numpy() for key, value in model_params.items()})
 
-    def model_predict(self, profile_data_list: list):
+    def model_predict(self, features) -> np.ndarray:
+        """
+        Предсказание для всей пачки профилей за один проход нейросети
+        :param features: Признаки профилей без id, размер (N, 16) для закрытых или (N, 45) для открытых
+        :return: Массив вероятностей того, что профиль - бот, размер (N, )
+        """
         with torch.no_grad():
-            results = []
-            for profile_data in profile_data_list:
-                prediction = self.model(self.transform(profile_data[1]))
-                prediction = torch.clip(prediction, 0, 1)
-                results.append((profile_data[0], round(prediction.item(), 4)))
-        return results
+            prediction = self.model(self.transform(features))
+            prediction = torch.clip(prediction, 0, 1)
+        return np.round(prediction.reshape(-1).numpy().astype(np.float64), 4)
+
+
+def export_numpy_weights() -> None:
+    """Выгружает веса обеих моделей из .pt в .npz, чтобы предсказывать через NumPy без PyTorch"""
+    for is_close in [False, True]:
+        model_params = torch.load(CLOSE_MODEL if is_close else OPEN_MODEL, weights_only=True)
+        np.savez(CLOSE_MODEL_NPZ if is_close else OPEN_MODEL_NPZ,
+                 **{key: value.cpu().numpy() for key, value in model_params.items()})
+
+
+def check_numpy_parity(samples: int = 10000, seed: int = 0) -> float:
+    """
+    Сравнивает предсказания PyTorch и NumPy моделей на случайных профилях
+    :return: Максимальное расхождение вероятностей по обеим моделям
+    """
+    rng = np.random.default_rng(seed)
+    max_difference = 0.0
+    for is_close in [False, True]:
+        max_clip = np.array(CLOSE_MAX_CLIP if is_close else OPEN_MAX_CLIP, dtype=np.float32)
+        # Немного выходим за границы нормализации, чтобы проверить и обрезку
+        features = (rng.random((samples, len(max_clip))) * max_clip * 1.2).astype(np.float32)
+        features[:, max_clip == 1] = np.round(features[:, max_clip == 1])
+
+        torch_result = PredictionModel(is_close).model_predict(features)
+        numpy_result = NumpyPredictionModel(is_close).model_predict(features)
+        max_difference = max(max_difference, float(np.abs(torch_result - numpy_result).max()))
+    return max_difference
@@ -0,0 +1,76 @@
+import hashlib
+
+import numpy as np
+
+from src.bot_detector.paths import OPEN_MODEL_NPZ, CLOSE_MODEL_NPZ
+
+# Верхние границы признаков для нормализации (нижние везде 0), общие для обоих движков
+CLOSE_MAX_CLIP = [1, 1, 1, 1, 1, 1, 1, 1, 648, 1, 764, 1, 28, 1, 261, 1]
+OPEN_MAX_CLIP = [1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 10, 1,
+                 835, 1, 716, 1, 1095, 1, 1173, 1, 426, 1, 56, 1, 545, 1, 1, 1, 1714, 1, 62, 1]
+
+# Насколько предсказания NumPy могут расходиться с PyTorch. Вероятности округляются до 4 знаков,
+# так что на границе округления разница 0.0001
+PARITY_TOLERANCE = 1.5e-4
+
+# Ключи весов линейных слоев в state_dict модели (nn.Sequential: Linear, ReLU, Dropout, Linear, ReLU, Dropout, ...)
+LINEAR_LAYERS = ['0', '3', '6']
+
+
+def weights_checksum(weights: dict) -> str:
+    """
+    Контрольная сумма весов модели. Считается по значениям весов линейных слоев,
+    так что у PyTorch и NumPy версий одной и той же модели она совпадает
+    :param weights: Словарь {ключ state_dict: массив NumPy}
+    """
+    checksum = hashlib.sha256()
+    for layer in LINEAR_LAYERS:
+        for kind in ['weight', 'bias']:
+            checksum.update(np.ascontiguousarray(weights[f'{layer}.{kind}'], dtype=np.float32).tobytes())
+    return checksum.hexdigest()[:16]
+
+
+class NumpyPredictionModel:
+    def __init__(self, is_close: bool):
+        """
+        Та же нейросеть, что и в PredictionModel, но на NumPy: не нужно загружать PyTorch.
+        Linear -> ReLU -> Linear -> ReLU -> Linear -> Sigmoid, Dropout при предсказании ничего не делает.
+        Веса берутся из .npz файлов, которые выгружаются командой `bot_detector model export`
+        """
+        self.input_size = 16 if is_close else 45
+        self.is_close = is_close
+        self.max_clip = np.array(CLOSE_MAX_CLIP if is_close else OPEN_MAX_CLIP, dtype=np.float32)
+        self.layers: list[tuple[np.ndarray, np.ndarray]] = []
+        self.checksum: str | None = None     # Контрольная сумма весов, записывается вместе с результатами
+
+        self.load_model_from_params()
+
+    def load_model_from_params(self):
+        weights_file = CLOSE_MODEL_NPZ if self.is_close else OPEN_MODEL_NPZ
+        if not weights_file.exists():
+            raise FileNotFoundError(f'Не найдены веса модели для NumPy ({weights_file})! '
+                                    f'Выгрузите их командой "bot_detector model export"')
+
+        with np.load(weights_file) as weights:
+            # Храним веса уже транспонированными, чтобы умножать пачку (N, in) @ (in, out)
+            self.layers = [(weights[f'{layer}.weight'].astype(np.float32).T.copy(),
+                            weights[f'{layer}.bias'].astype(np.float32))
+                           for layer in LINEAR_LAYERS]
+            self.checksum = weights_checksum(weights)
+
+    def model_predict(self, features) -> np.ndarray:
+        """
+        Предсказание для всей пачки профилей
+        :param features: Признаки профилей без id, размер (N, 16) для закрытых или (N, 45) для открытых
+        :return: Массив вероятностей того, что профиль - бот, размер (N, )
+        """
+        result = np.clip(np.asarray(features, dtype=np.float32), 0, self.max_clip) / self.max_clip
+
+        for layer_number, (weight, bias) in enumerate(self.layers):
+            result = result @ weight + bias
+            if layer_number != len(self.layers) - 1:
+                np.maximum(result, 0, out=result)   # ReLU
+
+        # Сигмоида через tanh не переполняется на больших по модулю значениях
+        result = 0.5 * (1 + np.tanh(0.5 * result))
+        return np.round(np.clip(result, 0, 1).reshape(-1).astype(np.float64), 4)
@@ -23,6 +23,10 @@ MODELS_DIR = PROJECT_ROOT / 'models'
 CONFIG_FILE = PROJECT_ROOT / 'settings.ini'
 OPEN_MODEL = MODELS_DIR / 'open_model_state_dict.pt'
 CLOSE_MODEL = MODELS_DIR / 'close_model_state_dict.pt'
+OPEN_MODEL_NPZ = MODELS_DIR / 'open_model_weights.npz'       # Те же веса для NumPy, без PyTorch
+CLOSE_MODEL_NPZ = MODELS_DIR / 'close_model_weights.npz'
+PROFILE_CACHE_FILE = DATA_DIR / 'profile_cache.db'    # Общий для всех входных файлов кэш собранных профилей
+TOKEN_LIMITS_FILE = DATA_DIR / 'token_limits.json'    # Лимиты методов, в которые упирались токены
 
 _settings_original = """[VK]
 access_token = []
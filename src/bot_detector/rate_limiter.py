@@ -0,0 +1,56 @@
+import asyncio
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: int = 1):
+        """
+        Ограничитель частоты запросов по алгоритму "ведро с токенами".
+        Один экземпляр на один токен VK API - все запросы с этим токеном проходят через него
+        :param rate: Сколько запросов в секунду разрешено (токенов добавляется в ведро за секунду)
+        :param capacity: Вместимость ведра, т.е. сколько запросов можно отправить разом после простоя.
+            VK API не любит всплески, поэтому по умолчанию 1 - запросы идут ровным потоком
+        """
+        if rate <= 0:
+            raise ValueError('Частота запросов должна быть больше нуля')
+        if capacity < 1:
+            raise ValueError('Вместимость ведра должна быть не меньше 1')
+
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._last_refill: float | None = None
+        self._lock = asyncio.Lock()    # Очередь из желающих отправить запрос
+
+    def _refill(self, now: float) -> None:
+        """Пополняет ведро в соответствии с прошедшим временем"""
+        if self._last_refill is None:
+            self._last_refill = now
+        self._tokens = min(self.capacity, self._tokens + (now - self._last_refill) * self.rate)
+        self._last_refill = now
+
+    async def acquire(self) -> None:
+        """Ждет, пока в ведре появится токен, и забирает его. Порядок ожидающих сохраняется (FIFO)"""
+        async with self._lock:
+            loop = asyncio.get_running_loop()
+            self._refill(loop.time())
+            while self._tokens < 1:
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+                self._refill(loop.time())
+            self._tokens -= 1
+
+    def release(self) -> None:
+        """
+        Возвращает в ведро токен, полученный через acquire, но не потраченный на запрос.
+        Во время паузы после backoff токен не возвращается, чтобы не сократить паузу
+        """
+        self._refill(asyncio.get_running_loop().time())
+        if self._tokens >= 0:
+            self._tokens = min(self.capacity, self._tokens + 1)
+
+    def backoff(self, seconds: float) -> None:
+        """
+        Откладывает следующий запрос минимум на seconds секунд (например, после ошибки 6 "слишком много запросов
+        в секунду"). Одновременные ошибки не складываются: пауза отсчитывается от текущего момента
+        """
+        self._refill(asyncio.get_running_loop().time())
+        self._tokens = min(self._tokens, 1 - seconds * self.rate)
@@ -0,0 +1,110 @@
+import json
+import time
+import hashlib
+from contextlib import contextmanager
+
+try:
+    import fcntl    # Linux и macOS
+except ImportError:
+    fcntl = None
+    import msvcrt   # Windows
+
+from src.bot_detector.paths import TOKEN_LIMITS_FILE
+
+TOKEN_COOLDOWN = 15 * 60            # Первая пауза токена после ошибки 29 в методе, сек
+MAX_TOKEN_COOLDOWN = 24 * 60 * 60   # Пауза удваивается при каждом повторном лимите, но не больше суток
+
+
+def token_key(token: str) -> str:
+    """Ключ токена в файле лимитов. Сами токены в файл не пишутся"""
+    return hashlib.sha256(token.encode()).hexdigest()[:16]
+
+
+@contextmanager
+def file_lock(path: str):
+    """Блокировка между процессами через отдельный файл: пока она взята, другие процессы ждут её на входе"""
+    with open(path, 'a+b') as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        else:
+            lock_file.seek(0)
+            msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK, 1)  # Блокировка первого байта файла
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+            else:
+                lock_file.seek(0)
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+class TokenLimits:
+    def __init__(self, file=TOKEN_LIMITS_FILE):
+        """
+        Лимиты методов API, которые наблюдались у токенов, хранятся между запусками в JSON файле.
+        Токен, упершийся в лимит метода (ошибка 29), не выбывает до конца сбора, а уходит на паузу,
+        после которой пробуется снова. Если лимит повторяется сразу после паузы, то пауза удваивается.
+        Запись по каждому токену и методу:
+            limited_until - до какого времени (unix) токен на паузе;
+            cooldown - длина последней паузы, сек;
+            requests_before_limit - сколько запросов токен успел выполнить до последнего лимита
+        В режиме процессов файл общий у всех процессов сбора, поэтому он читается и обновляется под блокировкой
+        (file_lock), а перед записью паузы перечитывается, чтобы не затереть паузы, записанные другими процессами
+        :param file: JSON файл с лимитами
+        """
+        self.file = file
+        self.lock_file = f'{file}.lock'
+        with file_lock(self.lock_file):
+            self.limits: dict[str, dict[str, dict]] = self._read()
+
+    def _read(self) -> dict:
+        try:
+            with open(self.file, 'r', encoding='utf-8') as limits_file:
+                return json.load(limits_file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def _get(self, token: str, method: str) -> dict:
+        return self.limits.get(token_key(token), {}).get(method, {})
+
+    def limited_until(self, token: str, method: str) -> float:
+        """До какого времени (unix) токен на паузе в методе, 0 - если не на паузе"""
+        return self._get(token, method).get('limited_until', 0)
+
+    def is_available(self, token: str, method: str) -> bool:
+        return self.limited_until(token, method) <= time.time()
+
+    def requests_before_limit(self, token: str, method: str) -> int | None:
+        """Сколько запросов токен выполнил до последнего лимита, если лимит уже встречался"""
+        return self._get(token, method).get('requests_before_limit')
+
+    def record_limit(self, token: str, method: str, requests_done: int) -> float:
+        """
+        Отмечает, что токен уперся в лимит метода, и ставит его на паузу
+        :param requests_done: Сколько запросов токен успел выполнить в этом методе до лимита
+        :return: Длина паузы, сек
+        """
+        with file_lock(self.lock_file):
+            self.limits = self._read()      # Другие процессы могли записать свои паузы
+            record = self._get(token, method)
+            now = time.time()
+
+            # Если лимит повторился сразу после прошлой паузы (без удачных запросов или вскоре после неё),
+            # то прошлой паузы не хватило
+            cooldown = TOKEN_COOLDOWN
+            if record and (requests_done == 0 or now - record.get('limited_until', 0) < record.get('cooldown', 0)):
+                cooldown = min(record['cooldown'] * 2, MAX_TOKEN_COOLDOWN)
+
+            self.limits.setdefault(token_key(token), {})[method] = {
+                'limited_until': now + cooldown,
+                'cooldown': cooldown,
+                'requests_before_limit': requests_done if requests_done > 0 else record.get('requests_before_limit', 0),
+            }
+            self._write()
+        return cooldown
+
+    def _write(self) -> None:
+        """Записывает лимиты в файл, вызывается под блокировкой"""
+        with open(self.file, 'w', encoding='utf-8') as limits_file:
+            json.dump(self.limits, limits_file, indent=4)
@@ -0,0 +1,111 @@
+import asyncio
+from collections import deque
+
+import numpy as np
+
+
+class WorkQueue:
+    def __init__(self, ids, max_attempts: int = 5, closed: bool = True):
+        """
+        Общая очередь id для всех полос сбора одного метода.
+        Полосы сами забирают из неё пакеты id по мере готовности, так что быстрые полосы забирают работу медленных,
+        а пакет, который полоса не смогла собрать (ошибка сети, лимит токена), сразу возвращается в очередь
+        и достается другой полосе
+        :param ids: id пользователей, которые нужно собрать. Хранятся одним массивом int64 без копирования,
+            если это уже такой массив, а в Python числа превращаются только id выданных пакетов
+        :param max_attempts: Сколько раз пакет с id может вернуться в очередь, после чего id откладываются
+            до следующего круга сбора
+        :param closed: Известны ли уже все id. Если нет, то id можно добавлять (add) по ходу сбора,
+            а полосы ждут новых id, пока очередь не закроют (close)
+        """
+        self._ids = np.asarray(ids, dtype=np.int64)
+        self._position = 0                  # Сколько id из массива уже выдано
+        self._added = deque()               # Массивы id, добавленные по ходу сбора, выдаются после массива
+        self._added_number = 0              # Сколько id в добавленных массивах
+        self._returned = deque()            # Возвращенные id, выдаются раньше массива
+        self._in_work = 0                   # Сколько id сейчас у полос (они еще могут вернуться в очередь)
+        self._attempts: dict[int, int] = {}
+        self._changed = asyncio.Condition()
+        self._closed = closed
+        self.max_attempts = max_attempts
+        self.failed = 0                     # Сколько id отложено до следующего круга
+        self.total = len(self._ids)         # Сколько id попало в очередь за все время, включая добавленные
+        self.completed = 0                  # Сколько id уже обработано
+
+    def __len__(self) -> int:
+        """Сколько id осталось собрать, включая те, что сейчас у полос"""
+        return self._waiting() + self._in_work
+
+    def _waiting(self) -> int:
+        """Сколько id ждет в очереди"""
+        return len(self._returned) + len(self._ids) - self._position + self._added_number
+
+    @property
+    def closed(self) -> bool:
+        return self._closed
+
+    async def add(self, ids) -> None:
+        """Добавляет id в конец очереди, пока она не закрыта (например, открытые профили с прошлой стадии)"""
+        ids = np.asarray(ids, dtype=np.int64)
+        if len(ids) == 0:
+            return
+        async with self._changed:
+            if self._closed:
+                raise RuntimeError('Нельзя добавить id в закрытую очередь')
+            self._added.append(ids)
+            self._added_number += len(ids)
+            self.total += len(ids)
+            self._changed.notify_all()
+
+    async def close(self) -> None:
+        """Отмечает, что новых id больше не будет: полосы закончат работу, когда очередь опустеет"""
+        async with self._changed:
+            self._closed = True
+            self._changed.notify_all()
+
+    async def take(self, count: int) -> list[int]:
+        """
+        Забирает из очереди до count id.
+        Если очередь пуста, но часть id еще у других полос, то ждет - они могут вернуться.
+        Если очередь не закрыта, то ждет новых id
+        :return: Список id или пустой список, если собирать больше нечего
+        """
+        async with self._changed:
+            while self._waiting() == 0:
+                if self._in_work == 0 and self._closed:
+                    return []
+                await self._changed.wait()
+
+            batch = [self._returned.popleft() for _ in range(min(count, len(self._returned)))]
+            if len(batch) < count and self._position == len(self._ids) and self._added:
+                # Массив выдан, переходим к следующему добавленному
+                self._ids = self._added.popleft()
+                self._position = 0
+                self._added_number -= len(self._ids)
+            if len(batch) < count:
+                end = min(self._position + count - len(batch), len(self._ids))
+                batch.extend(self._ids[self._position:end].tolist())
+                self._position = end
+            self._in_work += len(batch)
+            return batch
+
+    async def done(self, ids: list[int]) -> None:
+        """Отмечает, что пакет id обработан"""
+        async with self._changed:
+            self._in_work -= len(ids)
+            self.completed += len(ids)
+            self._changed.notify_all()
+
+    async def give_back(self, ids: list[int]) -> None:
+        """Возвращает необработанный пакет id в начало очереди, чтобы его сразу забрала другая полоса"""
+        async with self._changed:
+            self._in_work -= len(ids)
+            to_return = []
+            for profile_id in ids:
+                self._attempts[profile_id] = self._attempts.get(profile_id, 0) + 1
+                if self._attempts[profile_id] < self.max_attempts:
+                    to_return.append(profile_id)
+                else:
+                    self.failed += 1
+            self._returned.extendleft(reversed(to_return))
+            self._changed.notify_all()